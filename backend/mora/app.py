@@ -7,7 +7,10 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import collections
 import os
+import threading
+import time
 import typing
 
 import flask
@@ -15,6 +18,8 @@ import werkzeug
 import flask_session
 
 from . import exceptions
+from . import lora
+from . import metrics
 from . import service
 from . import settings
 from . import util
@@ -43,10 +48,93 @@ def create_app(overrides: typing.Dict[str, typing.Any] = None):
 
     app.register_blueprint(base.blueprint)
     app.register_blueprint(sso.blueprint)
+    app.register_blueprint(metrics.blueprint)
 
     for blueprint in service.blueprints:
         app.register_blueprint(blueprint)
 
+    if app.config['CLASSIFICATION_CACHE_WARMUP']:
+        def warm_up():
+            try:
+                lora.warm_up_classification_cache()
+            except Exception:
+                app.logger.exception('failed to warm up classification cache')
+
+        # don't hold up the start of the application
+        threading.Thread(target=warm_up, daemon=True).start()
+
+    @app.before_request
+    def start_timer():
+        flask.g.request_start = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        calls = flask.g.pop('lora_calls', [])
+        start = flask.g.pop('request_start', None)
+
+        if start is None:
+            return response
+
+        duration = time.perf_counter() - start
+
+        metrics.REQUEST_DURATION.observe(
+            duration,
+            endpoint=flask.request.endpoint or '',
+            method=flask.request.method,
+            status=response.status_code,
+        )
+
+        response.headers['Server-Timing'] = ', '.join(
+            '{};dur={:.1f}{}'.format(
+                name, secs * 1000,
+                ';desc="{}"'.format(desc) if desc else '',
+            )
+            for name, secs, desc in get_server_timings(duration, calls)
+        )
+
+        threshold = float(app.config['SLOW_REQUEST_THRESHOLD'])
+
+        if threshold and duration > threshold:
+            app.logger.warning(
+                'slow request: {} {} took {:.2f}s with {} LoRA calls '
+                'taking {:.2f}s; the slowest were:\n{}'.format(
+                    flask.request.method,
+                    flask.request.full_path.rstrip('?'),
+                    duration,
+                    len(calls),
+                    sum(call.duration for call in calls),
+                    '\n'.join(
+                        '  {:.3f}s {} {} -> {}, {} bytes, '
+                        '{:.3f}s decoding'.format(
+                            call.duration, call.method, call.path,
+                            call.status, call.size, call.decode_duration,
+                        )
+                        for call in sorted(calls,
+                                           key=lambda call: call.duration,
+                                           reverse=True)[:5]
+                    ),
+                ),
+            )
+
+        return response
+
+    @app.after_request
+    def log_lora_counters(response):
+        counters = flask.g.pop('lora_counters', None)
+
+        if counters:
+            lora.identity_map_stats.add(counters['hits'], counters['misses'])
+
+            app.logger.debug(
+                'LoRA identity map for {!r}: {} hits, {} misses'.format(
+                    flask.request.path,
+                    counters['hits'],
+                    counters['misses'],
+                ),
+            )
+
+        return response
+
     @app.errorhandler(Exception)
     def handle_invalid_usage(error):
         """
@@ -78,5 +166,45 @@ def create_app(overrides: typing.Dict[str, typing.Any] = None):
     return app
 
 
+def get_server_timings(duration: float, calls: typing.List[lora.Call]):
+    '''Summarise the given LoRA calls as ``(name, seconds,
+    description)`` entries suitable for a ``Server-Timing`` header.
+
+    Please note that calls may happen in parallel, so their total
+    duration can exceed that of the request.
+
+    '''
+    yield 'app', duration, None
+
+    if not calls:
+        return
+
+    yield (
+        'lora',
+        sum(call.duration for call in calls),
+        '{} calls ({} bytes)'.format(
+            len(calls),
+            sum(call.size for call in calls),
+        ),
+    )
+    yield 'lora-json', sum(call.decode_duration for call in calls), None
+
+    paths = collections.OrderedDict()
+
+    for call in calls:
+        paths.setdefault(call.path, []).append(call)
+
+    for path, path_calls in paths.items():
+        yield (
+            # metric names are tokens, so they cannot contain slashes
+            'lora.' + path.replace('/', '.'),
+            sum(call.duration for call in path_calls),
+            '{} calls ({} bytes)'.format(
+                len(path_calls),
+                sum(call.size for call in path_calls),
+            ),
+        )
+
+
 # create a default instance for backwards compatibility
 app = create_app()
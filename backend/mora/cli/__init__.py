@@ -7,4 +7,5 @@
 #
 
 from . import base  # noqa
+from . import dar  # noqa
 from . import lora  # noqa
@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+'''Management of the local replica of DAR.
+
+'''
+
+import itertools
+import json
+import os
+
+import click
+
+from .. import dar
+from .. import settings
+from ..service import address
+
+from . import base
+
+
+@base.cli.group('dar')
+def group():
+    '''Subcommands for the local replica of DAR.'''
+
+
+def read_addresses(fp):
+    '''Read addresses from either a JSON array or newline-delimited
+    JSON, yielding each address as an object.'''
+    head = fp.read(1)
+
+    while head.isspace():
+        head = fp.read(1)
+
+    if head == '[':
+        yield from json.loads(head + fp.read())
+
+    else:
+        for line in itertools.chain([head + fp.readline()], fp):
+            if line.strip():
+                yield json.loads(line)
+
+
+@group.command('load')
+@click.option('--replace', is_flag=True,
+              help='Remove all existing addresses first.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Database to load into, defaulting to the configured '
+              'DAR_REPLICA_FILE.')
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.File('r', encoding='utf-8'))
+def load(replace, output, inputs):
+    '''Load a bulk dump of DAWA into the replica.
+
+    Each input should contain addresses or access addresses in the
+    'mini' structure, e.g. as obtained using:
+
+    \b
+    curl -o adresser.json \\
+      'https://dawa.aws.dk/adresser?struktur=mini&ndjson'
+    curl -o adgangsadresser.json \\
+      'https://dawa.aws.dk/adgangsadresser?struktur=mini&ndjson'
+
+    Add e.g. '&kommunekode=0751' to either URL to only obtain the
+    addresses of a municipality.
+
+    '''
+    filename = output or settings.DAR_REPLICA_FILE
+
+    if not filename:
+        raise click.UsageError('no output given, and DAR_REPLICA_FILE '
+                               'is unset')
+
+    replica = dar.Replica(os.path.abspath(filename))
+
+    def convert():
+        for fp in inputs:
+            for addrobj in read_addresses(fp):
+                # only addresses refer to an access address
+                yield (
+                    'adresser' if 'adgangsadresseid' in addrobj
+                    else 'adgangsadresser',
+                    addrobj,
+                    address.stringify(addrobj),
+                )
+
+    count = replica.load(convert(), replace=replace)
+
+    click.echo('Loaded {} addresses into {}'.format(count, filename))
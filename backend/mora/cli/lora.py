@@ -134,6 +134,8 @@ def lora_update(path, input):
               help='Show more output.')
 @click.option('--jobs', '-j', default=1, type=int,
               help='Amount of parallel requests.')
+@click.option('--wash-jobs', type=int,
+              help='Amount of addresses to wash in parallel.')
 @click.option('--failfast', '-f', is_flag=True,
               help='Stop at first error.')
 @click.option('--include', '-I', multiple=True,
@@ -501,7 +501,8 @@ def replace_relation_value(relations: typing.List[dict],
             exceptions.ErrorCodes.E_ORIGINAL_ENTRY_NOT_FOUND)
 
 
-def add_history_entry(scope: lora.Scope, id: str, note: str):
+def add_history_entry(scope: lora.Scope, id: str, note: str,
+                      obj: dict=None):
     """
     Add a history entry to a given object.
     The idea is to write an update to the employee whenever an object
@@ -511,13 +512,20 @@ def add_history_entry(scope: lora.Scope, id: str, note: str):
 
     We have to make some sort of 'meaningful' change to data to be
     able to update the 'note' field - which for now amounts to just
-    updating the virkning notetekst of gyldighed with a garbage value
+    updating the virkning notetekst of a single state with a garbage
+    value. As LoRA merges the states given with the existing ones, the
+    others remain as they are. Should the object lack states within
+    the validity of the scope, we update all of them, as we used to.
 
     :param id: The UUID of the employee
     :param note: A note to be associated with the entry
+    :param obj: The registration of the object, if already loaded;
+                otherwise, we look it up
     """
 
-    obj = scope.get(id)
+    if obj is None:
+        obj = scope.get(id)
+
     if not obj:
         raise exceptions.HTTPException(
             exceptions.ErrorCodes.E_NOT_FOUND,
@@ -526,6 +534,18 @@ def add_history_entry(scope: lora.Scope, id: str, note: str):
         )
 
     unique_string = str(uuid.uuid4())
+    tilstande = obj.get('tilstande', {})
+
+    validity_name = min(
+        (validity_name for validity_name in tilstande
+         if tilstande[validity_name]),
+        default=None,
+    )
+
+    if validity_name is not None:
+        tilstande = {
+            validity_name: tilstande[validity_name][:1],
+        }
 
     payload = {
         'note': note,
@@ -535,7 +555,7 @@ def add_history_entry(scope: lora.Scope, id: str, note: str):
                                    unique_string)
                 for validity in validities
             ]
-            for validity_name, validities in obj['tilstande'].items()
+            for validity_name, validities in tilstande.items()
         }
     }
 
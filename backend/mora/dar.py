@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+'''Local replica of DAR, used for looking up and autocompleting
+addresses without asking DAWA. It's an SQLite database, enabled by
+pointing the ``DAR_REPLICA_FILE`` setting at it, and loaded from a
+bulk dump of DAWA using ``flask.sh dar load``.
+
+The replica merely contains current addresses and access addresses,
+so anything missing from it is looked up in DAWA as usual.
+
+'''
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import typing
+
+from . import settings
+
+ADDRESS_TYPES = ('adresser', 'adgangsadresser')
+
+_SEPARATORS = re.compile(r'[\s,.]+')
+
+_replicas = {}
+
+
+def normalise(text: str) -> str:
+    '''Normalise an address text for searching.
+
+    .. doctest::
+
+      >>> normalise('Nordre  Ringgade 1, 8000 Aarhus C')
+      'nordre ringgade 1 8000 aarhus c'
+      >>> normalise('Pilestræde 43, 3. th')
+      'pilestræde 43 3 th'
+
+    '''
+    return _SEPARATORS.sub(' ', text.lower()).strip()
+
+
+class Replica:
+    '''A replica of DAR, stored in the given database file.'''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        self.__local = threading.local()
+
+    def connect(self):
+        # connections cannot be shared between threads or processes
+        conn = getattr(self.__local, 'conn', None)
+
+        if conn is None or self.__local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30)
+
+            # allow reading while loading
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS addresses ('
+                'id TEXT PRIMARY KEY, type TEXT, kommunekode INTEGER, '
+                'tekst TEXT, search TEXT, data TEXT)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS addresses_search '
+                'ON addresses (type, search)'
+            )
+            conn.commit()
+
+            self.__local.conn = conn
+            self.__local.pid = os.getpid()
+
+        return conn
+
+    def load(self,
+             addresses: typing.Iterable[typing.Tuple[str, dict, str]],
+             replace=False) -> int:
+        '''Load the given addresses into the replica.
+
+        :param addresses: Tuples of the address type, i.e. one of
+                          :py:data:`ADDRESS_TYPES`, the address object
+                          in the ``mini`` structure of DAWA, and the
+                          text for autocompleting it.
+        :param replace: Remove all existing addresses first.
+        :return: The amount of addresses loaded.
+
+        '''
+        conn = self.connect()
+        count = 0
+
+        def rows():
+            nonlocal count
+
+            for addrtype, addrobj, text in addresses:
+                if addrtype not in ADDRESS_TYPES:
+                    raise ValueError(
+                        'invalid address type {!r}'.format(addrtype),
+                    )
+
+                count += 1
+
+                yield (
+                    addrobj['id'],
+                    addrtype,
+                    int(addrobj['kommunekode'])
+                    if addrobj.get('kommunekode') else None,
+                    text,
+                    normalise(text),
+                    json.dumps(addrobj),
+                )
+
+        with conn:
+            if replace:
+                conn.execute('DELETE FROM addresses')
+
+            conn.executemany(
+                'INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?, ?, ?)',
+                rows(),
+            )
+
+        return count
+
+    def get(self, addrids: typing.Iterable[str]) -> dict:
+        '''Look up the given addresses, in the form returned by
+        :py:func:`mora.service.address.fetch_addresses`. Addresses
+        missing from the replica are omitted.
+
+        '''
+        addrids = list(addrids)
+        entries = {}
+
+        # stay well below the limit on parameters in SQLite
+        for i in range(0, len(addrids), 500):
+            chunk = addrids[i:i + 500]
+
+            for addrid, addrtype, data in self.connect().execute(
+                'SELECT id, type, data FROM addresses WHERE id IN ({})'
+                .format(', '.join('?' * len(chunk))),
+                chunk,
+            ):
+                entries[addrid] = {
+                    'endpoint': addrtype,
+                    'address': json.loads(data),
+                }
+
+        return entries
+
+    def autocomplete(self, addrtype: str, q: str, limit: int,
+                     kommunekode: int = None) -> typing.List[
+                         typing.Tuple[str, str]]:
+        '''Find addresses of the given type starting with the given
+        query, optionally within a municipality.
+
+        :return: A list of their texts and IDs.
+
+        '''
+        prefix = normalise(q)
+
+        query = (
+            'SELECT tekst, id FROM addresses '
+            'WHERE type = ? AND search >= ? AND search < ?'
+        )
+        args = [addrtype, prefix, prefix + '\U0010ffff']
+
+        if kommunekode is not None:
+            query += ' AND kommunekode = ?'
+            args.append(kommunekode)
+
+        query += ' ORDER BY search LIMIT ?'
+        args.append(limit)
+
+        return self.connect().execute(query, args).fetchall()
+
+
+def get_replica() -> typing.Optional[Replica]:
+    '''Obtain the replica configured in the settings, if any.'''
+    filename = settings.DAR_REPLICA_FILE
+
+    if not filename or not os.path.isfile(filename):
+        return None
+
+    try:
+        return _replicas[filename]
+    except KeyError:
+        _replicas[filename] = replica = Replica(filename)
+
+        return replica
@@ -84,6 +84,7 @@ class ErrorCodes(Enum):
     E_ORIGINAL_ENTRY_NOT_FOUND = 400, "Original entry not found."
     E_NO_LOCAL_MUNICIPALITY = 400, "No local municipality found."
     E_SIZE_MUST_BE_POSITIVE = 400, "Size must be positive."
+    E_JOB_NOT_FOUND = 404, "Job not found."
 
     # Misc
     E_INVALID_INPUT = 400, "Invalid input."
@@ -143,3 +144,20 @@ class HTTPException(werkzeug.exceptions.HTTPException):
             self.response.status_code = self.key.code
         except RuntimeError:
             pass
+
+
+def get_error_body(exc: Exception) -> dict:
+    '''Describe the given error as in the body of an error response,
+    e.g. for reporting it along with other results. Any unexpected
+    errors are logged.
+
+    '''
+    if not isinstance(exc, HTTPException):
+        flask.current_app.logger.error(
+            'request failed: {}'.format(exc),
+            exc_info=(type(exc), exc, exc.__traceback__),
+        )
+
+        exc = HTTPException(message=str(exc))
+
+    return exc.body
@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+'''Index of the organisational hierarchy.
+
+Answering questions such as 'where is this unit located?' otherwise
+requires walking the tree through LoRA, one request per level. Instead,
+we load all active units of an organisation once, and keep their
+parents and names in memory.
+
+The index covers a single day, as MO records validities with that
+granularity, and is shared between requests. Changes to units made
+through MO invalidate it within the process making them, whereas
+changes made elsewhere -- including other processes serving MO --
+only show up once it expires, i.e. after ``HIERARCHY_CACHE_TTL``
+seconds. As such, locations, trees and child counts may be somewhat
+stale, and the index is only suitable for reading; validation of
+changes always consults LoRA.
+
+'''
+
+import collections
+import typing
+
+from . import metrics
+from . import settings
+from . import util
+
+cache = util.TTLCache(
+    maxsize=int(settings.HIERARCHY_CACHE_SIZE),
+    ttl=float(settings.HIERARCHY_CACHE_TTL),
+)
+
+metrics.register_cache('hierarchy', lambda: (cache.hits, cache.misses))
+
+# the amount of active units of each organisation as of the last
+# search, so that we can estimate the cost of loading an index without
+# searching again -- organisations rarely change much in size
+sizes = {}
+
+
+class Hierarchy:
+    '''The active units of an organisation, along with their parents
+    and names.
+
+    .. doctest::
+
+      >>> h = Hierarchy('org', [
+      ...   ('a', 'org', 'A'),
+      ...   ('b', 'a', 'B'),
+      ...   ('c', 'b', 'C'),
+      ...   ('d', 'a', 'D'),
+      ... ])
+      >>> h.get_ancestors('c')
+      ['b', 'a']
+      >>> h.get_location('c')
+      'A/B'
+      >>> h.get_depth('a'), h.get_depth('c')
+      (0, 2)
+      >>> h.get_children('a')
+      ['b', 'd']
+      >>> list(h.get_descendants('a'))
+      ['b', 'd', 'c']
+
+    '''
+
+    def __init__(self, orgid: str,
+                 units: typing.Iterable[typing.Tuple[str, str, str]]):
+        self.orgid = str(orgid)
+
+        self.__parents = {}
+        self.__names = {}
+        self.__children = collections.defaultdict(list)
+
+        for unitid, parentid, name in units:
+            self.__parents[unitid] = parentid
+            self.__names[unitid] = name
+            self.__children[parentid].append(unitid)
+
+    def __contains__(self, unitid):
+        return str(unitid) in self.__parents
+
+    def __len__(self):
+        return len(self.__parents)
+
+    def get_name(self, unitid) -> typing.Optional[str]:
+        return self.__names.get(str(unitid))
+
+    def get_parent(self, unitid) -> typing.Optional[str]:
+        '''The UUID of the parent of the given unit, which is the
+        organisation itself for root units.'''
+        return self.__parents.get(str(unitid))
+
+    def get_children(self, unitid) -> typing.List[str]:
+        return list(self.__children.get(str(unitid), ()))
+
+    def get_child_count(self, unitid) -> int:
+        return len(self.__children.get(str(unitid), ()))
+
+    def get_ancestors(self, unitid) -> typing.List[str]:
+        '''The active units above the given unit, nearest first.
+
+        We stop at the first parent that isn't an active unit of this
+        organisation -- normally, that's the organisation itself.
+
+        '''
+        unitid = str(unitid)
+        ancestors = []
+        seen = {unitid}
+
+        parentid = self.__parents.get(unitid)
+
+        while parentid in self.__parents and parentid not in seen:
+            ancestors.append(parentid)
+            seen.add(parentid)
+
+            parentid = self.__parents[parentid]
+
+        return ancestors
+
+    def get_depth(self, unitid) -> int:
+        return len(self.get_ancestors(unitid))
+
+    def get_descendants(self, unitid) -> typing.Iterator[str]:
+        '''The active units beneath the given unit, breadth first.'''
+        seen = {str(unitid)}
+        pending = collections.deque(self.get_children(unitid))
+
+        while pending:
+            childid = pending.popleft()
+
+            if childid not in seen:
+                seen.add(childid)
+                pending.extend(self.__children.get(childid, ()))
+
+                yield childid
+
+    def get_location(self, unitid) -> str:
+        '''The names of the ancestors of the given unit, separated by
+        slashes and starting with the root.'''
+        return '/'.join(
+            self.__names[ancestorid]
+            for ancestorid in reversed(self.get_ancestors(unitid))
+        )
+
+
+def search(c, orgid) -> typing.List[str]:
+    '''Search for the UUIDs of the active units of the given
+    organisation using the given connector, noting their amount.'''
+    unitids = c.organisationenhed(tilhoerer=orgid, gyldighed='Aktiv')
+
+    sizes[str(orgid)] = len(unitids)
+
+    return unitids
+
+
+def build(c, orgid, unitids=None) -> Hierarchy:
+    '''Load the index of the given organisation using the given
+    connector.
+
+    :param unitids: The UUIDs of the active units of the
+                    organisation, if already known.
+
+    '''
+    if unitids is None:
+        unitids = search(c, orgid)
+
+    def get_unit(unitid, unit):
+        parents = unit['relationer'].get('overordnet') or [{}]
+        attrs = unit['attributter']['organisationenhedegenskaber'][0]
+
+        return unitid, parents[0].get('uuid'), attrs['enhedsnavn']
+
+    return Hierarchy(orgid, (
+        get_unit(unitid, unit)
+        for unitid, unit in c.organisationenhed.get_all(uuid=unitids)
+    ))
+
+
+def get(c, orgid) -> typing.Optional[Hierarchy]:
+    '''Obtain the index of the given organisation on the day of the
+    given connector, loading it if needed.
+
+    :return: The index, or ``None`` if it is disabled or the
+             connector covers more than a single moment.
+
+    '''
+    if (
+        cache.ttl <= 0 or cache.maxsize <= 0 or
+        c.validity != 'present' or
+        c.end - c.start != util.MINIMAL_INTERVAL
+    ):
+        return None
+
+    key = (str(orgid), c.start.date())
+
+    h = cache.get(key)
+
+    if h is None:
+        h = build(c, orgid)
+        cache[key] = h
+
+    return h
+
+
+def invalidate():
+    '''Discard all indices, following changes to a unit.'''
+    for key in cache:
+        cache.pop(key)
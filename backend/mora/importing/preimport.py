@@ -13,7 +13,7 @@ import click
 from . import spreadsheets
 
 
-def run(output, sheets, compact, exact, **kwargs):
+def run(output, sheets, compact, exact, wash_jobs=None, **kwargs):
     '''Convert an Excel spreadsheet into JSON for faster importing
 
     '''
@@ -27,7 +27,7 @@ def run(output, sheets, compact, exact, **kwargs):
             'unsupported arguments: {}'.format(', '.join(unsupported_args)),
         )
 
-    d = spreadsheets.load_data(sheets, exact=exact)
+    d = spreadsheets.load_data(sheets, exact=exact, wash_jobs=wash_jobs)
 
     if compact:
         json.dump(d, output)
@@ -6,9 +6,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import collections
 import re
+import typing
 
 from .. import lora
+from .. import settings
 from .. import util
 
 
@@ -83,3 +86,26 @@ def wash_address(addrstring, postalcode, postaldistrict):
                 return v
 
     return None
+
+
+def wash_addresses(addresses: typing.Iterable[tuple],
+                   jobs: int = None) -> dict:
+    '''Wash the given addresses in parallel, each given as a tuple of
+    the arguments to :py:func:`wash_address`.
+
+    :param jobs: The amount of addresses to wash at once, defaulting to
+                 :py:data:`mora.settings.DAWA_CONCURRENCY`.
+    :return: A dictionary mapping each address to its UUID, or
+             :py:data:`None` if not found.
+
+    '''
+    addresses = list(collections.OrderedDict.fromkeys(addresses))
+
+    return dict(zip(
+        addresses,
+        lora.map_concurrently(
+            lambda args: wash_address(*args),
+            addresses,
+            settings.DAWA_CONCURRENCY if jobs is None else jobs,
+        ),
+    ))
@@ -153,7 +153,7 @@ def read_paths(paths):
             yield from book
 
 
-def load_data(sheets, exact=False):
+def load_data(sheets, exact=False, wash_jobs=None):
     # use an ordered dictionary to ensure consistent walk order if the types
     dest = collections.OrderedDict()
 
@@ -247,9 +247,33 @@ def load_data(sheets, exact=False):
                          '59141156-ed0b-457c-9535-884447c5220b')
     )
 
+    def get_address(obj):
+        address = obj.get('adresse')
+        postalcode = obj.get('postnummer')
+        postaldistrict = obj.get('postdistrikt')
+
+        if (
+            not exact and not util.is_uuid(address) and
+            address and postalcode and postaldistrict
+        ):
+            return address, postalcode, postaldistrict
+
+    # washing an address takes several lookups in DAWA, so wash each
+    # distinct address once, and many at a time
+    washed = processors.wash_addresses(
+        (
+            get_address(obj)
+            for obj in itertools.chain.from_iterable(dest.values())
+            if get_address(obj)
+        ),
+        wash_jobs,
+    )
+
     for i, obj in enumerate(itertools.chain.from_iterable(dest.values())):
-        postaldistrict = obj.pop('postdistrikt', None)
-        postalcode = obj.pop('postnummer', None)
+        address_key = get_address(obj)
+
+        obj.pop('postdistrikt', None)
+        obj.pop('postnummer', None)
         address = obj.pop('adresse', None)
 
         if exact or util.is_uuid(address):
@@ -257,10 +281,8 @@ def load_data(sheets, exact=False):
             obj['adresse'] = address
             obj['adresse_type'] = obj.get('adresse_type')
 
-        elif address and postalcode and postaldistrict:
-
-            obj['adresse'] = processors.wash_address(address, postalcode,
-                                                     postaldistrict)
+        elif address_key:
+            obj['adresse'] = washed[address_key]
             obj['adresse_type'] = obj.get('adresse_type')
 
         else:
@@ -327,9 +349,9 @@ def load_data(sheets, exact=False):
     return dest
 
 
-def convert(paths, include=None, exact=False):
+def convert(paths, include=None, exact=False, wash_jobs=None):
     print('loading input...', file=sys.stderr)
-    sheets = load_data(paths, exact=exact)
+    sheets = load_data(paths, exact=exact, wash_jobs=wash_jobs)
 
     for title, sheet in sheets.items():
         try:
@@ -750,7 +772,7 @@ def convert_organisationfunktion(obj):
 
 
 def run(target, sheets, dry_run, verbose, jobs, failfast,
-        include, check, exact, **kwargs):
+        include, check, exact, wash_jobs=None, **kwargs):
 
     if any(kwargs.values()):
         unsupported_args = [k for k in sorted(kwargs) if kwargs[k]]
@@ -761,7 +783,8 @@ def run(target, sheets, dry_run, verbose, jobs, failfast,
 
     start = util.now()
 
-    sheetlines = convert(sheets, include=include, exact=exact)
+    sheetlines = convert(sheets, include=include, exact=exact,
+                         wash_jobs=wash_jobs)
 
     if dry_run:
         for method, path, obj in sheetlines:
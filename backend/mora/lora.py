@@ -9,14 +9,20 @@
 from __future__ import generator_stop
 
 import collections
+import concurrent.futures
 import functools
 import itertools
+import threading
+import time
+import typing
 import uuid
 
+import flask
 import requests
 
 from .auth import base
 from . import exceptions
+from . import metrics
 from . import settings
 from . import util
 
@@ -144,6 +150,33 @@ ALL_RELATION_NAMES = {
 }
 
 
+# these rarely change, so we cache them across requests -- writes
+# through this module invalidate them, but changes made elsewhere
+# only show up once the entry expires
+SHARED_SCOPES = frozenset({
+    'klassifikation/facet',
+    'klassifikation/klasse',
+    'organisation/organisation',
+})
+
+classification_cache = util.TTLCache(
+    maxsize=int(settings.CLASSIFICATION_CACHE_SIZE),
+    ttl=float(settings.CLASSIFICATION_CACHE_TTL),
+)
+
+# the identity maps live only for a request, so we tally them up here
+identity_map_stats = metrics.CacheStats()
+
+metrics.register_cache(
+    'classification',
+    lambda: (classification_cache.hits, classification_cache.misses),
+)
+metrics.register_cache(
+    'identity_map',
+    lambda: (identity_map_stats.hits, identity_map_stats.misses),
+)
+
+
 def _check_response(r):
     if not r.ok:
         try:
@@ -173,6 +206,145 @@ def _check_response(r):
     return r
 
 
+def _get_request_state(name, factory):
+    '''Obtain the given state for the current request, or a throwaway
+    instance when running outside of one.
+
+    '''
+    if flask.has_request_context():
+        return flask.g.setdefault(name, factory())
+    else:
+        return factory()
+
+
+Call = collections.namedtuple('Call', (
+    'method',
+    'path',
+    'status',
+    'size',
+    'duration',
+    'decode_duration',
+))
+Call.__doc__ = '''A request made to LoRA; durations are in seconds.'''
+
+
+def _request(calls, method, path, url, *, decode=True, **kwargs):
+    '''Issue a request to LoRA, and record it in the given list of
+    calls. Returns the decoded JSON response, if desired.
+
+    '''
+    start = time.perf_counter()
+    r = session.request(method, url, **kwargs)
+    duration = time.perf_counter() - start
+    decode_duration = 0.0
+
+    try:
+        _check_response(r)
+
+        if decode:
+            start = time.perf_counter()
+            data = r.json()
+            decode_duration = time.perf_counter() - start
+        else:
+            data = None
+
+        return data
+
+    finally:
+        calls.append(Call(method, path, r.status_code, len(r.content),
+                          duration, decode_duration))
+        metrics.LORA_DURATION.observe(duration, path=path, method=method)
+
+
+def map_concurrently(func, iterable, concurrency=None):
+    '''Equivalent to :py:func:`map`, but with up to ``concurrency``
+    invocations running in parallel, defaulting to
+    :py:data:`mora.settings.LORA_CONCURRENCY`. The results retain the
+    order of the input.
+
+    The invocations run within the current request, if any, so that
+    they act on behalf of the same user.
+
+    '''
+    args = list(iterable)
+    workers = min(
+        int(settings.LORA_CONCURRENCY if concurrency is None
+            else concurrency),
+        len(args),
+    )
+
+    if workers <= 1:
+        yield from map(func, args)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        yield from executor.map(util.copy_current_context(func), args)
+
+
+def _filter_registration(reg, start, end):
+    '''Filter the given registration to the effects overlapping the
+    given interval, similar to what LoRA does for ``virkningfra`` and
+    ``virkningtil``.
+
+    '''
+    r = dict(reg)
+
+    for group in ('attributter', 'relationer', 'tilstande'):
+        if group not in reg:
+            continue
+
+        r[group] = {}
+
+        for key, entries in reg[group].items():
+            entries = [
+                entry
+                for entry in entries
+                if util.do_ranges_overlap(
+                    start, end,
+                    util.parsedatetime(entry['virkning']['from']),
+                    util.parsedatetime(entry['virkning']['to']),
+                )
+            ]
+
+            if entries:
+                r[group][key] = entries
+
+    return r
+
+
+def _sweep_intervals(intervals, chunks):
+    '''For each of the given chunks, yield the indices of the
+    intervals overlapping it, in their original order.
+
+    As the chunks are sorted and don't overlap, we can sweep across
+    them, rather than comparing each interval to each chunk.
+
+    .. doctest::
+
+      >>> [
+      ...   list(indices)
+      ...   for indices in _sweep_intervals(
+      ...     [(2, 4), (0, 3), (5, 6)],
+      ...     [(0, 2), (2, 3), (3, 4), (4, 5), (5, 6)],
+      ...   )
+      ... ]
+      [[1], [0, 1], [0], [], [2]]
+
+    '''
+    pending = sorted(range(len(intervals)), key=lambda i: intervals[i][0])
+    pending.reverse()
+
+    active = set()
+
+    for start, end in chunks:
+        while pending and intervals[pending[-1]][0] < end:
+            active.add(pending.pop())
+
+        active = {i for i in active if intervals[i][1] > start}
+
+        yield sorted(active)
+
+
 def get(path, uuid, **params):
 
     d = fetch(path, uuid=str(uuid), **params)
@@ -193,36 +365,114 @@ def get(path, uuid, **params):
 
 
 def fetch(path, **params):
-    r = session.get(settings.LORA_URL + path, params=params)
-    _check_response(r)
+    d = _request(_get_request_state('lora_calls', list),
+                 'GET', path, settings.LORA_URL + path, params=params)
 
     try:
-        return r.json()['results'][0]
+        return d['results'][0]
     except IndexError:
         return []
 
 
 def create(path, obj, uuid=None):
+    calls = _get_request_state('lora_calls', list)
+
     if uuid:
-        r = session.put('{}{}/{}'.format(settings.LORA_URL, path, uuid),
-                        json=obj)
-        _check_response(r)
-        return uuid
+        _request(calls, 'PUT', path,
+                 '{}{}/{}'.format(settings.LORA_URL, path, uuid),
+                 json=obj, decode=False)
     else:
-        r = session.post(settings.LORA_URL + path, json=obj)
-        _check_response(r)
-        return r.json()['uuid']
+        uuid = _request(calls, 'POST', path, settings.LORA_URL + path,
+                        json=obj)['uuid']
+
+    _forget(path, uuid)
+
+    return uuid
 
 
 def delete(path, uuid):
-    r = session.delete('{}{}/{}'.format(settings.LORA_URL, path, uuid))
-    _check_response(r)
+    _request(_get_request_state('lora_calls', list),
+             'DELETE', path, '{}{}/{}'.format(settings.LORA_URL, path, uuid),
+             decode=False)
+
+    _forget(path, uuid)
 
 
 def update(path, obj):
-    r = session.put(settings.LORA_URL + path, json=obj)
-    _check_response(r)
-    return r.json()['uuid']
+    objid = _request(_get_request_state('lora_calls', list),
+                     'PUT', path, settings.LORA_URL + path, json=obj)['uuid']
+
+    _forget(path, objid)
+
+    return objid
+
+
+def _forget(path, uuid):
+    '''Drop the given object from the process-wide cache and the
+    objects prefetched for the current request.'''
+    classification_cache.pop((path, str(uuid)))
+    _get_request_state('lora_prefetched', dict).pop((path, str(uuid)), None)
+
+
+def prefetch(objects: typing.Mapping[str, typing.Iterable[str]]):
+    '''Load the full history of the given objects in bulk, so that
+    any connector created during the current request looks them up in
+    memory rather than asking LoRA.
+
+    :param objects: A mapping of scopes, i.e. the attributes of
+                    :py:class:`Connector` such as ``organisationenhed``,
+                    to the UUIDs of objects to load. Objects not found
+                    are remembered as such.
+
+    Outside of a request, this does nothing.
+
+    '''
+    if not flask.has_request_context():
+        return
+
+    c = Connector(virkningfra='-infinity', virkningtil='infinity')
+
+    missing = {
+        name: [
+            objid
+            for objid in util.uniqueify(map(str, uuids))
+            if (getattr(c, name).path, objid) not in c.prefetched
+        ]
+        for name, uuids in objects.items()
+    }
+
+    def load(name):
+        return list(getattr(c, name).get_all(uuid=missing[name]))
+
+    names = [name for name in missing if missing[name]]
+
+    for name, results in zip(names, map_concurrently(load, names)):
+        path = getattr(c, name).path
+
+        c.prefetched.update(
+            ((path, objid), None) for objid in missing[name]
+        )
+        c.prefetched.update(
+            ((path, objid), reg) for objid, reg in results
+        )
+
+
+def reset_request_state():
+    '''Discard the state kept for the current request, i.e. the
+    objects prefetched and the calls made, e.g. between the batches of
+    a request streaming its response.
+
+    '''
+    if not flask.has_request_context():
+        return
+
+    counters = flask.g.pop('lora_counters', None)
+
+    if counters:
+        identity_map_stats.add(counters['hits'], counters['misses'])
+
+    flask.g.pop('lora_calls', None)
+    flask.g.pop('lora_prefetched', None)
 
 
 class Connector:
@@ -282,10 +532,65 @@ class Connector:
 
         self.__defaults = defaults
 
+        # registrations loaded through this connector, keyed by scope
+        # path, UUID and parameters -- as we create a connector for
+        # each request, this avoids fetching the same object repeatedly
+        self.__registrations = {}
+        self.__lock = threading.Lock()
+        self.__counters = _get_request_state('lora_counters',
+                                             collections.Counter)
+
+        # likewise, record the calls made to LoRA -- note that we
+        # may access these from other threads
+        self.__calls = _get_request_state('lora_calls', list)
+
+        # the full history of objects loaded using prefetch(), shared
+        # by all connectors of the current request
+        self.__prefetched = _get_request_state('lora_prefetched', dict)
+
+        # and bound the amount of parallel requests, even when
+        # concurrent lookups use concurrency themselves
+        self.__semaphore = threading.BoundedSemaphore(
+            max(int(settings.LORA_CONCURRENCY), 1),
+        )
+
     @property
     def defaults(self):
         return self.__defaults
 
+    @property
+    def registrations(self):
+        '''Identity map of the registrations loaded through this
+        connector.'''
+        return self.__registrations
+
+    @property
+    def lock(self):
+        '''Held whilst changing the identity map, as concurrent
+        lookups may add to it from other threads.'''
+        return self.__lock
+
+    @property
+    def counters(self):
+        '''Identity map hits and misses for the current request.'''
+        return self.__counters
+
+    @property
+    def calls(self):
+        '''The LoRA calls made during the current request.'''
+        return self.__calls
+
+    @property
+    def prefetched(self):
+        '''The objects prefetched for the current request, keyed by
+        scope path and UUID.'''
+        return self.__prefetched
+
+    @property
+    def semaphore(self):
+        '''Held whilst reading from LoRA.'''
+        return self.__semaphore
+
     @property
     def validity(self):
         return self.__validity
@@ -334,15 +639,16 @@ class Scope:
         return settings.LORA_URL + self.path
 
     def fetch(self, **params):
-        r = session.get(self.base_path, params={
-            **self.connector.defaults,
-            **params,
-        })
-
-        _check_response(r)
+        with self.connector.semaphore:
+            d = _request(self.connector.calls, 'GET', self.path,
+                         self.base_path,
+                         params={
+                             **self.connector.defaults,
+                             **params,
+                         })
 
         try:
-            return r.json()['results'][0]
+            return d['results'][0]
         except IndexError:
             return []
 
@@ -359,6 +665,59 @@ class Scope:
 
         wantregs = params.keys() & {'registreretfra', 'registrerettil'}
 
+        chunk_size = self.get_chunk_size(**params)
+
+        if wantregs:
+            for d in self._fetch_chunks(uuids, chunk_size):
+                yield d['id'], d['registreringer']
+
+            return
+
+        # serve anything we already loaded from memory
+        missing = []
+
+        for objid in uuids:
+            key = self._registration_key(objid, {})
+
+            if key in self.connector.registrations:
+                self.connector.counters['hits'] += 1
+
+                if self.connector.registrations[key] is not None:
+                    yield objid, self.connector.registrations[key]
+
+            elif self._is_prefetched(objid, {}):
+                self.connector.counters['misses'] += 1
+
+                reg = self._get_prefetched(objid, {})
+
+                with self.connector.lock:
+                    self.connector.registrations[key] = reg
+
+                if reg is not None:
+                    yield objid, reg
+
+            else:
+                self.connector.counters['misses'] += 1
+                missing.append(objid)
+
+        if self._is_shared({}):
+            results = self._get_shared(missing, {}, chunk_size)
+        else:
+            results = (
+                (d['id'], d['registreringer'][0])
+                for d in self._fetch_chunks(missing, chunk_size)
+            )
+
+        for objid, reg in results:
+            with self.connector.lock:
+                self.connector.registrations[
+                    self._registration_key(objid, {})
+                ] = reg
+
+            yield objid, reg
+
+    def get_chunk_size(self, **params):
+        '''Calculate how many objects we can fetch in one request.'''
         # as an optimisation, we want to minimize the amount of
         # roundtrips whilst also avoiding too large requests -- to
         # this, we calculate in advance how many we can request
@@ -372,15 +731,23 @@ class Scope:
 
         per_length = 36 + len('&uuid=')
 
-        for chunk in util.splitlist(uuids, int(available_length / per_length)):
-            for d in self.fetch(uuid=chunk):
-                yield d['id'], (d['registreringer'] if wantregs
-                                else d['registreringer'][0])
+        return int(available_length / per_length)
+
+    def _fetch_chunks(self, uuids, chunk_size, **params):
+        # the chunks are independent of each other, so fetch them
+        # in parallel
+        for results in map_concurrently(
+            lambda chunk: self.fetch(uuid=chunk, **params),
+            util.splitlist(uuids, chunk_size),
+        ):
+            yield from results
 
     def paged_get(self, func, *,
                   start=0, limit=settings.DEFAULT_PAGE_SIZE,
                   **params):
 
+        # search once, and then fetch the requested page by UUID
+        # rather than repeating the search with paging parameters
         uuids = self.fetch(**params)
 
         return {
@@ -389,11 +756,138 @@ class Scope:
             'items': [
                 func(self.connector, obj_id, obj)
                 for obj_id, obj in self.get_all(
-                    start=start, limit=limit, **params)
+                    uuid=uuids[start:start + limit],
+                )
             ],
         }
 
+    def _registration_key(self, uuid, params):
+        return (
+            self.path,
+            str(uuid),
+            tuple(sorted(
+                (k, str(v))
+                for k, v in {**self.connector.defaults, **params}.items()
+            )),
+        )
+
+    def _forget(self, uuid):
+        '''Drop the given object from the identity map and the
+        process-wide cache, e.g. after changing it.'''
+        with self.connector.lock:
+            for key in [
+                key
+                for key in self.connector.registrations
+                if key[:2] == (self.path, str(uuid))
+            ]:
+                del self.connector.registrations[key]
+
+        classification_cache.pop((self.path, str(uuid)))
+        self.connector.prefetched.pop((self.path, str(uuid)), None)
+
+    def _is_shared(self, params):
+        '''Determine whether lookups with the given parameters may use
+        the process-wide cache.'''
+        return (
+            classification_cache.ttl > 0 and
+            self.path in SHARED_SCOPES and
+            {**self.connector.defaults, **params}.keys() <= {
+                'virkningfra', 'virkningtil',
+            }
+        )
+
+    def _is_prefetched(self, uuid, params):
+        '''Determine whether a lookup of the given object with the
+        given parameters may use the prefetched objects.'''
+        return (
+            (self.path, str(uuid)) in self.connector.prefetched and
+            {**self.connector.defaults, **params}.keys() <= {
+                'virkningfra', 'virkningtil',
+            }
+        )
+
+    def _get_prefetched(self, uuid, params):
+        '''Obtain the given prefetched object, as filtered to the
+        effects within the validity of the connector.'''
+        reg = self.connector.prefetched[self.path, str(uuid)]
+
+        if reg is None:
+            return None
+
+        params = {**self.connector.defaults, **params}
+
+        return _filter_registration(
+            reg,
+            util.parsedatetime(params['virkningfra']),
+            util.parsedatetime(params['virkningtil']),
+        )
+
+    def _get_shared(self, uuids, params, chunk_size):
+        '''Yield the registrations of the given objects, as filtered
+        to the effects within the validity of the connector.
+
+        We cache the full history of each object, and filter it
+        ourselves, so that the cache remains usable regardless of the
+        time of the request.
+
+        '''
+        params = {**self.connector.defaults, **params}
+        start = util.parsedatetime(params['virkningfra'])
+        end = util.parsedatetime(params['virkningtil'])
+
+        missing = []
+
+        for objid in uuids:
+            reg = classification_cache.get((self.path, str(objid)))
+
+            if reg is None:
+                missing.append(objid)
+            else:
+                yield objid, _filter_registration(reg, start, end)
+
+        for d in self._fetch_chunks(missing, chunk_size,
+                                    virkningfra='-infinity',
+                                    virkningtil='infinity'):
+            reg = d['registreringer'][0]
+
+            classification_cache[self.path, d['id']] = reg
+
+            yield d['id'], _filter_registration(reg, start, end)
+
     def get(self, uuid, **params):
+        '''Get the registration of the given object.
+
+        Please note that the result is shared with any subsequent
+        lookups of the same object through this connector, so callers
+        should refrain from modifying it.
+
+        '''
+        key = self._registration_key(uuid, params)
+
+        try:
+            reg = self.connector.registrations[key]
+        except KeyError:
+            self.connector.counters['misses'] += 1
+        else:
+            self.connector.counters['hits'] += 1
+            return reg
+
+        if self._is_prefetched(uuid, params):
+            reg = self._get_prefetched(uuid, params)
+        elif self._is_shared(params):
+            reg = next(
+                (reg for objid, reg in self._get_shared([uuid], params, 1)),
+                None,
+            )
+        else:
+            reg = self._get(uuid, **params)
+
+        with self.connector.lock:
+            self.connector.registrations[key] = reg
+
+        return reg
+
+    def _get(self, uuid, **params):
         d = self.fetch(uuid=str(uuid), **params)
 
         if not d or not d[0]:
@@ -412,26 +906,31 @@ class Scope:
 
     def create(self, obj, uuid=None):
         if uuid:
-            r = session.put('{}/{}'.format(self.base_path, uuid),
-                            json=obj)
+            r = _request(self.connector.calls, 'PUT', self.path,
+                         '{}/{}'.format(self.base_path, uuid), json=obj)
         else:
-            r = session.post(self.base_path, json=obj)
+            r = _request(self.connector.calls, 'POST', self.path,
+                         self.base_path, json=obj)
 
-        _check_response(r)
-        return r.json()['uuid']
+        objid = r['uuid']
+
+        self._forget(objid)
+
+        return objid
 
     def delete(self, uuid):
-        r = session.delete('{}/{}'.format(self.base_path, uuid))
-        _check_response(r)
+        _request(self.connector.calls, 'DELETE', self.path,
+                 '{}/{}'.format(self.base_path, uuid), decode=False)
+
+        self._forget(uuid)
 
     def update(self, obj, uuid):
-        r = session.request(
-            'PATCH',
-            '{}/{}'.format(self.base_path, uuid),
-            json=obj,
-        )
-        _check_response(r)
-        return r.json()['uuid']
+        r = _request(self.connector.calls, 'PATCH', self.path,
+                     '{}/{}'.format(self.base_path, uuid), json=obj)
+
+        self._forget(uuid)
+
+        return r['uuid']
 
     def get_effects(self, obj, relevant, also=None, **params):
         reg = (
@@ -443,8 +942,6 @@ class Scope:
         if not reg:
             return
 
-        chunks = set()
-
         everything = collections.defaultdict(tuple)
 
         for group in relevant:
@@ -452,41 +949,51 @@ class Scope:
         for group in also or {}:
             everything[group] += also[group]
 
+        # parse the validity of every entry exactly once
+        intervals = {
+            (group, key): [
+                (
+                    util.parsedatetime(entry['virkning']['from']),
+                    util.parsedatetime(entry['virkning']['to']),
+                )
+                for entry in reg[group][key]
+            ]
+            for group in everything
+            if group in reg
+            for key in everything[group]
+            if key in reg[group]
+        }
+
         # extract all beginning and end timestamps for all effects
+        chunks = set()
+
         for group, keys in relevant.items():
             if group not in reg:
                 continue
 
-            entries = reg[group]
-
             for key in keys:
-                if key not in entries:
-                    continue
-
-                for entry in entries[key]:
-                    chunks.update((
-                        util.parsedatetime(entry['virkning']['from']),
-                        util.parsedatetime(entry['virkning']['to']),
-                    ))
+                if key in reg[group]:
+                    for bounds in intervals[group, key]:
+                        chunks.update(bounds)
 
         # sort them, and apply the filter, if given
-        chunks = self.connector.get_date_chunks(chunks)
+        chunks = list(self.connector.get_date_chunks(chunks))
 
-        def filter_list(entries, start, end):
-            for entry in entries:
-                entry_start = util.parsedatetime(entry['virkning']['from'])
-                entry_end = util.parsedatetime(entry['virkning']['to'])
-
-                if entry_start < end and entry_end > start:
-                    yield entry
+        matches = {
+            k: _sweep_intervals(v, chunks)
+            for k, v in intervals.items()
+        }
 
         # finally, extract chunks corresponding to each cut-off
         for start, end in chunks:
             effect = {
                 group: {
-                    key: list(filter_list(reg[group][key], start, end))
-                    for key in everything[group]
-                    if key in everything[group] and key in reg[group]
+                    key: [
+                        reg[group][key][i]
+                        for i in next(matches[group, key])
+                    ]
+                    for key in dict.fromkeys(everything[group])
+                    if key in reg[group]
                 }
                 for group in everything
                 if group in reg
@@ -496,6 +1003,20 @@ class Scope:
                 yield start, end, effect
 
 
+def warm_up_classification_cache():
+    '''Preload all organisations, along with their facets and
+    classes, into the process-wide cache.'''
+    c = Connector()
+
+    orgids = c.organisation.fetch(bvn='%')
+
+    list(c.organisation.get_all(uuid=orgids))
+
+    for orgid in orgids:
+        for scope in (c.facet, c.klasse):
+            list(scope.get_all(uuid=scope.fetch(ansvarlig=orgid)))
+
+
 organisation = functools.partial(fetch, 'organisation/organisation')
 organisation.get = functools.partial(get, 'organisation/organisation')
 organisation.delete = functools.partial(delete, 'organisation/organisation')
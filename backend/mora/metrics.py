@@ -0,0 +1,289 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+'''Metrics
+-------
+
+This section describes the metrics exposed by MO for monitoring
+purposes. They use the `text exposition format
+<https://prometheus.io/docs/instrumenting/exposition_formats/>`_
+of Prometheus, and are collected in the memory of each process.
+
+'''
+
+import bisect
+import collections
+import threading
+import typing
+import urllib.parse
+
+import flask
+
+blueprint = flask.Blueprint('metrics', __name__, static_url_path='',
+                            url_prefix='/service')
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+_registry = collections.OrderedDict()
+_caches = collections.OrderedDict()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    else:
+        return repr(value)
+
+
+def _format_labels(labels: typing.Iterable[typing.Tuple[str, str]]):
+    labels = list(labels)
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            k,
+            str(v).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'),
+        )
+        for k, v in labels
+    ) + '}'
+
+
+class Metric:
+    '''Base class for metrics, which are registered for exposition
+    upon creation.'''
+
+    type = None
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: typing.Sequence[str] = ()):
+        if name in _registry:
+            raise ValueError('duplicate metric {!r}'.format(name))
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+        _registry[name] = self
+
+    def _key(self, labels):
+        if labels.keys() != set(self.labelnames):
+            raise ValueError('expected labels {}, got {}'.format(
+                ', '.join(self.labelnames), ', '.join(sorted(labels)),
+            ))
+
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        '''Yield ``(suffix, labels, value)`` for each sample.'''
+        raise NotImplementedError
+
+    def expose(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.type)
+
+        for suffix, labels, value in self.samples():
+            yield '{}{}{} {}'.format(self.name, suffix,
+                                     _format_labels(labels),
+                                     _format_value(value))
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0.0
+
+            counts[idx] += 1
+            self._values[key] = counts, total + value
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            )
+
+        for key, (counts, total) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield ('_bucket', labels + [('le', _format_value(bound))],
+                       cumulative)
+
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+REQUEST_DURATION = Histogram(
+    'mora_request_duration_seconds',
+    'Duration of requests to MO, per endpoint.',
+    ('endpoint', 'method', 'status'),
+)
+
+LORA_DURATION = Histogram(
+    'mora_lora_request_duration_seconds',
+    'Duration of requests to LoRA, per scope path.',
+    ('path', 'method'),
+)
+
+DAWA_DURATION = Histogram(
+    'mora_dawa_request_duration_seconds',
+    'Duration of requests to DAWA, per endpoint.',
+    ('endpoint', 'status'),
+)
+
+
+class CacheStats:
+    '''Hits and misses of a cache that doesn't count them itself.'''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+
+    def add(self, hits: int = 0, misses: int = 0):
+        with self.__lock:
+            self.hits += hits
+            self.misses += misses
+
+
+def register_cache(name: str,
+                   get_stats: typing.Callable[[], typing.Tuple[int, int]]):
+    '''Expose the hit ratio of the given cache.
+
+    :param name: The name of the cache, used as a label.
+    :param get_stats: A function returning the amount of hits and
+                      misses so far.
+
+    '''
+    _caches[name] = get_stats
+
+
+def observe_dawa(response, *args, **kwargs):
+    '''Response hook for :py:class:`requests.Session` recording requests
+    made to DAWA.'''
+    DAWA_DURATION.observe(
+        response.elapsed.total_seconds(),
+        endpoint=urllib.parse.urlsplit(response.url).path.strip('/'),
+        status=response.status_code,
+    )
+
+
+def _expose_caches():
+    stats = [(name, get_stats()) for name, get_stats in _caches.items()]
+
+    for name, documentation, get_value in (
+        (
+            'mora_cache_hits_total',
+            'Lookups served by the cache.',
+            lambda hits, misses: hits,
+        ),
+        (
+            'mora_cache_misses_total',
+            'Lookups not served by the cache.',
+            lambda hits, misses: misses,
+        ),
+        (
+            'mora_cache_hit_ratio',
+            'Ratio of lookups served by the cache.',
+            lambda hits, misses: hits / (hits + misses) if hits else 0.0,
+        ),
+    ):
+        yield '# HELP {} {}'.format(name, documentation)
+        yield '# TYPE {} {}'.format(
+            name, 'gauge' if name.endswith('ratio') else 'counter',
+        )
+
+        for cache, (hits, misses) in stats:
+            yield '{}{} {}'.format(
+                name,
+                _format_labels([('cache', cache)]),
+                _format_value(get_value(hits, misses)),
+            )
+
+
+def expose() -> str:
+    '''Render all metrics in the text exposition format.'''
+    lines = [
+        line
+        for metric in _registry.values()
+        for line in metric.expose()
+    ]
+
+    lines.extend(_expose_caches())
+
+    return '\n'.join(lines) + '\n'
+
+
+@blueprint.route('/metrics')
+def get_metrics():
+    '''Obtain metrics about this MO process.
+
+    .. :quickref: Metrics; Get
+
+    The metrics include request counts and latencies for each
+    endpoint, likewise for requests made to LoRA and DAWA, and the
+    hit ratios of our caches.
+
+    :>header Content-Type: ``text/plain; version=0.0.4``
+
+    :status 200: Always.
+
+    **Example Response**:
+
+    .. sourcecode:: none
+
+      # HELP mora_lora_request_duration_seconds Duration of requests \
+to LoRA, per scope path.
+      # TYPE mora_lora_request_duration_seconds histogram
+      mora_lora_request_duration_seconds_bucket{path="organisation/\
+organisation",method="GET",le="0.005"} 0
+      ...
+      mora_lora_request_duration_seconds_sum{path="organisation/\
+organisation",method="GET"} 0.0121
+      mora_lora_request_duration_seconds_count{path="organisation/\
+organisation",method="GET"} 1
+      # HELP mora_cache_hit_ratio Ratio of lookups served by the cache.
+      # TYPE mora_cache_hit_ratio gauge
+      mora_cache_hit_ratio{cache="classification"} 0.75
+
+    '''
+    return flask.Response(expose(),
+                          content_type='text/plain; version=0.0.4')
@@ -13,6 +13,7 @@ from . import detail_reading
 from . import detail_writing
 from . import facet
 from . import itsystem
+from . import jobs
 from . import org
 from . import orgunit
 from . import exports
@@ -25,6 +26,7 @@ blueprints = (
     detail_writing.blueprint,
     facet.blueprint,
     itsystem.blueprint,
+    jobs.blueprint,
     org.blueprint,
     orgunit.blueprint,
     exports.blueprint,
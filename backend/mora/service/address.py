@@ -199,7 +199,10 @@ API
 
 import collections
 import json
+import os
 import re
+import tempfile
+import typing
 
 import flask
 import requests
@@ -209,9 +212,11 @@ from . import facet
 from . import handlers
 from . import orgunit
 from .. import common
+from .. import dar
 from .. import exceptions
 from .. import lora
 from .. import mapping
+from .. import metrics
 from .. import settings
 from .. import util
 
@@ -219,6 +224,36 @@ session = requests.Session()
 session.headers = {
     'User-Agent': 'MORA/0.1',
 }
+session.hooks['response'].append(metrics.observe_dawa)
+
+# the endpoints in which we look up addresses, in order
+DAWA_ENDPOINTS = (
+    'adresser',
+    'adgangsadresser',
+    'historik/adresser',
+    'historik/adgangsadresser',
+)
+
+dawa_cache = util.PersistentCache(
+    settings.DAWA_CACHE_FILE or os.path.join(
+        tempfile.gettempdir(),
+        'mora-dawa-{}.db'.format(os.getuid()),
+    ),
+    settings.DAWA_CACHE_SIZE,
+    settings.DAWA_CACHE_TTL,
+)
+
+metrics.register_cache('dawa', lambda: (dawa_cache.hits, dawa_cache.misses))
+
+autocomplete_cache = util.TTLCache(
+    maxsize=int(settings.AUTOCOMPLETE_CACHE_SIZE),
+    ttl=float(settings.AUTOCOMPLETE_CACHE_TTL),
+)
+
+metrics.register_cache(
+    'autocomplete',
+    lambda: (autocomplete_cache.hits, autocomplete_cache.misses),
+)
 
 URN_PREFIXES = {
     'EMAIL': 'urn:mailto:',
@@ -352,7 +387,168 @@ def get_address_class(c, addrrel, class_cache):
         )
 
 
-def get_one_address(c, addrrel, class_cache=None):
+def _fetch_dawa(addrtype, addrids):
+    try:
+        r = session.get(
+            'https://dawa.aws.dk/' + addrtype,
+            # use a list to work around unordered dicts in Python < 3.6
+            params=[
+                ('id', '|'.join(addrids)),
+                ('noformat', '1'),
+                ('struktur', 'mini'),
+            ],
+        )
+
+        addrobjs = r.json()
+
+    except Exception as exc:
+        # the exception above is overly broad for a) safety and b)
+        # testing -- specifically, the exception raised by
+        # requests_mock does not descend from RequestException :(
+        return None, str(exc)
+
+    if not r.ok:
+        return None, addrobjs
+
+    return addrobjs, None
+
+
+def _fetch_many_dawa(chunks):
+    return lora.map_concurrently(lambda args: _fetch_dawa(*args), chunks,
+                                 settings.DAWA_CONCURRENCY)
+
+
+def fetch_addresses(addrids: typing.Iterable[str]) -> dict:
+    '''Look up the given DAR addresses in DAWA.
+
+    Addresses present in the local replica of DAR, if any, are taken
+    from there. Otherwise, each address is looked up in each of
+    :py:data:`DAWA_ENDPOINTS` in turn, starting with the one it was
+    found in previously. Rather
+    than doing so one by one, we ask for many addresses in each
+    request, and perform several requests in parallel. Should a request
+    fail, we retry its addresses one by one.
+
+    :return: A dictionary mapping each ID to an entry containing the
+             ``endpoint`` and ``address`` found, no ``endpoint`` if
+             not found, or an ``error`` if the lookup failed.
+
+    '''
+    addrids = set(addrids)
+    replica = dar.get_replica()
+
+    entries = replica.get(addrids) if replica and addrids else {}
+    pending = {}
+
+    for addrid in addrids - entries.keys():
+        entry = dawa_cache.get(addrid)
+
+        if entry is not None:
+            entries[addrid] = entry
+            continue
+
+        # start with the endpoint the address was found in last, as
+        # addresses rarely move between them
+        previous = dawa_cache.get(addrid, {}, allow_expired=True)
+
+        pending[addrid] = sorted(
+            DAWA_ENDPOINTS,
+            key=lambda addrtype: addrtype != previous.get('endpoint'),
+        )
+
+    while pending:
+        batches = collections.defaultdict(list)
+
+        for addrid, endpoints in sorted(pending.items()):
+            batches[endpoints.pop(0)].append(addrid)
+
+        size = max(int(settings.DAWA_BATCH_SIZE), 1)
+        chunks = [
+            (addrtype, ids[i:i + size])
+            for addrtype, ids in batches.items()
+            for i in range(0, len(ids), size)
+        ]
+
+        results = list(zip(chunks, _fetch_many_dawa(chunks)))
+
+        # a batch may fail due to any one of its addresses, so retry
+        # its addresses one by one rather than failing them all
+        retries = [
+            (addrtype, [addrid])
+            for (addrtype, ids), (addrobjs, error) in results
+            if error is not None and len(ids) > 1
+            for addrid in ids
+        ]
+
+        if retries:
+            results = [
+                ((addrtype, ids), (addrobjs, error))
+                for (addrtype, ids), (addrobjs, error) in results
+                if error is None or len(ids) == 1
+            ] + list(zip(retries, _fetch_many_dawa(retries)))
+
+        for (addrtype, ids), (addrobjs, error) in results:
+            # failures are not cached, so that we retry them next time
+            if error is not None:
+                for addrid in ids:
+                    entries[addrid] = {
+                        'error': error,
+                    }
+
+                    del pending[addrid]
+
+                continue
+
+            # historical addresses have an object for each version,
+            # so use the latest
+            for addrobj in addrobjs:
+                if addrobj.get('id') in pending:
+                    entries[addrobj['id']] = {
+                        'endpoint': addrtype,
+                        'address': addrobj,
+                    }
+
+            for addrid in ids:
+                if addrid in entries:
+                    dawa_cache.set(addrid, entries[addrid])
+
+                    del pending[addrid]
+
+                elif not pending[addrid]:
+                    entries[addrid] = {
+                        'endpoint': None,
+                    }
+
+                    dawa_cache.set(addrid, entries[addrid],
+                                   settings.DAWA_CACHE_NEGATIVE_TTL)
+
+                    del pending[addrid]
+
+    return entries
+
+
+def get_many_addresses(c, addrrels, class_cache=None):
+    '''Equivalent to calling :py:func:`get_one_address` for each of
+    the given relations, but looking up the DAR addresses together.'''
+    addrrels = list(addrrels)
+
+    entries = fetch_addresses({
+        addrrel['uuid'] for addrrel in addrrels if 'uuid' in addrrel
+    })
+
+    return [
+        get_one_address(c, addrrel, class_cache, entries)
+        for addrrel in addrrels
+    ]
+
+
+def get_one_address(c, addrrel, class_cache=None, entries=None):
+    '''Convert the given address relation.
+
+    :param entries: DAR addresses as previously obtained from
+                    :py:func:`fetch_addresses`.
+
+    '''
     addrclass = get_address_class(c, addrrel, class_cache)
     scope = util.checked_get(addrclass, 'scope', 'DAR')
 
@@ -373,38 +569,20 @@ def get_one_address(c, addrrel, class_cache=None):
                 mapping.ERROR: errordesc,
             }
 
-        for addrtype in ('adresser', 'adgangsadresser',
-                         'historik/adresser', 'historik/adgangsadresser'):
-            try:
-                r = session.get(
-                    'https://dawa.aws.dk/' + addrtype,
-                    # use a list to work around unordered dicts in Python < 3.6
-                    params=[
-                        ('id', addrrel['uuid']),
-                        ('noformat', '1'),
-                        ('struktur', 'mini'),
-                    ],
-                )
-
-                addrobjs = r.json()
-
-            except Exception as exc:
-                # the exception above is overly broad for a) safety and b)
-                # testing -- specifically, the exception raised by
-                # requests_mock does not descend from RequestException :(
-                return make_error_object(str(exc))
-
-            if not r.ok:
-                return make_error_object(addrobjs)
-
-            if addrobjs:
-                # found, escape loop!
-                break
+        addrid = addrrel['uuid']
 
+        if entries is not None and addrid in entries:
+            entry = entries[addrid]
         else:
+            entry = fetch_addresses([addrid])[addrid]
+
+        if 'error' in entry:
+            return make_error_object(entry['error'])
+
+        elif not entry['endpoint']:
             return make_error_object(NOT_FOUND, NOT_FOUND)
 
-        addrobj = addrobjs.pop()
+        addrobj = entry['address']
 
         return {
             mapping.ADDRESS_TYPE: addrclass,
@@ -417,7 +595,7 @@ def get_one_address(c, addrrel, class_cache=None):
             ),
 
             mapping.NAME: stringify(addrobj),
-            mapping.UUID: addrrel['uuid'],
+            mapping.UUID: addrid,
         }
 
     elif scope in URN_PREFIXES:
@@ -557,12 +735,20 @@ class AddressRequestHandler(handlers.ReadingRequestHandler):
         def convert(effect):
             if not effect.get('relationer'):
                 return
-            for addrrel in effect['relationer'].get('adresser', []):
-                if not c.is_effect_relevant(addrrel['virkning']):
-                    continue
 
+            addrrels = [
+                addrrel
+                for addrrel in effect['relationer'].get('adresser', [])
+                if c.is_effect_relevant(addrrel['virkning'])
+            ]
+
+            entries = fetch_addresses({
+                addrrel['uuid'] for addrrel in addrrels if 'uuid' in addrrel
+            })
+
+            for addrrel in addrrels:
                 try:
-                    addr = get_one_address(c, addrrel, class_cache)
+                    addr = get_one_address(c, addrrel, class_cache, entries)
                 except Exception as e:
                     util.log_exception(
                         'invalid address relation {}'.format(
@@ -656,6 +842,80 @@ def get_scope_and_original(obj_uuid, obj_type):
     return scope, obj
 
 
+def _autocomplete_dawa_endpoint(addrtype, count, code, q):
+    key = 'adgangsadresse' if addrtype == 'adgangsadresser' else 'adresse'
+
+    return [
+        (addr['tekst'], addr[key]['id'])
+        for addr in session.get(
+            'https://dawa.aws.dk/{}/autocomplete'.format(addrtype),
+            # use a list to work around unordered dicts in Python < 3.6
+            params=[
+                ('per_side', count),
+                ('noformat', '1'),
+                ('kommunekode', code),
+                ('q', q),
+            ],
+        ).json()
+    ]
+
+
+def _autocomplete_dawa(code, q):
+    '''Autocomplete the given query using DAWA, yielding a list of
+    access addresses and a list of addresses.
+
+    As users type one letter at a time, we cache the results, and
+    use those of a shorter query if they weren't truncated. Then, the
+    results of this query are those matching every word of it.
+
+    '''
+    access_count = settings.AUTOCOMPLETE_ACCESS_ADDRESS_COUNT
+    addr_count = settings.AUTOCOMPLETE_ADDRESS_COUNT
+
+    query = dar.normalise(q)
+    words = query.split()
+
+    def matches(text):
+        textwords = dar.normalise(text).split()
+
+        return all(
+            any(textword.startswith(word) for textword in textwords)
+            for word in words
+        )
+
+    for i in range(len(query), 0, -1):
+        key = (code, query[:i])
+
+        if key not in autocomplete_cache:
+            continue
+
+        access_addrs, addrs = autocomplete_cache.get(key, ([], []))
+
+        if i == len(query):
+            return access_addrs, addrs
+
+        elif len(access_addrs) < access_count and len(addrs) < addr_count:
+            return (
+                [v for v in access_addrs if matches(v[0])],
+                [v for v in addrs if matches(v[0])],
+            )
+
+    # the two lookups are independent, so perform them in parallel
+    access_addrs, addrs = lora.map_concurrently(
+        lambda args: _autocomplete_dawa_endpoint(*args, code=code, q=q),
+        [
+            ('adgangsadresser', access_count),
+            ('adresser', addr_count),
+        ],
+        settings.DAWA_CONCURRENCY,
+    )
+
+    if query:
+        autocomplete_cache[code, query] = access_addrs, addrs
+
+    return access_addrs, addrs
+
+
 @blueprint.route('/o/<uuid:orgid>/address_autocomplete/')
 @util.restrictargs('global', required=['q'])
 def address_autocomplete(orgid):
@@ -727,39 +987,36 @@ def address_autocomplete(orgid):
     # comparison, ten addresses seems apt since they may refer to
     # apartments etc.
     #
+    # If we have a local replica of DAR, we use that unless it lacks
+    # any matches.
+    #
 
-    addrs = collections.OrderedDict(
-        (addr['tekst'], addr['adgangsadresse']['id'])
-        for addr in session.get(
-            'https://dawa.aws.dk/adgangsadresser/autocomplete',
-            # use a list to work around unordered dicts in Python < 3.6
-            params=[
-                ('per_side', settings.AUTOCOMPLETE_ACCESS_ADDRESS_COUNT),
-                ('noformat', '1'),
-                ('kommunekode', code),
-                ('q', q),
-            ],
-        ).json()
-    )
+    replica = dar.get_replica()
 
-    for addr in session.get(
-        'https://dawa.aws.dk/adresser/autocomplete',
-        # use a list to work around unordered dicts in Python < 3.6
-        params=[
-            ('per_side', settings.AUTOCOMPLETE_ADDRESS_COUNT),
-            ('noformat', '1'),
-            ('kommunekode', code),
-            ('q', q),
-        ],
-    ).json():
-        addrs.setdefault(addr['tekst'], addr['adresse']['id'])
+    if replica:
+        access_addrs = replica.autocomplete(
+            'adgangsadresser', q,
+            settings.AUTOCOMPLETE_ACCESS_ADDRESS_COUNT, code,
+        )
+        addrs = replica.autocomplete(
+            'adresser', q,
+            settings.AUTOCOMPLETE_ADDRESS_COUNT, code,
+        )
+
+    if not replica or not access_addrs and not addrs:
+        access_addrs, addrs = _autocomplete_dawa(code, q)
+
+    combined = collections.OrderedDict(access_addrs)
+
+    for text, addrid in addrs:
+        combined.setdefault(text, addrid)
 
     return flask.jsonify([
         {
             "location": {
                 "name": k,
-                "uuid": addrs[k],
+                "uuid": combined[k],
             },
         }
-        for k in addrs
+        for k in combined
     ])
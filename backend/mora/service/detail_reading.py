@@ -24,8 +24,14 @@ creating and editing relations for employees and organisational units:
 
 from __future__ import generator_stop
 
+import base64
+import bisect
 import collections
+import functools
 import itertools
+import json
+import math
+import typing
 
 import flask
 
@@ -37,6 +43,7 @@ from . import itsystem
 from . import orgunit
 from .. import common
 from .. import exceptions
+from .. import lora
 from .. import mapping
 from .. import settings
 from .. import util
@@ -88,12 +95,35 @@ def list_details(type, id):
     }
     scope = getattr(c, info.scope)
 
-    r = {
-        functype: bool(
-            c.organisationfunktion(funktionsnavn=funcname, **search),
-        )
-        for functype, funcname in handlers.FUNCTION_KEYS.items()
-    }
+    # search for all functions at once, and read their names --
+    # unless they're so many that searching for each kind takes
+    # fewer requests
+    funcids = c.organisationfunktion(**search)
+    nrequests = math.ceil(len(funcids) /
+                          c.organisationfunktion.get_chunk_size())
+
+    if nrequests <= len(handlers.FUNCTION_KEYS):
+        funcnames = {
+            attrs.get('funktionsnavn')
+            for funcid, func in c.organisationfunktion.get_all(uuid=funcids)
+            for attrs in mapping.ORG_FUNK_EGENSKABER_FIELD(func)
+        }
+
+        r = {
+            functype: funcname in funcnames
+            for functype, funcname in handlers.FUNCTION_KEYS.items()
+        }
+
+    else:
+        r = dict(zip(
+            handlers.FUNCTION_KEYS,
+            lora.map_concurrently(
+                lambda funcname: bool(
+                    c.organisationfunktion(funktionsnavn=funcname, **search),
+                ),
+                handlers.FUNCTION_KEYS.values(),
+            ),
+        ))
 
     reg = scope.get(id)
 
@@ -107,7 +137,7 @@ def list_details(type, id):
 @blueprint.route(
     '/<any("e", "ou"):type>/<uuid:id>/details/<function>',
 )
-@util.restrictargs('at', 'validity', 'start', 'limit')
+@util.restrictargs('at', 'validity', 'start', 'limit', 'paged', 'cursor')
 def get_detail(type, id, function):
     '''Obtain the list of engagements, associations, roles, etc.
     corresponding to a user or organisational unit. See
@@ -138,6 +168,15 @@ def get_detail(type, id, function):
         values.
     :queryparam int start: Index of first item for paging.
     :queryparam int limit: Maximum items.
+    :queryparam boolean paged: Respond with a page, as described below.
+    :queryparam string cursor: Obtain the page following a previous
+        one, using the ``cursor`` it returned.
+
+    Given ``paged`` or ``cursor``, the response is an object rather
+    than a list, in which ``items`` holds the requested page of the
+    list, ``total`` the length of the entire list, ``offset`` the
+    index of the first item, and ``cursor`` a value for obtaining the
+    next page, or ``null`` if this is the last one.
 
     :param type: 'ou' for querying a unit; 'e' for querying an
         employee.
@@ -452,10 +491,26 @@ def get_detail(type, id, function):
             type=function,
         )
 
+    args = flask.request.args
+    paged = util.get_args_flag('paged') or 'cursor' in args
+    sliced = paged or not {'start', 'limit'}.isdisjoint(args)
+
+    if args.get('cursor'):
+        offset, limit = _decode_cursor(args['cursor'])
+    else:
+        try:
+            offset = int(args.get('start', 0))
+            limit = int(args.get('limit', 0)) or settings.DEFAULT_PAGE_SIZE
+        except ValueError:
+            offset = limit = -1
+
+        if offset < 0 or limit < 0:
+            raise exceptions.HTTPException(
+                exceptions.ErrorCodes.E_INVALID_INPUT,
+                'start and limit must be non-negative integers',
+            )
+
     search.update(
-        limit=int(flask.request.args.get('limit', 0)) or
-        settings.DEFAULT_PAGE_SIZE,
-        start=int(flask.request.args.get('start', 0)),
         funktionsnavn=handlers.FUNCTION_KEYS[function],
     )
 
@@ -464,7 +519,7 @@ def get_detail(type, id, function):
 
     def get_address(effect):
         return [
-            address.get_one_address(c, addr, class_cache)
+            address.get_one_address(c, addr, class_cache, address_cache)
             for addr in mapping.ADDRESSES_FIELD(effect)
         ]
 
@@ -492,6 +547,7 @@ def get_detail(type, id, function):
     user_cache = {}
     unit_cache = {}
     itsystem_cache = {}
+    address_cache = {}
 
     # the values are cache, getter, cachegetter, aslist
     #
@@ -592,7 +648,9 @@ def get_detail(type, id, function):
     # first, extract all the effects
     function_effects = [
         (start, end, funcid, effect)
-        for funcid, funcobj in c.organisationfunktion.get_all(**search)
+        for funcid, funcobj in c.organisationfunktion.get_all(
+            uuid=c.organisationfunktion(**search),
+        )
         for start, end, effect in c.organisationfunktion.get_effects(
             funcobj,
             {
@@ -631,6 +689,29 @@ def get_detail(type, id, function):
             else:
                 yield v.get('uuid', None)
 
+    # the details are sorted by their start date, followed by names
+    # we have yet to look up -- so narrow the effects down to those
+    # sharing a start date with the requested page, and only look
+    # those up
+    function_effects.sort(key=lambda v: util.to_iso_date(v[0]))
+
+    total = len(function_effects)
+
+    if sliced:
+        dates = [
+            util.to_iso_date(start)
+            for start, end, funcid, effect in function_effects
+        ]
+        stop = min(offset + limit, total)
+
+        if offset < stop:
+            first = bisect.bisect_left(dates, dates[offset])
+            last = bisect.bisect_right(dates, dates[stop - 1])
+        else:
+            first = last = offset
+
+        function_effects = function_effects[first:last]
+
     # extract all object IDs
     for cache, getter, cachegetter, aslist in converters[function].values():
         if cache is not None:
@@ -638,33 +719,77 @@ def get_detail(type, id, function):
                 for v in as_values((cachegetter or getter)(effect)):
                     cache[v] = None
 
+    if mapping.ADDRESS in converters[function]:
+        address_cache.update(
+            (addr['uuid'], None)
+            for start, end, funcid, effect in function_effects
+            for addr in mapping.ADDRESSES_FIELD(effect)
+            if 'uuid' in addr
+        )
+
     # fetch and convert each object once, rather than multiple times
-    class_cache.update({
-        classid: facet.get_one_class(c, classid, classobj)
-        for classid, classobj in c.klasse.get_all(uuid=class_cache)
-    })
+    #
+    # these lookups are independent of each other, so perform them
+    # in parallel; the connector bounds the amount of requests
+    lookups = [
+        (
+            class_cache,
+            c.klasse,
+            lambda classid, classobj: facet.get_one_class(
+                c, classid, classobj,
+            ),
+        ),
+        (
+            user_cache,
+            c.bruger,
+            lambda userid, user: employee.get_one_employee(c, userid, user),
+        ),
+        (
+            unit_cache,
+            c.organisationenhed,
+            lambda unitid, unit: orgunit.get_one_orgunit(
+                c, unitid, unit, details=orgunit.UnitDetails.MINIMAL,
+            ),
+        ),
+        (
+            itsystem_cache,
+            c.itsystem,
+            lambda systemid, system: itsystem.get_one_itsystem(
+                c, systemid, system,
+            ),
+        ),
+    ]
 
-    user_cache.update({
-        userid: employee.get_one_employee(c, userid, user)
-        for userid, user in
-        c.bruger.get_all(uuid=user_cache)
-    })
+    lookups = [
+        (cache, scope, convert)
+        for cache, scope, convert in lookups
+        if cache
+    ]
 
-    unit_cache.update({
-        unitid: orgunit.get_one_orgunit(
-            c, unitid, unit, details=orgunit.UnitDetails.MINIMAL,
-        )
-        for unitid, unit in
-        c.organisationenhed.get_all(uuid=unit_cache)
-    })
+    def load(cache, scope, convert):
+        return {
+            objid: convert(objid, obj)
+            for objid, obj in scope.get_all(uuid=cache)
+        }
+
+    tasks = [
+        (cache, functools.partial(load, cache, scope, convert))
+        for cache, scope, convert in lookups
+    ]
 
-    itsystem_cache.update({
-        systemid: itsystem.get_one_itsystem(
-            c, systemid, system,
+    # DAWA is separate from LoRA, so look up any addresses alongside
+    if address_cache:
+        tasks.append(
+            (address_cache,
+             functools.partial(address.fetch_addresses, list(address_cache))),
         )
-        for systemid, system in
-        c.itsystem.get_all(uuid=itsystem_cache)
-    })
+
+    for (cache, task), values in zip(
+        tasks,
+        lora.map_concurrently(lambda cache_and_task: cache_and_task[1](),
+                              tasks),
+    ):
+        cache.update(values)
 
     def get_one(effect, cache, getter, cachegetter, aslist):
         values = getter(effect)
@@ -711,7 +836,51 @@ def get_detail(type, id, function):
                                    default=' '),
                 util.get_obj_value(obj, (mapping.ORG_UNIT, mapping.NAME)))
 
-    return flask.jsonify(sorted(
+    items = sorted(
         itertools.starmap(convert, function_effects),
         key=sort_key
-    ))
+    )
+
+    if sliced:
+        items = items[offset - first:offset - first + limit]
+
+    if not paged:
+        return flask.jsonify(items)
+
+    return flask.jsonify({
+        'total': total,
+        'offset': offset,
+        'items': items,
+        'cursor': (
+            _encode_cursor(offset + limit, limit)
+            if offset + limit < total
+            else None
+        ),
+    })
+
+
+def _encode_cursor(offset: int, limit: int) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([offset, limit]).encode(),
+    ).decode()
+
+
+def _decode_cursor(cursor: str) -> typing.Tuple[int, int]:
+    try:
+        offset, limit = json.loads(
+            base64.urlsafe_b64decode(cursor).decode(),
+        )
+
+        if (
+            isinstance(offset, int) and isinstance(limit, int) and
+            offset >= 0 and limit > 0
+        ):
+            return offset, limit
+
+    except (ValueError, TypeError):
+        pass
+
+    raise exceptions.HTTPException(
+        exceptions.ErrorCodes.E_INVALID_INPUT,
+        'invalid cursor {!r}'.format(cursor),
+    )
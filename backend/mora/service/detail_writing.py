@@ -20,6 +20,8 @@ For more information regarding reading relations, refer to:
 
 '''
 
+import itertools
+import json
 import typing
 
 import flask
@@ -29,21 +31,27 @@ from . import association
 from . import engagement
 from . import handlers
 from . import itsystem
+from . import jobs
 from . import leave
 from . import manager
 from . import orgunit
 from . import role
 from .. import common
 from .. import exceptions
+from .. import lora
+from .. import settings
+from .. import util
 
 blueprint = flask.Blueprint('detail_writing', __name__, static_url_path='',
                             url_prefix='/service')
 
 
-def handle_requests(
+def prepare_requests(
     reqs: typing.List[dict],
     request_type: handlers.RequestType
-):
+) -> typing.Tuple[typing.List[handlers.RequestHandler], bool]:
+    '''Validate the given request or requests and prepare their
+    handlers, returning them and whether we got a single request.'''
     if isinstance(reqs, dict):
         is_single_request = True
         reqs = [reqs]
@@ -55,14 +63,119 @@ def handle_requests(
             request=reqs,
         )
 
-    requests = handlers.generate_requests(reqs, request_type)
+    return handlers.generate_requests(reqs, request_type), is_single_request
+
 
-    uuids = handlers.submit_requests(requests)
+def submit_requests(
+    requests: typing.List[handlers.RequestHandler],
+    is_single_request: bool,
+):
+    uuids = handlers.submit_requests(requests, progress=jobs.set_progress)
     if is_single_request:
         uuids = uuids[0]
     return uuids
 
 
+def _parse_line(line: bytes) -> dict:
+    try:
+        req = json.loads(line.decode('utf-8'))
+    except ValueError as exc:
+        raise exceptions.HTTPException(
+            exceptions.ErrorCodes.E_INVALID_INPUT,
+            message='invalid JSON: {}'.format(exc),
+        )
+
+    if not isinstance(req, dict):
+        raise exceptions.HTTPException(
+            exceptions.ErrorCodes.E_INVALID_INPUT,
+            request=req,
+        )
+
+    return req
+
+
+def handle_bulk_requests(
+    lines: typing.Iterable[bytes],
+    request_type: handlers.RequestType,
+) -> typing.Iterator[dict]:
+    '''Process the given lines of newline-delimited JSON requests,
+    yielding the result of each line.
+
+    We process :py:data:`mora.settings.BULK_BATCH_SIZE` lines at a
+    time, and a failing request merely fails its own line.
+
+    '''
+    lines = (
+        (lineno, line)
+        for lineno, line in enumerate(lines, 1)
+        if line.strip()
+    )
+
+    while True:
+        batch = list(itertools.islice(lines, int(settings.BULK_BATCH_SIZE)))
+
+        if not batch:
+            break
+
+        results = {}
+        reqs = []
+
+        for lineno, line in batch:
+            try:
+                reqs.append((lineno, _parse_line(line)))
+            except exceptions.HTTPException as exc:
+                results[lineno] = exc
+
+        try:
+            handlers.prefetch_requests([req for lineno, req in reqs],
+                                       request_type)
+        except Exception:
+            # prefetching is merely an optimisation, so carry on
+            flask.current_app.logger.warning('failed to prefetch requests',
+                                             exc_info=True)
+
+        prepared = []
+
+        for lineno, req in reqs:
+            try:
+                handler = handlers.get_handler_for_role_type(req.get('type'))
+
+                prepared.append((lineno, handler(req, request_type)))
+            except Exception as exc:
+                results[lineno] = exc
+
+        errors = {}
+        uuids = handlers.submit_requests(
+            [request for lineno, request in prepared],
+            errors,
+        )
+
+        for i, (lineno, request) in enumerate(prepared):
+            results[lineno] = errors.get(i, uuids[i])
+
+        for lineno, line in batch:
+            result = results[lineno]
+
+            if isinstance(result, Exception):
+                yield {'line': lineno, **exceptions.get_error_body(result)}
+            else:
+                yield {'line': lineno, 'uuid': result}
+
+        # keep memory usage flat across batches
+        lora.reset_request_state()
+
+
+def _run_bulk_requests(lines: typing.List[bytes],
+                       request_type: handlers.RequestType):
+    results = []
+
+    for entry in handle_bulk_requests(lines, request_type):
+        results.append(entry)
+        jobs.set_progress(entry['line'], len(lines))
+
+    return results
+
+
 @blueprint.route('/details/create', methods=['POST'])
 def create():
     """Creates new relations on employees and units
@@ -70,6 +183,11 @@ def create():
     .. :quickref: Writing; Create relation
 
     :statuscode 200: Creation succeeded.
+    :statuscode 202: The request is valid, and creation will happen in
+        the background.
+
+    :queryparam boolean async: Create in the background, and respond
+        with a job; see :http:get:`/service/jobs/(uuid:jobid)`.
 
     All requests contain validity objects on the following form:
 
@@ -413,12 +531,14 @@ def create():
 
     """
 
-    reqs = flask.request.get_json()
-    return (
-        flask.jsonify(handle_requests(reqs, handlers.RequestType.CREATE)),
-        201
+    requests, is_single_request = prepare_requests(
+        flask.request.get_json(),
+        handlers.RequestType.CREATE,
     )
 
+    return jobs.run('create_details', submit_requests,
+                    requests, is_single_request, status=201)
+
 
 @blueprint.route('/details/edit', methods=['POST'])
 def edit():
@@ -427,6 +547,11 @@ def edit():
     .. :quickref: Writing; Edit relation
 
     :statuscode 200: The edit succeeded.
+    :statuscode 202: The request is valid, and the edit will happen in
+        the background.
+
+    :queryparam boolean async: Edit in the background, and respond
+        with a job; see :http:get:`/service/jobs/(uuid:jobid)`.
 
     All requests contain validity objects on the following form:
 
@@ -913,8 +1038,74 @@ def edit():
       ]
     """
 
-    reqs = flask.request.get_json()
-    return (
-        flask.jsonify(handle_requests(reqs, handlers.RequestType.EDIT)),
-        200
+    requests, is_single_request = prepare_requests(
+        flask.request.get_json(),
+        handlers.RequestType.EDIT,
+    )
+
+    return jobs.run('edit_details', submit_requests,
+                    requests, is_single_request)
+
+
+@blueprint.route('/details/bulk/<any(create,edit):action>',
+                 methods=['POST'])
+def bulk(action):
+    """Creates or edits many relations on employees and units
+
+    .. :quickref: Writing; Create or edit relations in bulk
+
+    :statuscode 200: The requests were processed; note that each of
+        them may have failed.
+    :statuscode 202: The requests will be processed in the background.
+
+    :param action: Either ``create`` or ``edit``.
+
+    :queryparam boolean async: Process the requests in the background,
+        and respond with a job, with the results of each line as its
+        result; see :http:get:`/service/jobs/(uuid:jobid)`.
+
+    The request payload is newline-delimited JSON, with each line
+    containing one request as described in
+    :http:post:`/service/details/create` or
+    :http:post:`/service/details/edit`, respectively. Rather than
+    reading them all at once, we process them in batches, and respond
+    with newline-delimited JSON containing the result of each line,
+    i.e. either the UUID of the object or an error, as soon as each
+    batch completes. Empty lines are ignored.
+
+    **Example Request**:
+
+    .. sourcecode:: none
+
+      {"type": "engagement", "org_unit": {"uuid": "..."}, ...}
+      {"type": "kaflaflibob"}
+
+    **Example Response**:
+
+    .. sourcecode:: none
+
+      {"line": 1, "uuid": "d70ef8c5-63e2-4ce5-8d3b-7e2f8d2e3f0a"}
+      {"line": 2, "error": true, "error_key": "E_UNKNOWN_ROLE_TYPE", \
+"description": "Unknown role type.", "status": 400, "type": "kaflaflibob"}
+
+    """
+    request_type = {
+        'create': handlers.RequestType.CREATE,
+        'edit': handlers.RequestType.EDIT,
+    }[action]
+
+    if util.get_args_flag('async'):
+        # the request is gone once the job runs, so read it now
+        lines = flask.request.get_data().splitlines()
+
+        return jobs.run('bulk_' + action, _run_bulk_requests,
+                        lines, request_type)
+
+    return flask.Response(
+        flask.stream_with_context(
+            json.dumps(entry) + '\n'
+            for entry in handle_bulk_requests(flask.request.stream,
+                                              request_type)
+        ),
+        mimetype='application/x-ndjson',
     )
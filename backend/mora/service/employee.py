@@ -23,6 +23,7 @@ import uuid
 import flask
 
 from . import handlers
+from . import jobs
 from . import org
 from .. import common
 from .. import exceptions
@@ -38,6 +39,7 @@ blueprint = flask.Blueprint('employee', __name__, static_url_path='',
 class EmployeeRequestHandler(handlers.RequestHandler):
     __slots__ = ('details_requests',)
     role_type = "employee"
+    lora_scope = 'bruger'
 
     def prepare_create(self, req):
         c = lora.Connector()
@@ -160,18 +162,17 @@ class EmployeeRequestHandler(handlers.RequestHandler):
         self.payload = payload
         self.uuid = userid
 
+    @property
+    def subrequests(self):
+        return getattr(self, "details_requests", [])
+
     def submit(self):
         c = lora.Connector()
 
         if self.request_type == handlers.RequestType.CREATE:
-            result = c.bruger.create(self.payload, self.uuid)
+            return c.bruger.create(self.payload, self.uuid)
         else:
-            result = c.bruger.update(self.payload, self.uuid)
-
-        # process subrequests, if any
-        [r.submit() for r in getattr(self, "details_requests", [])]
-
-        return result
+            return c.bruger.update(self.payload, self.uuid)
 
 
 def get_one_employee(c, userid, user=None, full=False):
@@ -334,9 +335,15 @@ def terminate_employee(employee_uuid):
     .. :quickref: Employee; Terminate
 
     :statuscode 200: The termination succeeded.
+    :statuscode 202: The employee may be terminated, and that will happen
+        in the background.
+    :statuscode 404: No such employee found.
 
     :param employee_uuid: The UUID of the employee to be terminated.
 
+    :queryparam boolean async: Terminate in the background, and respond
+        with a job; see :http:get:`/service/jobs/(uuid:jobid)`.
+
     :<json string to: When the termination should occur, as an ISO 8601 date.
 
     **Example Request**:
@@ -351,9 +358,17 @@ def terminate_employee(employee_uuid):
 
     """
     date = util.get_valid_to(flask.request.get_json())
-
     c = lora.Connector(virkningfra=date, virkningtil='infinity')
 
+    employee = c.bruger.get(employee_uuid)
+
+    if not employee:
+        raise exceptions.HTTPException(
+            exceptions.ErrorCodes.E_NOT_FOUND,
+            path=c.bruger.path,
+            uuid=employee_uuid,
+        )
+
     request_handlers = [
         handlers.get_handler_for_function(obj)(
             {
@@ -369,14 +384,21 @@ def terminate_employee(employee_uuid):
         )
     ]
 
-    for handler in request_handlers:
-        handler.submit()
+    return jobs.run('terminate_employee', _terminate_employee,
+                    employee_uuid, date, employee, request_handlers)
+
+
+def _terminate_employee(employee_uuid, date, employee, request_handlers):
+    c = lora.Connector(virkningfra=date, virkningtil='infinity')
+
+    handlers.submit_requests(request_handlers, progress=jobs.set_progress)
 
     # Write a noop entry to the user, to be used for the history
-    common.add_history_entry(c.bruger, employee_uuid, "Afslut medarbejder")
+    common.add_history_entry(c.bruger, employee_uuid, "Afslut medarbejder",
+                             employee)
 
     # TODO:
-    return flask.jsonify(employee_uuid), 200
+    return employee_uuid
 
 
 @blueprint.route('/e/<uuid:employee_uuid>/history/', methods=['GET'])
@@ -497,7 +519,7 @@ def create_employee():
     """
     req = flask.request.get_json()
     request = EmployeeRequestHandler(req, handlers.RequestType.CREATE)
-    return flask.jsonify(request.submit()), 201
+    return flask.jsonify(handlers.submit_requests([request])[0]), 201
 
 
 def _inject_persons(details, employee_uuid, valid_from, valid_to):
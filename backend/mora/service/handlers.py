@@ -12,6 +12,8 @@ handlers for the various detail types.
 '''
 
 import abc
+import collections
+import concurrent.futures
 import enum
 import inspect
 import typing
@@ -20,6 +22,7 @@ from .. import common
 from .. import exceptions
 from .. import lora
 from .. import mapping
+from .. import settings
 from .. import util
 
 
@@ -67,6 +70,13 @@ class RequestHandler(metaclass=_RequestHandlerMeta):
     The `role_type` for corresponding details to this attribute.
     '''
 
+    lora_scope = None
+    '''
+    The LoRA scope of the objects edited by this handler, i.e. an
+    attribute of :py:class:`mora.lora.Connector`, if they're referred to
+    by the ``uuid`` of edit requests.
+    '''
+
     @classmethod
     def _register(cls):
         assert cls.role_type is not None
@@ -126,6 +136,14 @@ class RequestHandler(metaclass=_RequestHandlerMeta):
         """
         raise NotImplementedError
 
+    @property
+    def subrequests(self) -> typing.List['RequestHandler']:
+        """Further requests to submit once this request succeeds, such
+        as the details of a new employee.
+
+        """
+        return []
+
     @abc.abstractmethod
     def submit(self) -> str:
         """Submit the request to LoRa.
@@ -162,6 +180,8 @@ class OrgFunkRequestHandler(RequestHandler):
     ``funktionsnavn``.
     '''
 
+    lora_scope = 'organisationfunktion'
+
     termination_field = mapping.ORG_FUNK_GYLDIGHED_FIELD
     '''The relation to change when terminating an employee tied to to an
     ``organisationsfunktion`` objects tied for `organisationsfunktion`
@@ -239,10 +259,85 @@ def get_handler_for_role_type(role_type: str):
         )
 
 
+# the scopes of objects referenced by the various keys of a request;
+# anything else referenced by UUID is a class, whereas addresses
+# typically live in DAR, so we don't prefetch those, and we handle
+# nested requests separately
+REFERENCE_SCOPES = {
+    'original': None,
+    'data': None,
+    'details': None,
+    mapping.ORG: 'organisation',
+    mapping.ORG_UNIT: 'organisationenhed',
+    mapping.PARENT: 'organisationenhed',
+    mapping.PERSON: 'bruger',
+    mapping.ITSYSTEM: 'itsystem',
+    mapping.ADDRESS: None,
+    mapping.ADDRESSES: None,
+}
+
+
+def _collect_references(requests: typing.List[dict],
+                        request_type: RequestType, objects: dict,
+                        nested=True):
+    '''Collect the UUIDs of the objects referenced by the given
+    requests, keyed by their scope, optionally including those of any
+    nested requests.'''
+
+    def add(scope, value):
+        if (
+            isinstance(value, dict) and
+            util.is_uuid(value.get(mapping.UUID)) and
+            not value.get('allow_nonexistent')
+        ):
+            objects[scope].add(value[mapping.UUID])
+
+    for req in requests:
+        if not isinstance(req, dict):
+            continue
+
+        handler = HANDLERS_BY_ROLE_TYPE.get(req.get('type'))
+
+        if request_type == RequestType.EDIT and handler and handler.lora_scope:
+            add(handler.lora_scope, req)
+
+        for obj in (req, req.get('original'), req.get('data')):
+            if not isinstance(obj, dict):
+                continue
+
+            for key, value in obj.items():
+                scope = REFERENCE_SCOPES.get(key, 'klasse')
+
+                if not scope:
+                    continue
+
+                for item in value if isinstance(value, list) else [value]:
+                    add(scope, item)
+
+        if nested and isinstance(req.get('details'), list):
+            _collect_references(req['details'], RequestType.CREATE, objects)
+
+
+def prefetch_requests(requests: typing.List[dict],
+                      request_type: RequestType):
+    '''Load the units, employees and classes referred to by the given
+    requests in bulk, so that the handlers share them rather than
+    looking up each of them separately.
+
+    '''
+    if request_type in (RequestType.CREATE, RequestType.EDIT):
+        objects = collections.defaultdict(set)
+
+        _collect_references(requests, request_type, objects)
+
+        lora.prefetch(objects)
+
+
 def generate_requests(
     requests: typing.List[dict],
     request_type: RequestType
 ) -> typing.List[RequestHandler]:
+    '''Validate the given requests and prepare their handlers.'''
     operations = {req.get('type') for req in requests}
 
     if not operations.issubset(HANDLERS_BY_ROLE_TYPE):
@@ -251,11 +346,188 @@ def generate_requests(
             types=sorted(operations - HANDLERS_BY_ROLE_TYPE.keys()),
         )
 
+    prefetch_requests(requests, request_type)
+
     return [
         HANDLERS_BY_ROLE_TYPE[req.get('type')](req, request_type)
         for req in requests
     ]
 
 
-def submit_requests(requests: typing.List[RequestHandler]) -> typing.List[str]:
-    return [request.submit() for request in requests]
+def _get_dependencies(
+    requests: typing.List[RequestHandler],
+    parents: typing.List[typing.Optional[int]],
+) -> typing.List[typing.Set[int]]:
+    '''Determine the earlier requests each request must wait for.
+
+    A request depends on its parent, e.g. the details of an employee
+    on the employee, and on any earlier request writing an object it
+    either refers to or writes itself, e.g. a unit on its parent. A
+    request writing an object also waits for those referring to it.
+
+    '''
+    writers = {}
+    readers = collections.defaultdict(list)
+    dependencies = []
+
+    for i, (request, parent) in enumerate(zip(requests, parents)):
+        writes = {request.uuid} if request.uuid else set()
+        reads = set()
+
+        if request.request_type != RequestType.TERMINATE:
+            objects = collections.defaultdict(set)
+
+            _collect_references([request.request], request.request_type,
+                                objects, nested=False)
+
+            reads.update(*objects.values())
+
+        reads -= writes
+
+        deps = {parent} if parent is not None else set()
+
+        deps.update(writers[objid] for objid in reads | writes
+                    if objid in writers)
+
+        for objid in writes:
+            deps.update(readers.pop(objid, ()))
+            writers[objid] = i
+
+        for objid in reads:
+            readers[objid].append(i)
+
+        dependencies.append(deps)
+
+    return dependencies
+
+
+def submit_requests(
+    requests: typing.List[RequestHandler],
+    errors: typing.Optional[typing.Dict[int, Exception]]=None,
+    progress: typing.Optional[typing.Callable[[int, int], None]]=None,
+) -> typing.List[typing.Optional[str]]:
+    '''Submit the given requests to LoRA, returning their results.
+
+    By default, we submit the requests serially, in order, and raise
+    the error of the first one failing, so that none of the requests
+    following it have been submitted.
+
+    Alternatively, given a dict of ``errors``, we carry on, and record
+    the error of each failing request under its index, with ``None``
+    as its result. As the outcome of each request is then reported on
+    its own, requests run in parallel, with up to
+    :py:data:`mora.settings.LORA_WRITE_CONCURRENCY` at a time, except
+    that each waits for any earlier request it depends on, as
+    determined by :py:func:`_get_dependencies`. Requests depending on
+    a failed request are skipped and fail with the same error.
+
+    Given a ``progress`` callback, we invoke it with the amount of
+    requests finished and their total as we go along, including any
+    subrequests.
+
+    '''
+    # flatten the requests in the order of submitting them serially,
+    # i.e. any subrequests immediately follow their parent
+    flattened = []
+    parents = []
+    roots = []
+
+    def add(request, parent=None):
+        i = len(flattened)
+
+        flattened.append(request)
+        parents.append(parent)
+        roots.append(i if parent is None else roots[parent])
+
+        for subrequest in request.subrequests:
+            add(subrequest, i)
+
+        return i
+
+    toplevel = [add(request) for request in requests]
+
+    dependencies = _get_dependencies(flattened, parents)
+    results = {}
+    failures = {}
+
+    def get_failure(i):
+        failed = dependencies[i] & failures.keys()
+
+        return failures[min(failed)] if failed else None
+
+    def report():
+        if progress:
+            progress(len(results) + len(failures), len(flattened))
+
+    workers = (
+        min(int(settings.LORA_WRITE_CONCURRENCY), len(flattened))
+        if errors is not None else 1
+    )
+
+    if workers <= 1:
+        for i, request in enumerate(flattened):
+            if failures and errors is None:
+                break
+
+            failure = get_failure(i)
+
+            if failure is not None:
+                failures[i] = failure
+                continue
+
+            try:
+                results[i] = request.submit()
+            except Exception as exc:
+                failures[i] = exc
+
+            report()
+
+    else:
+        submit = util.copy_current_context(lambda request: request.submit())
+
+        waiting = list(range(len(flattened)))
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            while running or waiting:
+                finished = results.keys() | failures.keys()
+
+                for i in list(waiting):
+                    if not dependencies[i].issubset(finished):
+                        continue
+
+                    failure = get_failure(i)
+
+                    if failure is not None:
+                        waiting.remove(i)
+                        failures[i] = failure
+                        finished.add(i)
+
+                    elif len(running) < workers:
+                        waiting.remove(i)
+                        running[executor.submit(submit, flattened[i])] = i
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+
+                for future in done:
+                    i = running.pop(future)
+
+                    try:
+                        results[i] = future.result()
+                    except Exception as exc:
+                        failures[i] = exc
+
+                if done:
+                    report()
+
+    if failures and errors is None:
+        raise failures[min(failures)]
+
+    positions = {i: position for position, i in enumerate(toplevel)}
+
+    for i in sorted(failures):
+        errors.setdefault(positions[roots[i]], failures[i])
+
+    return [results.get(i) for i in toplevel]
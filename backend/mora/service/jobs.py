@@ -0,0 +1,331 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+'''Jobs
+----
+
+This section describes how to follow changes performed in the
+background.
+
+Endpoints performing potentially lengthy changes, such as
+:http:post:`/service/e/(uuid:employee_uuid)/terminate`, accept an
+``async`` flag. Given it, they respond immediately with a
+:http:statuscode:`202` and a job, and perform the change using a pool
+of workers. Its progress and eventual result are then available from
+:http:get:`/service/jobs/(uuid:jobid)`.
+
+Jobs run within the process receiving the request, as they act on
+behalf of the user making it. Their state lives in an SQLite database
+shared by all processes serving MO, so that any of them may report on
+the jobs. The ``JOB_DATABASE`` setting specifies its location,
+defaulting to a file in the temporary directory.
+
+'''
+
+import concurrent.futures
+import functools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import typing
+import uuid
+
+import flask
+
+from .. import exceptions
+from .. import settings
+from .. import util
+
+blueprint = flask.Blueprint('jobs', __name__, static_url_path='',
+                            url_prefix='/service')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+FINISHED_STATES = (DONE, FAILED)
+
+# report progress at most this often, in seconds
+PROGRESS_INTERVAL = 0.5
+
+_current = threading.local()
+_lock = threading.Lock()
+_executor = None
+_stores = {}
+
+
+class SQLiteStore:
+    '''The state of jobs, kept in an SQLite database shared by all
+    processes using it.
+
+    Should the process running a job die, e.g. following a restart,
+    we report the job as failed.
+
+    '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        self.__local = threading.local()
+
+    def __connect(self):
+        # connections cannot be shared between threads or processes
+        conn = getattr(self.__local, 'conn', None)
+
+        if conn is None or self.__local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30)
+
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'uuid TEXT PRIMARY KEY, data TEXT, pid INTEGER, '
+                'expires REAL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires)'
+            )
+            conn.commit()
+
+            self.__local.conn = conn
+            self.__local.pid = os.getpid()
+
+        return conn
+
+    def put(self, job: dict):
+        expires = (
+            time.time() + float(settings.JOB_TTL)
+            if job['state'] in FINISHED_STATES else None
+        )
+
+        with self.__connect() as conn:
+            if job['state'] == QUEUED:
+                conn.execute('DELETE FROM jobs WHERE expires <= ?',
+                             (time.time(),))
+
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)',
+                (job['uuid'], flask.json.dumps(job), os.getpid(), expires),
+            )
+
+    def get(self, jobid: str) -> typing.Optional[dict]:
+        row = self.__connect().execute(
+            'SELECT data, pid FROM jobs WHERE uuid = ?', (jobid,),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        job = flask.json.loads(row[0])
+
+        if job['state'] not in FINISHED_STATES and not _is_alive(row[1]):
+            job.update(
+                state=FAILED,
+                error=exceptions.HTTPException(
+                    message='job interrupted',
+                ).body,
+            )
+
+        return job
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def get_store():
+    '''Obtain the store of jobs configured in the settings.'''
+    filename = settings.JOB_DATABASE or os.path.join(
+        tempfile.gettempdir(),
+        'mora-jobs-{}.db'.format(os.getuid()),
+    )
+
+    with _lock:
+        try:
+            return _stores[filename]
+        except KeyError:
+            store = SQLiteStore(filename)
+            _stores[filename] = store
+
+            return store
+
+
+def _get_executor():
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max(int(settings.JOB_WORKERS), 1),
+            )
+
+        return _executor
+
+
+def _run(store, job, func, *args, **kwargs):
+    job = dict(job, state=RUNNING, started=util.now().isoformat())
+    store.put(job)
+
+    _current.store = store
+    _current.job = job
+    _current.reported = time.monotonic()
+
+    try:
+        result = func(*args, **kwargs)
+    except Exception as exc:
+        job.update(state=FAILED, error=exceptions.get_error_body(exc))
+    else:
+        job.update(state=DONE, result=result)
+    finally:
+        _current.job = None
+
+    job['finished'] = util.now().isoformat()
+    store.put(job)
+
+
+def enqueue(kind: str, func, *args, **kwargs) -> dict:
+    '''Perform the given function in the background, within the
+    context of the current request, if any.
+
+    :param kind: A short description of the job, e.g. the endpoint.
+    :return: The new job.
+
+    '''
+    store = get_store()
+    job = {
+        'uuid': str(uuid.uuid4()),
+        'kind': kind,
+        'state': QUEUED,
+        'progress': None,
+        'result': None,
+        'error': None,
+        'created': util.now().isoformat(),
+        'started': None,
+        'finished': None,
+    }
+
+    store.put(job)
+
+    run = functools.partial(_run, store, job, func, *args, **kwargs)
+
+    # the job acts on behalf of the user, but outlives the request
+    _get_executor().submit(util.copy_current_context(run, share_g=False))
+
+    return job
+
+
+def set_progress(done: int, total: int=None):
+    '''Report the progress of the current job, if any, as the amount of
+    steps done and, if known, their total.'''
+    job = getattr(_current, 'job', None)
+
+    if job is None:
+        return
+
+    job['progress'] = {
+        'done': done,
+        'total': total,
+    }
+
+    # avoid updating the store too often
+    now = time.monotonic()
+
+    if done == total or now - _current.reported >= PROGRESS_INTERVAL:
+        _current.store.put(job)
+        _current.reported = now
+
+
+def run(kind: str, func, *args, status: int=200, **kwargs):
+    '''Perform the given function for the current request, and respond
+    with its result -- unless the request has the ``async`` flag, in
+    which case we perform it in the background, and respond with the
+    job instead.
+
+    :param kind: A short description of the job, e.g. the endpoint.
+    :param status: The status code of the response, when performed
+                   immediately.
+
+    '''
+    if util.get_args_flag('async'):
+        job = enqueue(kind, func, *args, **kwargs)
+
+        response = flask.jsonify(job)
+        response.status_code = 202
+        response.headers['Location'] = flask.url_for(
+            'jobs.get_job', jobid=job['uuid'],
+        )
+
+        return response
+
+    return flask.jsonify(func(*args, **kwargs)), status
+
+
+@blueprint.route('/jobs/<uuid:jobid>')
+@util.restrictargs()
+def get_job(jobid):
+    '''Obtain the state of a job performed in the background.
+
+    .. :quickref: Jobs; Get
+
+    :statuscode 200: The job exists.
+    :statuscode 404: No such job, or it finished long ago.
+
+    :param uuid jobid: The UUID of the job.
+
+    :>json string uuid: The UUID of the job.
+    :>json string kind: What the job does.
+    :>json string state: One of ``queued``, ``running``, ``done`` or
+        ``failed``.
+    :>json object progress: The amount of steps ``done`` and, if known,
+        their ``total``, or ``null`` if not reported.
+    :>json result: Once done, the result of the job, as the endpoint
+        would have responded.
+    :>json object error: Once failed, the error, as the endpoint would
+        have responded.
+    :>json string created: When the job was created, in ISO 8601.
+    :>json string started: When the job started, if it did.
+    :>json string finished: When the job finished, if it did.
+
+    **Example Response**:
+
+    .. sourcecode:: json
+
+      {
+        "created": "2018-06-01T12:00:00.123456+02:00",
+        "error": null,
+        "finished": null,
+        "kind": "terminate_employee",
+        "progress": {
+          "done": 12,
+          "total": 40
+        },
+        "result": null,
+        "started": "2018-06-01T12:00:00.234567+02:00",
+        "state": "running",
+        "uuid": "a9c3a0f6-6f40-4bb3-9d4e-3a1f0d33c0ab"
+      }
+
+    '''
+    job = get_store().get(str(jobid))
+
+    if job is None:
+        raise exceptions.HTTPException(
+            exceptions.ErrorCodes.E_JOB_NOT_FOUND,
+            job_uuid=str(jobid),
+        )
+
+    return flask.jsonify(job)
@@ -17,9 +17,13 @@ units, refer to :http:get:`/service/(any:type)/(uuid:id)/details/`
 
 '''
 
+import collections
 import enum
 import functools
+import itertools
+import math
 import operator
+import typing
 import uuid
 
 import flask
@@ -27,9 +31,11 @@ import flask
 from . import address
 from . import facet
 from . import handlers
+from . import jobs
 from . import org
 from .. import common
 from .. import exceptions
+from .. import hierarchy
 from .. import lora
 from .. import mapping
 from .. import settings
@@ -56,6 +62,7 @@ class OrgUnitRequestHandler(handlers.ReadingRequestHandler):
     __slots__ = ()
 
     role_type = 'org_unit'
+    lora_scope = 'organisationenhed'
 
     @classmethod
     def has(cls, scope, reg):
@@ -253,9 +260,13 @@ class OrgUnitRequestHandler(handlers.ReadingRequestHandler):
         c = lora.Connector()
 
         if self.request_type == handlers.RequestType.CREATE:
-            return c.organisationenhed.create(self.payload, self.uuid)
+            r = c.organisationenhed.create(self.payload, self.uuid)
         else:
-            return c.organisationenhed.update(self.payload, self.uuid)
+            r = c.organisationenhed.update(self.payload, self.uuid)
+
+        hierarchy.invalidate()
+
+        return r
 
 
 def get_one_orgunit(c, unitid, unit=None,
@@ -281,33 +292,39 @@ def get_one_orgunit(c, unitid, unit=None,
     }
 
     if details is UnitDetails.NCHILDREN:
-        children = c.organisationenhed(overordnet=unitid, gyldighed='Aktiv')
+        h = hierarchy.get(c, rels['tilhoerer'][0]['uuid'])
 
-        r['child_count'] = len(children)
+        if h is not None:
+            r['child_count'] = h.get_child_count(unitid)
+        else:
+            children = c.organisationenhed(overordnet=unitid,
+                                           gyldighed='Aktiv')
+
+            r['child_count'] = len(children)
 
     elif details is UnitDetails.FULL:
         unittype = util.get_uuid(rels['enhedstype'][0], required=False)
 
         if rels['overordnet'][0]['uuid'] is not None:
-            r[mapping.PARENT] = get_one_orgunit(c,
-                                                rels['overordnet'][0]['uuid'],
-                                                details=UnitDetails.FULL)
-
-            parent = r[mapping.PARENT]
-            if parent and parent[mapping.LOCATION]:
-                r[mapping.LOCATION] = (parent[mapping.LOCATION] + '/' +
-                                       parent[mapping.NAME])
-            elif parent:
-                r[mapping.LOCATION] = parent[mapping.NAME]
-            else:
-                r[mapping.LOCATION] = ''
-
-            if unitid in settings.USER_SETTINGS['orgunit']:
-                org_settings = {'orgunit':
-                                settings.USER_SETTINGS['orgunit'][unitid]}
-                r[mapping.USER_SETTINGS] = org_settings
-            elif parent and mapping.USER_SETTINGS in parent:
-                r[mapping.USER_SETTINGS] = parent[mapping.USER_SETTINGS]
+            ancestors = _get_ancestors(c, rels['tilhoerer'][0]['uuid'],
+                                       rels['overordnet'][0]['uuid'])
+
+            r[mapping.LOCATION] = '/'.join(
+                name for ancestorid, name in reversed(ancestors)
+            )
+
+            # inherit the settings of the nearest unit that has any
+            for ancestorid in itertools.chain(
+                [unitid],
+                (ancestorid for ancestorid, name in ancestors),
+            ):
+                if ancestorid in settings.USER_SETTINGS['orgunit']:
+                    r[mapping.USER_SETTINGS] = {
+                        'orgunit': settings.USER_SETTINGS['orgunit'][
+                            ancestorid
+                        ],
+                    }
+                    break
             else:
                 r[mapping.USER_SETTINGS] = settings.USER_SETTINGS
 
@@ -334,6 +351,134 @@ def get_one_orgunit(c, unitid, unit=None,
     return r
 
 
+def _get_ancestors(c, orgid, parentid) -> typing.List[typing.Tuple[str, str]]:
+    '''Obtain the UUID and name of the given unit and the active units
+    above it, nearest first.'''
+    h = hierarchy.get(c, orgid)
+
+    if h is not None:
+        if parentid not in h:
+            return []
+
+        return [
+            (ancestorid, h.get_name(ancestorid))
+            for ancestorid in [parentid] + h.get_ancestors(parentid)
+        ]
+
+    # without an index, we have to walk the tree one level at a time
+    ancestors = []
+    seen = set()
+
+    while parentid is not None and parentid != orgid and parentid not in seen:
+        seen.add(parentid)
+
+        parent = c.organisationenhed.get(parentid)
+
+        if not parent or not util.is_reg_valid(parent):
+            break
+
+        ancestors.append((
+            parentid,
+            parent['attributter']['organisationenhedegenskaber'][0][
+                'enhedsnavn'
+            ],
+        ))
+
+        parentid = parent['relationer']['overordnet'][0]['uuid']
+
+    return ancestors
+
+
+def _load_if_cheaper(c, orgid,
+                     nunits: int) -> typing.Optional[hierarchy.Hierarchy]:
+    '''Load the index of the given organisation, provided that takes
+    fewer requests than searching for the children of the given amount
+    of units.
+
+    We estimate the cost from the size of the organisation as of the
+    last search. Lacking that, we only search the organisation once
+    the searches for children take more than one round of parallel
+    requests, so that narrow units never cost an extra request.
+
+    '''
+    chunk_size = c.organisationenhed.get_chunk_size()
+    size = hierarchy.sizes.get(str(orgid))
+
+    if size is not None:
+        if 1 + math.ceil(size / chunk_size) < nunits:
+            return hierarchy.build(c, orgid)
+
+    elif nunits > int(settings.LORA_CONCURRENCY):
+        orgunitids = hierarchy.search(c, orgid)
+
+        if math.ceil(len(orgunitids) / chunk_size) < nunits:
+            return hierarchy.build(c, orgid, orgunitids)
+
+    return None
+
+
+def get_child_counts(c, orgid, unitids) -> typing.Dict[str, int]:
+    '''Count the active units immediately beneath each of the given
+    units, which belong to the given organisation.
+
+    We use the index of the organisation when available. Otherwise,
+    searching for the children of each unit costs a request per unit,
+    so for wide trees, we instead load all active units of the
+    organisation. We search per unit, in parallel, when that takes
+    fewer requests.
+
+    '''
+    counts = collections.OrderedDict.fromkeys(map(str, unitids), 0)
+
+    if not counts:
+        return counts
+
+    h = hierarchy.get(c, orgid)
+
+    if h is None and len(counts) > 1:
+        h = _load_if_cheaper(c, orgid, len(counts))
+
+    if h is not None:
+        for unitid in counts:
+            counts[unitid] = h.get_child_count(unitid)
+
+        return counts
+
+    return collections.OrderedDict(zip(
+        counts,
+        lora.map_concurrently(
+            lambda unitid: len(c.organisationenhed(
+                overordnet=unitid,
+                gyldighed='Aktiv',
+            )),
+            counts,
+        ),
+    ))
+
+
+def _get_parent_orgid(c, type, parentid) -> str:
+    '''Obtain the organisation of the given parent of units, which is
+    either an organisation or a unit.'''
+    if type == 'o':
+        scope = c.organisation
+    else:
+        assert type == 'ou'
+        scope = c.organisationenhed
+
+    obj = scope.get(parentid)
+
+    if not obj or not obj.get('attributter'):
+        raise exceptions.HTTPException(
+            exceptions.ErrorCodes.E_ORG_UNIT_NOT_FOUND,
+            org_unit_uuid=parentid,
+        )
+
+    if type == 'o':
+        return str(parentid)
+    else:
+        return obj['relationer']['tilhoerer'][0]['uuid']
+
+
 @blueprint.route('/<any(o,ou):type>/<uuid:parentid>/children')
 @util.restrictargs('at')
 def get_children(type, parentid):
@@ -389,32 +534,198 @@ def get_children(type, parentid):
     '''
     c = common.get_connector()
 
-    if type == 'o':
-        scope = c.organisation
-    else:
-        assert type == 'ou'
-        scope = c.organisationenhed
-
-    obj = scope.get(parentid)
-
-    if not obj or not obj.get('attributter'):
-        raise exceptions.HTTPException(
-            exceptions.ErrorCodes.E_ORG_UNIT_NOT_FOUND,
-            org_unit_uuid=parentid,
-        )
+    orgid = _get_parent_orgid(c, type, parentid)
 
     children = [
-        get_one_orgunit(c, childid, child)
+        get_one_orgunit(c, childid, child, details=UnitDetails.MINIMAL)
         for childid, child in
         c.organisationenhed.get_all(overordnet=parentid,
                                     gyldighed='Aktiv')
     ]
 
+    child_counts = get_child_counts(c, orgid, [
+        child['uuid'] for child in children
+    ])
+
+    for child in children:
+        child['child_count'] = child_counts[child['uuid']]
+
     children.sort(key=operator.itemgetter('name'))
 
     return flask.jsonify(children)
 
 
+def get_subtree(c, orgid, parentid,
+                depth: typing.Optional[int] = None) -> typing.List[dict]:
+    '''Obtain the active units beneath the given parent, nested as
+    a tree, down to the given depth.
+
+    We fetch each level in bulk, and search for children using the
+    index of the organisation, loading it when the levels are wide.
+
+    '''
+    h = hierarchy.get(c, orgid)
+
+    roots = []
+    containers = {str(parentid): roots}
+    seen = set(containers)
+    nodes = []
+
+    while containers and (depth is None or depth > 0):
+        parentids = list(containers)
+
+        # searching per unit gets costly as the levels grow wider, so
+        # load the whole organisation once that takes fewer requests
+        if h is None and len(parentids) > 1:
+            h = _load_if_cheaper(c, orgid, len(parentids))
+
+        if h is not None:
+            childids = [h.get_children(unitid) for unitid in parentids]
+        else:
+            childids = lora.map_concurrently(
+                lambda unitid: c.organisationenhed(overordnet=unitid,
+                                                   gyldighed='Aktiv'),
+                parentids,
+            )
+
+        childids = collections.OrderedDict(
+            (childid, unitid)
+            for unitid, unitchildids in zip(parentids, childids)
+            for childid in unitchildids
+            if childid not in seen
+        )
+
+        seen.update(childids)
+
+        nodes = []
+
+        for childid, child in c.organisationenhed.get_all(uuid=childids):
+            node = get_one_orgunit(c, childid, child,
+                                   details=UnitDetails.MINIMAL)
+            node['children'] = []
+
+            containers[childids[childid]].append(node)
+            nodes.append(node)
+
+        for container in containers.values():
+            container.sort(key=operator.itemgetter('name'))
+
+        containers = collections.OrderedDict(
+            (node['uuid'], node['children']) for node in nodes
+        )
+
+        if depth is not None:
+            depth -= 1
+
+    # we only count the children of the deepest level, as we didn't
+    # load them
+    if h is not None:
+        child_counts = {
+            unitid: h.get_child_count(unitid) for unitid in containers
+        }
+    else:
+        child_counts = get_child_counts(c, orgid, containers)
+
+    for node in nodes:
+        node['child_count'] = child_counts[node['uuid']]
+        del node['children']
+
+    def set_counts(nodes):
+        for node in nodes:
+            if 'children' in node:
+                node['child_count'] = len(node['children'])
+                set_counts(node['children'])
+
+    set_counts(roots)
+
+    return roots
+
+
+@blueprint.route('/<any(o,ou):type>/<uuid:parentid>/tree')
+@util.restrictargs('at', 'depth')
+def get_tree(type, parentid):
+    '''Obtain the units nested within an organisation or an
+    organisational unit, along with the units nested beneath them,
+    and so on.
+
+    .. :quickref: Unit; Tree
+
+    :param type: 'o' if the parent is an organistion, and 'ou' if it's a unit.
+    :param uuid parentid: The UUID of the parent.
+
+    :queryparam date at: Show the units valid at this point in time,
+        in ISO-8601 format.
+    :queryparam int depth: The amount of levels to return; by default,
+        we return all of them. A depth of one is equivalent to
+        :http:get:`/service/(any:type)/(uuid:parentid)/children`.
+
+    :>jsonarr string name: Human-readable name of the unit.
+    :>jsonarr string user_key: Short, unique key identifying the unit.
+    :>jsonarr object validity: Validity range of the organisational unit.
+    :>jsonarr uuid uuid: Machine-friendly UUID of the unit.
+    :>jsonarr int child_count: Number of org. units nested immediately beneath
+                               the unit.
+    :>jsonarr array children: The units nested immediately beneath the
+                              unit, in the same format. Omitted for
+                              units beyond the requested depth.
+
+    :status 200: Whenever the organisation or unit exists and is readable.
+    :status 400: When the depth isn't a positive integer.
+    :status 404: When no such organisation or unit exists, or the
+                 parent was of the wrong type.
+
+    **Example Response**:
+
+    .. sourcecode:: json
+
+      [
+        {
+          "name": "Humanistisk fakultet",
+          "user_key": "hum",
+          "uuid": "9d07123e-47ac-4a9a-88c8-da82e3a4bc9e",
+          "child_count": 1,
+          "validity": {
+              "from": "2016-01-01",
+              "to": "2018-12-31"
+          },
+          "children": [
+            {
+              "name": "Filosofisk Institut",
+              "user_key": "fil",
+              "uuid": "85715fc7-925d-401b-822d-467eb4b163b6",
+              "child_count": 0,
+              "validity": {
+                  "from": "2016-01-01",
+                  "to": null
+              },
+              "children": []
+            }
+          ]
+        }
+      ]
+
+    '''
+    c = common.get_connector()
+
+    depth = flask.request.args.get('depth')
+
+    if depth is not None:
+        try:
+            depth = int(depth)
+        except ValueError:
+            depth = 0
+
+        if depth <= 0:
+            raise exceptions.HTTPException(
+                exceptions.ErrorCodes.E_INVALID_INPUT,
+                'depth must be a positive integer',
+            )
+
+    orgid = _get_parent_orgid(c, type, parentid)
+
+    return flask.jsonify(get_subtree(c, orgid, parentid, depth))
+
+
 @blueprint.route('/ou/<uuid:unitid>/')
 @util.restrictargs('at')
 def get_orgunit(unitid):
@@ -630,11 +941,16 @@ def terminate_org_unit(unitid):
     .. :quickref: Unit; Terminate
 
     :statuscode 200: The termination succeeded.
+    :statuscode 202: The unit may be terminated, and that will happen in
+        the background.
     :statuscode 404: No such unit found.
     :statuscode 409: Validation failed, see below.
 
     :param unitid: The UUID of the organisational unit to be terminated.
 
+    :queryparam boolean async: Terminate in the background, and respond
+        with a job; see :http:get:`/service/jobs/(uuid:jobid)`.
+
     :<json object validity: The date on which the termination should happen,
         in ISO 8601.
 
@@ -678,7 +994,6 @@ def terminate_org_unit(unitid):
 
     """
     date = util.get_valid_to(flask.request.get_json())
-
     c = lora.Connector(effective_date=util.to_iso_date(date))
 
     validator.is_date_range_in_org_unit_range(
@@ -705,6 +1020,12 @@ def terminate_org_unit(unitid):
             role_count=len(roles),
         )
 
+    return jobs.run('terminate_org_unit', _terminate_org_unit, unitid, date)
+
+
+def _terminate_org_unit(unitid, date):
+    c = lora.Connector()
+
     obj_path = ('tilstande', 'organisationenhedgyldighed')
     val_inactive = {
         'gyldighed': 'Inaktiv',
@@ -716,7 +1037,9 @@ def terminate_org_unit(unitid):
 
     c.organisationenhed.update(payload, unitid)
 
-    return flask.jsonify(unitid)
+    hierarchy.invalidate()
+
+    return unitid
 
     # TODO: Afkort adresser?
 
@@ -15,6 +15,58 @@ CONFIG_FILE = _path.join(BASE_DIR, '..', 'setup', 'mora.json')
 MAX_REQUEST_LENGTH = 4096
 DEFAULT_PAGE_SIZE = 2000
 
+# amount of parallel requests used when fetching many objects from LoRA
+LORA_CONCURRENCY = 5
+
+# amount of parallel writes used when submitting many changes to LoRA
+LORA_WRITE_CONCURRENCY = 5
+
+# amount of lines of a bulk write processed at a time
+BULK_BATCH_SIZE = 100
+
+# changes performed in the background, when requested using the
+# 'async' flag, run on this many workers per process; their state is
+# kept in an SQLite database shared by all processes, defaulting to a
+# file in the temporary directory, for this many seconds after they
+# finish
+JOB_WORKERS = 2
+JOB_DATABASE = None
+JOB_TTL = 86400
+
+# process-wide cache of organisations, facets and classes; set the TTL
+# to zero to disable it, or enable the warm-up to preload them on start
+CLASSIFICATION_CACHE_SIZE = 10000
+CLASSIFICATION_CACHE_TTL = 300
+CLASSIFICATION_CACHE_WARMUP = False
+
+# process-wide index of the units in each organisation and their
+# parents, per day, used when reading; changes made through other
+# processes only show up once it expires, so trees and child counts
+# may be this stale; set the TTL to zero to disable it
+HIERARCHY_CACHE_SIZE = 32
+HIERARCHY_CACHE_TTL = 300
+
+# persistent cache of addresses looked up in DAWA, shared between
+# processes; the file defaults to one in the temporary directory, and
+# addresses not found are retried sooner
+DAWA_CACHE_FILE = None
+DAWA_CACHE_SIZE = 100000
+DAWA_CACHE_TTL = 86400
+DAWA_CACHE_NEGATIVE_TTL = 300
+
+# local replica of DAR, loaded using 'flask.sh dar load', for looking
+# up and autocompleting addresses without asking DAWA
+DAR_REPLICA_FILE = None
+
+# addresses looked up in DAWA are batched, with this many in each
+# request and this many requests running in parallel
+DAWA_BATCH_SIZE = 50
+DAWA_CONCURRENCY = 5
+
+# log a breakdown of the LoRA calls made by requests taking longer
+# than this many seconds; zero disables it
+SLOW_REQUEST_THRESHOLD = 2.0
+
 LORA_URL = 'http://localhost:8080/'
 CA_BUNDLE = None
 
@@ -22,6 +74,12 @@ CA_BUNDLE = None
 AUTOCOMPLETE_ACCESS_ADDRESS_COUNT = 5
 AUTOCOMPLETE_ADDRESS_COUNT = 10
 
+# process-wide cache of autocomplete results from DAWA, which also
+# serves longer queries when the results of a shorter one were
+# complete; set the TTL to zero to disable it
+AUTOCOMPLETE_CACHE_SIZE = 1000
+AUTOCOMPLETE_CACHE_TTL = 60
+
 # Session config
 SESSION_TYPE = 'filesystem'
 SESSION_PERMANENT = False
@@ -15,6 +15,7 @@ various small functions used in many places.
 '''
 
 
+import atexit
 import collections
 import copy
 import datetime
@@ -27,8 +28,11 @@ import json
 import marshal
 import os
 import re
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
 import typing
 import urllib.parse
 import uuid
@@ -39,6 +43,7 @@ import dateutil.tz
 
 from . import exceptions
 from . import mapping
+from . import metrics
 
 
 # use this string rather than nothing or N/A in UI -- it's the em dash
@@ -73,6 +78,64 @@ _tzinfos = {
 }
 
 
+# the timestamp formats emitted by LoRA and ourselves, e.g.
+# '2017-01-01 00:00:00+01' or '2017-01-01T00:00:00.123456+01:00'
+_LORA_TIME_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?'
+    r'(?:Z|([+-])(\d\d)(?::?(\d\d)(?::?(\d\d))?)?)?\Z'
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_lora_time(s: str) -> datetime.datetime:
+    '''Parse the timestamps LoRA gives us. These are few and highly
+    repetitive, so we cache the results.
+
+    :raises ValueError: for anything else.
+
+    '''
+    if s == 'infinity':
+        return POSITIVE_INFINITY
+    elif s == '-infinity':
+        return NEGATIVE_INFINITY
+
+    m = _LORA_TIME_RE.match(s)
+
+    if not m:
+        raise ValueError('not a LoRA timestamp: {!r}'.format(s))
+
+    (year, month, day, hour, minute, second, fraction,
+     sign, tzhour, tzminute, tzsecond) = m.groups()
+
+    dt = datetime.datetime(
+        int(year), int(month), int(day),
+        int(hour or 0), int(minute or 0), int(second or 0),
+        int((fraction or '').ljust(6, '0')),
+    )
+
+    if sign:
+        offset = (
+            int(tzhour) * 3600 + int(tzminute or 0) * 60 + int(tzsecond or 0)
+        )
+
+        dt = dt.replace(tzinfo=dateutil.tz.tzoffset(
+            None, -offset if sign == '-' else offset,
+        ))
+    elif s.endswith('Z'):
+        dt = dt.replace(tzinfo=dateutil.tz.tzutc())
+    else:
+        return dt.replace(tzinfo=DEFAULT_TIMEZONE)
+
+    return dt.astimezone(DEFAULT_TIMEZONE)
+
+
+metrics.register_cache(
+    'timestamps',
+    lambda: _parse_lora_time.cache_info()[:2],
+)
+
+
 def parsedatetime(s: str, default=_sentinel) -> datetime.datetime:
     if isinstance(s, datetime.date):
         dt = s
@@ -90,10 +153,10 @@ def parsedatetime(s: str, default=_sentinel) -> datetime.datetime:
 
         return dt
 
-    elif s == 'infinity':
-        return POSITIVE_INFINITY
-    elif s == '-infinity':
-        return NEGATIVE_INFINITY
+    try:
+        return _parse_lora_time(s)
+    except (ValueError, TypeError):
+        pass
 
     if ' ' in s:
         # the frontend doesn't escape the 'plus' in ISO 8601 dates, so
@@ -364,6 +427,43 @@ def log_exception(msg=''):
     )
 
 
+def copy_current_context(func, share_g: bool=True):
+    '''Wrap the given function so that it runs within the current
+    application and request context, if any, e.g. from a worker thread.
+
+    Unlike :py:func:`flask.copy_current_request_context`, this shares
+    :py:data:`flask.session` with the caller, and thereby the token of
+    the user. Unless ``share_g`` is false, e.g. for work outliving the
+    current request, it also shares :py:data:`flask.g`, and thereby any
+    state kept for the current request.
+
+    '''
+    appctx = flask._app_ctx_stack.top
+    reqctx = flask._request_ctx_stack.top
+
+    if appctx is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        ctx = appctx.app.app_context()
+
+        if share_g:
+            ctx.g = appctx.g
+
+        with ctx:
+            if reqctx is None:
+                return func(*args, **kwargs)
+
+            copy = reqctx.copy()
+            copy.session = reqctx.session
+
+            with copy:
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
 def get_cpr_birthdate(number: typing.Union[int, str]) -> datetime.datetime:
     if isinstance(number, str):
         number = int(number)
@@ -394,19 +494,107 @@ def get_cpr_birthdate(number: typing.Union[int, str]) -> datetime.datetime:
 
 
 def cached(func):
+    '''Memoise the given function persistently, in an SQLite database
+    in the temporary directory. The database may be shared by several
+    processes at once.
+
+    Results are kept in memory, and written to the database in batches
+    of ``flush_size``, as well as on exit; call ``flush()`` to write
+    them immediately. Calls with arguments that :py:mod:`marshal`
+    cannot serialise are only memoised in memory.
+
+    '''
+    local = threading.local()
+    lock = threading.Lock()
+
+    def connect():
+        key = wrapper.cache_file, os.getpid()
+
+        # connections cannot be shared between threads or processes
+        if getattr(local, 'key', None) != key:
+            conn = sqlite3.connect(wrapper.cache_file, timeout=30)
+
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key BLOB PRIMARY KEY, value BLOB)'
+            )
+            conn.commit()
+
+            local.conn, local.key = conn, key
+
+        return local.conn
+
+    def load(key):
+        try:
+            row = connect().execute(
+                'SELECT value FROM cache WHERE key = ?', (key,),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+
+        return row and (marshal.loads(row[0]),)
+
+    def flush():
+        with lock:
+            pending = wrapper.pending
+            wrapper.pending = {}
+
+        if not pending:
+            return
+
+        try:
+            conn = connect()
+
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?)',
+                    pending.items(),
+                )
+        except sqlite3.Error:
+            pass
+
     @functools.wraps(func)
     def wrapper(*args):
         try:
             return wrapper.cache[args]
         except KeyError:
-            wrapper.cache[args] = result = func(*args)
+            pass
+
+        try:
+            key = marshal.dumps(args, marshal.version)
+        except ValueError:
+            key = None
+
+        found = load(key) if key is not None else None
+
+        if found:
+            result, = found
 
-            with open(wrapper.cache_file, 'wb') as fp:
-                marshal.dump(wrapper.cache, fp, marshal.version)
+        else:
+            result = func(*args)
+
+            try:
+                value = marshal.dumps(result, marshal.version)
+            except ValueError:
+                value = None
+
+            if key is not None and value is not None:
+                with lock:
+                    wrapper.pending[key] = value
+                    full = len(wrapper.pending) >= wrapper.flush_size
+
+                if full:
+                    flush()
 
-            return result
+        wrapper.cache[args] = result
+
+        return result
 
     wrapper.cache = {}
+    wrapper.pending = {}
+    wrapper.flush_size = 100
+    wrapper.flush = flush
     wrapper.uncached = wrapper.__wrapped__
 
     wrapper.cache_file = os.path.join(
@@ -417,18 +605,259 @@ def cached(func):
                 func.__name__,
                 str(os.getuid()),
             ],
-        ) + '.data',
+        ) + '.db',
     )
 
-    try:
-        with open(wrapper.cache_file, 'rb') as fp:
-            wrapper.cache = marshal.load(fp)
-    except (IOError, EOFError):
-        wrapper.cache = {}
+    atexit.register(flush)
 
     return wrapper
 
 
+class TTLCache:
+    '''A thread-safe, size-bounded mapping where entries expire after a
+    fixed amount of seconds. Once full, the least recently used entry
+    is evicted.
+
+    .. doctest::
+
+      >>> cache = TTLCache(maxsize=2, ttl=60)
+      >>> cache['a'] = 1
+      >>> cache['b'] = 2
+      >>> cache.get('a')
+      1
+      >>> cache['c'] = 3
+      >>> cache.get('b') is None
+      True
+      >>> sorted(cache)
+      ['a', 'c']
+
+    '''
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.RLock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+
+        with self.__lock:
+            try:
+                expires, value = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= now:
+                del self.__entries[key]
+                self.misses += 1
+                return default
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return (
+                key in self.__entries and
+                self.__entries[key][0] > time.monotonic()
+            )
+
+    def __iter__(self):
+        with self.__lock:
+            return iter(list(self.__entries))
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            try:
+                expires, value = self.__entries.pop(key)
+            except KeyError:
+                return default
+
+            return value if expires > time.monotonic() else default
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = self.misses = 0
+
+
+class PersistentCache:
+    '''A size-bounded cache of JSON values stored in an SQLite
+    database, shared by all processes using the same file. Entries
+    expire after a fixed amount of seconds, unless given a TTL of
+    their own; once full, those expiring first are evicted.
+
+    Failing to access the database merely results in a miss, as
+    caching is an optimisation.
+
+    .. doctest::
+
+      >>> cache = PersistentCache(':memory:', maxsize=10, ttl=60)
+      >>> cache['a'] = {'b': 1}
+      >>> cache.get('a')
+      {'b': 1}
+      >>> cache.set('c', 2, ttl=-1)
+      >>> cache.get('c') is None
+      True
+      >>> cache.get('c', allow_expired=True)
+      2
+
+    '''
+
+    def __init__(self, filename: str, maxsize: int, ttl: float):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.__local = threading.local()
+        self.__writes = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def __connect(self):
+        # connections cannot be shared between threads or processes
+        conn = getattr(self.__local, 'conn', None)
+
+        if conn is None or self.__local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=5)
+
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT, expires REAL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_expires '
+                'ON cache (expires)'
+            )
+            conn.commit()
+
+            self.__local.conn = conn
+            self.__local.pid = os.getpid()
+
+        return conn
+
+    def __warn(self, exc):
+        if flask.has_app_context():
+            flask.current_app.logger.warning(
+                'cache {!r} failed: {}'.format(self.filename, exc),
+            )
+
+    def get(self, key: str, default=None, *, allow_expired=False):
+        '''Obtain the given entry.
+
+        :param allow_expired: Return the entry even if it has expired.
+                              These remain until evicted, and such
+                              lookups count neither as hits nor
+                              misses.
+
+        '''
+        if not self.enabled:
+            return default
+
+        try:
+            row = self.__connect().execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key,),
+            ).fetchone()
+        except sqlite3.Error as exc:
+            self.__warn(exc)
+            row = None
+
+        if allow_expired:
+            return default if row is None else json.loads(row[0])
+        elif row is None or row[1] <= time.time():
+            self.misses += 1
+            return default
+
+        self.hits += 1
+
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float = None):
+        if not self.enabled:
+            return
+
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+
+        try:
+            conn = self.__connect()
+
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                    (key, json.dumps(value), expires),
+                )
+
+            # rather than counting the entries for every write, we
+            # evict periodically
+            self.__writes += 1
+
+            if self.__writes >= max(self.maxsize // 100, 1):
+                self.__writes = 0
+
+                with conn:
+                    conn.execute(
+                        'DELETE FROM cache WHERE key IN ('
+                        'SELECT key FROM cache ORDER BY expires DESC '
+                        'LIMIT -1 OFFSET ?)',
+                        (self.maxsize,),
+                    )
+
+        except sqlite3.Error as exc:
+            self.__warn(exc)
+
+    __setitem__ = set
+
+    def pop(self, key: str, default=None):
+        value = self.get(key, default, allow_expired=True)
+
+        try:
+            conn = self.__connect()
+
+            with conn:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error as exc:
+            self.__warn(exc)
+
+        return value
+
+    def clear(self):
+        try:
+            conn = self.__connect()
+
+            with conn:
+                conn.execute('DELETE FROM cache')
+        except sqlite3.Error as exc:
+            self.__warn(exc)
+
+        self.hits = self.misses = 0
+
+
 URN_SAFE = frozenset(b'abcdefghijklmnopqrstuvwxyz'
                      b'0123456789'
                      b'+')
@@ -222,11 +222,14 @@ def is_candidate_parent_valid(unitid: str, parent: str,
         raise exceptions.HTTPException(
             exceptions.ErrorCodes.V_CANNOT_MOVE_UNIT_TO_ROOT_LEVEL)
 
+    # validation must reflect LoRA as it is, so we always walk the
+    # tree rather than consult the index of the hierarchy, which may
+    # be stale in other processes
+    c = lora.Connector(effective_date=from_date)
+
     # Use for checking that the candidate parent is not the units own subtree
     seen = {unitid}
 
-    c = lora.Connector(effective_date=from_date)
-
     while True:
         # this captures moving to a child as well as moving into a loop
         if parent in seen:
@@ -0,0 +1,207 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import json
+import os
+import tempfile
+
+import click.testing
+import flask.cli
+import freezegun
+
+from mora import dar
+from mora import lora
+from mora.cli import dar as dar_cli
+from mora.service import address
+
+from . import util
+
+ACCESS_ADDRESS = {
+    'id': '00000000-0000-0000-0000-00000000000a',
+    'vejnavn': 'Nordre Ringgade',
+    'husnr': '1',
+    'supplerendebynavn': None,
+    'postnr': '8000',
+    'postnrnavn': 'Aarhus C',
+    'kommunekode': '0751',
+    'x': 10.199,
+    'y': 56.171,
+}
+
+ADDRESS = dict(
+    ACCESS_ADDRESS,
+    id='00000000-0000-0000-0000-00000000000b',
+    adgangsadresseid=ACCESS_ADDRESS['id'],
+    etage='1',
+    dør='th',
+)
+
+OTHER_ADDRESS = {
+    'id': '00000000-0000-0000-0000-00000000000c',
+    'vejnavn': 'Nordre Frihavnsgade',
+    'husnr': '2',
+    'supplerendebynavn': None,
+    'postnr': '2100',
+    'postnrnavn': 'København Ø',
+    'kommunekode': '0101',
+}
+
+
+class Tests(util.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        self.filename = os.path.join(tmpdir.name, 'dar.db')
+
+        runner = click.testing.CliRunner()
+
+        with runner.isolated_filesystem():
+            with open('adgangsadresser.json', 'w') as fp:
+                json.dump([ACCESS_ADDRESS, OTHER_ADDRESS], fp)
+
+            with open('adresser.json', 'w') as fp:
+                fp.write(json.dumps(ADDRESS) + '\n')
+
+            r = runner.invoke(
+                dar_cli.load,
+                ['-o', self.filename,
+                 'adgangsadresser.json', 'adresser.json'],
+                obj=flask.cli.ScriptInfo(create_app=lambda *args: self.app),
+            )
+
+        self.assertEqual(0, r.exit_code, r.output)
+        self.assertIn('Loaded 3 addresses', r.output)
+
+        settings = util.override_settings(DAR_REPLICA_FILE=self.filename)
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def test_replica(self):
+        replica = dar.get_replica()
+
+        self.assertEqual(
+            {
+                ADDRESS['id']: {
+                    'endpoint': 'adresser',
+                    'address': ADDRESS,
+                },
+            },
+            replica.get([ADDRESS['id'], 'kaflaflibob']),
+        )
+
+        self.assertEqual(
+            [
+                ('Nordre Ringgade 1, 8000 Aarhus C', ACCESS_ADDRESS['id']),
+            ],
+            replica.autocomplete('adgangsadresser', 'nordre   ringgade',
+                                 5, 751),
+        )
+
+        self.assertEqual(
+            [
+                ('Nordre Frihavnsgade 2, 2100 København Ø',
+                 OTHER_ADDRESS['id']),
+                ('Nordre Ringgade 1, 8000 Aarhus C', ACCESS_ADDRESS['id']),
+            ],
+            replica.autocomplete('adgangsadresser', 'Nordre', 5),
+        )
+
+        with util.override_settings(DAR_REPLICA_FILE=None):
+            self.assertIsNone(dar.get_replica())
+
+    @util.mock('many-addresses.json')
+    def test_lookup(self, m):
+        c = lora.Connector()
+
+        self.assertEqual(
+            [
+                {
+                    'address_type': {
+                        'scope': 'DAR',
+                    },
+                    'href': 'https://www.openstreetmap.org/'
+                    '?mlon=10.199&mlat=56.171&zoom=16',
+                    'name': 'Nordre Ringgade 1, 1. th, 8000 Aarhus C',
+                    'uuid': ADDRESS['id'],
+                },
+                {
+                    'address_type': {
+                        'scope': 'DAR',
+                    },
+                    'href': 'https://www.openstreetmap.org/'
+                    '?mlon=12.57924839&mlat=55.68113676&zoom=16',
+                    'name': 'Pilestræde 43, 3. th, 1112 København K',
+                    'uuid': '0ead9b4d-c615-442d-8447-b328a73b5b39',
+                },
+            ],
+            address.get_many_addresses(
+                c,
+                [
+                    {
+                        'objekttype': 'DAR',
+                        'uuid': addrid,
+                    }
+                    for addrid in (
+                        ADDRESS['id'],
+                        '0ead9b4d-c615-442d-8447-b328a73b5b39',
+                    )
+                ],
+            ),
+        )
+
+        # only the address missing from the replica was looked up
+        self.assertEqual(1, m.call_count)
+
+    @freezegun.freeze_time('2017-07-28')
+    @util.mock(('reading-organisation.json', 'dawa-autocomplete.json'))
+    def test_autocomplete(self, m):
+        def autocomplete(q):
+            m.reset_mock()
+
+            r = self.assertRequest(
+                '/service/o/456362c4-0ee4-4e5e-a72c-751239745e62/'
+                'address_autocomplete/?q=' + q,
+            )
+
+            return (
+                [addr['location']['name'] for addr in r],
+                sum(1 for req in m.request_history
+                    if req.hostname == 'dawa.aws.dk'),
+            )
+
+        self.assertEqual(
+            (
+                [
+                    'Nordre Ringgade 1, 8000 Aarhus C',
+                    'Nordre Ringgade 1, 1. th, 8000 Aarhus C',
+                ],
+                0,
+            ),
+            autocomplete('Nordre'),
+        )
+
+        self.assertEqual(
+            (
+                [
+                    'Nordre Frihavnsgade 2, 2100 København Ø',
+                    'Nordre Ringgade 1, 8000 Aarhus C',
+                    'Nordre Ringgade 1, 1. th, 8000 Aarhus C',
+                ],
+                0,
+            ),
+            autocomplete('Nordre&global=1'),
+        )
+
+        # fall back to DAWA for anything unknown
+        names, dawa_calls = autocomplete('Strandlodsvej+25M&global=1')
+
+        self.assertEqual('Strandlodsvej 25M, 2300 København S', names[0])
+        self.assertEqual(2, dawa_calls)
@@ -6,11 +6,65 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import json
+import re
+import threading
+import unittest.mock
+
+import freezegun
+
+from mora import exceptions
 from mora.service import detail_writing
+from mora.service import handlers
 
 from . import util
 
 
+def mock_units_and_employees(m, orgid, missing=()):
+    '''Mock any unit, employee or class looked up, except for those
+    listed as missing.'''
+    always = {
+        'from': '-infinity',
+        'to': 'infinity',
+    }
+
+    objects = {
+        'organisation/organisationenhed': {
+            'relationer': {
+                'tilhoerer': [{'uuid': orgid, 'virkning': always}],
+            },
+            'tilstande': {
+                'organisationenhedgyldighed': [
+                    {'gyldighed': 'Aktiv', 'virkning': always},
+                ],
+            },
+        },
+        'organisation/bruger': {
+            'tilstande': {
+                'brugergyldighed': [
+                    {'gyldighed': 'Aktiv', 'virkning': always},
+                ],
+            },
+        },
+        'klassifikation/klasse': {},
+    }
+
+    for path, reg in objects.items():
+        m.get(
+            'http://mox/' + path,
+            json=lambda request, context, reg=reg: {
+                'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [reg],
+                    }
+                    for objid in request.qs['uuid']
+                    if objid not in missing
+                ]],
+            },
+        )
+
+
 class Tests(util.TestCase):
     maxDiff = None
 
@@ -69,3 +123,521 @@ class Tests(util.TestCase):
             },
             status_code=400,
         )
+
+    @util.mock()
+    def test_list_details(self, m):
+        userid = '00000000-0000-0000-0000-000000000000'
+        funcnames = {
+            '{:08x}-0000-0000-0000-000000000001'.format(i): funcname
+            for i, funcname in enumerate(['Engagement', 'Orlov'] * 100)
+        }
+
+        def callback(request, context):
+            if 'uuid' in request.qs:
+                return {'results': [[
+                    {
+                        'id': funcid,
+                        'registreringer': [{
+                            'attributter': {
+                                'organisationfunktionegenskaber': [{
+                                    'funktionsnavn': funcnames[funcid],
+                                }],
+                            },
+                        }],
+                    }
+                    for funcid in request.qs['uuid']
+                ]]}
+
+            self.assertEqual([userid], request.qs['tilknyttedebrugere'])
+
+            if 'funktionsnavn' in request.qs:
+                (funcname,) = request.qs['funktionsnavn']
+
+                return {'results': [[
+                    funcid
+                    for funcid, name in sorted(funcnames.items())
+                    if name.lower() == funcname
+                ]]}
+
+            else:
+                return {'results': [sorted(funcnames)]}
+
+        m.get('http://mox/organisation/organisationfunktion', json=callback)
+        m.get('http://mox/organisation/bruger', json={'results': [[]]})
+
+        expected = dict.fromkeys(handlers.FUNCTION_KEYS, False)
+        expected.update(address=False, engagement=True, leave=True,
+                        org_unit=False)
+
+        # one search, fetching the functions in three chunks, and the
+        # user itself
+        with self.subTest('bulk'):
+            m.reset_mock()
+
+            self.assertRequestResponse(
+                '/service/e/{}/details/'.format(userid),
+                expected,
+            )
+
+            self.assertEqual(1 + 3 + 1, m.call_count)
+
+        # with smaller chunks, it's cheaper to search for each kind
+        with self.subTest('many'), \
+                util.override_settings(MAX_REQUEST_LENGTH=1000):
+            m.reset_mock()
+
+            self.assertRequestResponse(
+                '/service/e/{}/details/'.format(userid),
+                expected,
+            )
+
+            self.assertEqual(
+                1 + len(handlers.FUNCTION_KEYS) + 1,
+                m.call_count,
+            )
+
+    @freezegun.freeze_time('2018-03-15')
+    @util.mock()
+    def test_get_detail_paged(self, m):
+        unitid = '00000000-0000-0000-0000-000000000000'
+
+        def get_virkning(i):
+            return {
+                'from': '2017-0{}-01 00:00:00+01'.format(1 + i % 3),
+                'to': 'infinity',
+            }
+
+        def get_function(i):
+            virkning = get_virkning(i)
+
+            return {
+                'attributter': {
+                    'organisationfunktionegenskaber': [{
+                        'brugervendtnoegle': str(i),
+                        'funktionsnavn': 'Engagement',
+                        'virkning': virkning,
+                    }],
+                },
+                'tilstande': {
+                    'organisationfunktiongyldighed': [{
+                        'gyldighed': 'Aktiv',
+                        'virkning': virkning,
+                    }],
+                },
+                'relationer': {
+                    'tilknyttedebrugere': [{
+                        'uuid': '{:08x}-0000-0000-0000-000000000002'.format(i),
+                        'virkning': virkning,
+                    }],
+                    'tilknyttedeenheder': [{
+                        'uuid': unitid,
+                        'virkning': virkning,
+                    }],
+                },
+            }
+
+        def get_user(i):
+            return {
+                'attributter': {
+                    'brugeregenskaber': [{
+                        # reverse the order within each start date
+                        'brugernavn': 'Bruger {:03}'.format(100 - i),
+                        'virkning': get_virkning(i),
+                    }],
+                },
+            }
+
+        def get_callback(get_obj):
+            def callback(request, context):
+                if 'uuid' not in request.qs:
+                    return {'results': [[
+                        '{:08x}-0000-0000-0000-000000000001'.format(i)
+                        for i in range(20)
+                    ]]}
+
+                return {'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [get_obj(int(objid[:8], 16))],
+                    }
+                    for objid in request.qs['uuid']
+                ]]}
+
+            return callback
+
+        m.get('http://mox/organisation/organisationfunktion',
+              json=get_callback(get_function))
+        m.get('http://mox/organisation/bruger',
+              json=get_callback(get_user))
+        m.get('http://mox/organisation/organisationenhed',
+              json={'results': [[]]})
+
+        url = '/service/ou/{}/details/engagement'.format(unitid)
+
+        everything = self.assertRequest(url)
+
+        self.assertEqual(20, len(everything))
+        self.assertEqual(
+            sorted(
+                everything,
+                key=lambda v: (v['validity']['from'], v['person']['name']),
+            ),
+            everything,
+        )
+
+        with self.subTest('start'):
+            m.reset_mock()
+
+            # plain paging merely slices the list
+            r = self.assertRequest(url + '?start=8&limit=4')
+
+            self.assertEqual(everything[8:12], r)
+
+            # we only looked up the users starting on the same date as
+            # those on the page
+            (users,) = [
+                request.qs['uuid']
+                for request in m.request_history
+                if request.path == '/organisation/bruger'
+            ]
+
+            self.assertEqual(7, len(users))
+
+        with self.subTest('paged'):
+            r = self.assertRequest(url + '?paged=1&start=8&limit=4')
+
+            self.assertEqual(everything[8:12], r['items'])
+            self.assertEqual(20, r['total'])
+            self.assertEqual(8, r['offset'])
+            self.assertIsNotNone(r['cursor'])
+
+        with self.subTest('cursor'):
+            items = []
+            cursor = None
+
+            while True:
+                r = self.assertRequest(
+                    url + ('?cursor=' + cursor if cursor
+                           else '?paged=1&limit=6'),
+                )
+
+                items += r['items']
+                cursor = r['cursor']
+
+                if not cursor:
+                    break
+
+            self.assertEqual(everything, items)
+
+        with self.subTest('beyond'):
+            self.assertEqual([], self.assertRequest(url + '?start=20'))
+
+            self.assertEqual(
+                {'cursor': None, 'items': [], 'offset': 20, 'total': 20},
+                self.assertRequest(url + '?start=20&paged=1'),
+            )
+
+        with self.subTest('invalid'):
+            self.assertRequestResponse(
+                url + '?cursor=kaflaflibob',
+                {
+                    'description': "invalid cursor 'kaflaflibob'",
+                    'error': True,
+                    'error_key': 'E_INVALID_INPUT',
+                    'status': 400,
+                },
+                status_code=400,
+            )
+
+            self.assertRequestResponse(
+                url + '?start=kaflaflibob',
+                {
+                    'description': 'start and limit must be non-negative '
+                    'integers',
+                    'error': True,
+                    'error_key': 'E_INVALID_INPUT',
+                    'status': 400,
+                },
+                status_code=400,
+            )
+
+    @util.mock()
+    def test_prefetch_validation(self, m):
+        orgid = '00000000-0000-0000-0000-000000000000'
+        unitid = '00000000-0000-0000-0000-000000000001'
+        typeid = '00000000-0000-0000-0000-000000000002'
+        userids = [
+            '{:08x}-0000-0000-0000-000000000003'.format(i)
+            for i in range(10)
+        ]
+
+        mock_units_and_employees(m, orgid)
+
+        requests = handlers.generate_requests(
+            [
+                {
+                    'type': 'engagement',
+                    'org_unit': {'uuid': unitid},
+                    'person': {'uuid': userid},
+                    'engagement_type': {'uuid': typeid},
+                    'validity': {
+                        'from': '2018-01-01',
+                        'to': None,
+                    },
+                }
+                for userid in userids
+            ],
+            handlers.RequestType.CREATE,
+        )
+
+        self.assertEqual(userids, [
+            req.payload['relationer']['tilknyttedebrugere'][0]['uuid']
+            for req in requests
+        ])
+
+        # one lookup of the unit, the employees and the type each,
+        # rather than several per request
+        self.assertEqual(
+            [
+                '/klassifikation/klasse',
+                '/organisation/bruger',
+                '/organisation/organisationenhed',
+            ],
+            sorted(req.path for req in m.request_history),
+        )
+
+        (userreq,) = [
+            req
+            for req in m.request_history
+            if req.path == '/organisation/bruger'
+        ]
+
+        self.assertEqual(sorted(userids), sorted(userreq.qs['uuid']))
+
+    def test_submit_requests(self):
+        parentid, childid, userid, otherid = (
+            '00000000-0000-0000-0000-00000000000{}'.format(i)
+            for i in range(4)
+        )
+
+        lock = threading.Lock()
+        log = []
+
+        def make_request(name, request, objid=None, subrequests=(),
+                         submit=None):
+            def do_submit():
+                with lock:
+                    log.append(('start', name))
+
+                if submit:
+                    submit()
+
+                with lock:
+                    log.append(('end', name))
+
+                return name
+
+            return unittest.mock.Mock(
+                uuid=objid,
+                request=request,
+                request_type=handlers.RequestType.CREATE,
+                subrequests=list(subrequests),
+                submit=do_submit,
+            )
+
+        # make the two independent engagements wait for each other,
+        # so that this deadlocks unless they run in parallel
+        barrier = threading.Barrier(2, timeout=5)
+
+        parent = make_request('parent', {'type': 'org_unit'}, parentid)
+        child = make_request('child', {
+            'type': 'org_unit',
+            'parent': {'uuid': parentid},
+        }, childid)
+        engagement = make_request('engagement', {
+            'type': 'engagement',
+            'person': {'uuid': userid},
+            'org_unit': {'uuid': parentid},
+        }, submit=barrier.wait)
+        employee = make_request('employee', {
+            'type': 'employee',
+        }, userid, subrequests=[engagement])
+        other = make_request('other', {
+            'type': 'engagement',
+            'org_unit': {'uuid': otherid},
+        }, submit=barrier.wait)
+
+        with self.subTest('dependencies'):
+            self.assertEqual(
+                [set(), {0}, set(), {0, 2}, set()],
+                handlers._get_dependencies(
+                    [parent, child, employee, engagement, other],
+                    [None, None, None, 2, None],
+                ),
+            )
+
+        with self.subTest('parallel'):
+            # only when reporting the errors of each request
+            self.assertEqual(
+                ['parent', 'child', 'employee', 'other'],
+                handlers.submit_requests([parent, child, employee, other],
+                                         {}),
+            )
+
+            self.assertLess(log.index(('end', 'parent')),
+                            log.index(('start', 'child')))
+            self.assertLess(log.index(('end', 'employee')),
+                            log.index(('start', 'engagement')))
+
+        with self.subTest('serial'):
+            log.clear()
+
+            handlers.submit_requests([
+                parent,
+                child,
+                make_request('other', {'type': 'engagement'}),
+            ])
+
+            self.assertEqual(
+                [
+                    ('start', 'parent'),
+                    ('end', 'parent'),
+                    ('start', 'child'),
+                    ('end', 'child'),
+                    ('start', 'other'),
+                    ('end', 'other'),
+                ],
+                log,
+            )
+
+        with self.subTest('serial, by setting'), \
+                util.override_settings(LORA_WRITE_CONCURRENCY=1):
+            log.clear()
+
+            handlers.submit_requests([parent, child], {})
+
+            self.assertEqual(
+                [
+                    ('start', 'parent'),
+                    ('end', 'parent'),
+                    ('start', 'child'),
+                    ('end', 'child'),
+                ],
+                log,
+            )
+
+        with self.subTest('errors'):
+            def fail(message):
+                def raise_it():
+                    raise exceptions.HTTPException(
+                        exceptions.ErrorCodes.E_INVALID_INPUT,
+                        message=message,
+                    )
+
+                return raise_it
+
+            log.clear()
+
+            with self.assertRaisesRegex(exceptions.HTTPException, 'first'):
+                handlers.submit_requests([
+                    make_request('first', {}, submit=fail('first')),
+                    make_request('second', {}, submit=fail('second')),
+                    make_request('third', {}),
+                ])
+
+            # nothing following the failure was submitted
+            self.assertEqual([('start', 'first')], log)
+
+    @util.mock()
+    def test_bulk(self, m):
+        orgid = '00000000-0000-0000-0000-000000000000'
+        unitid = '00000000-0000-0000-0000-000000000001'
+        userid = '00000000-0000-0000-0000-000000000002'
+        missingid = '00000000-0000-0000-0000-000000000003'
+
+        mock_units_and_employees(m, orgid, missing={missingid})
+
+        m.put(
+            re.compile('http://mox/organisation/organisationfunktion/'),
+            json=lambda request, context: {
+                'uuid': request.path.rsplit('/', 1)[-1],
+            },
+        )
+
+        def make_engagement(i, person=userid):
+            return json.dumps({
+                'type': 'engagement',
+                'uuid': '{:08x}-0000-0000-0000-000000000004'.format(i),
+                'org_unit': {'uuid': unitid},
+                'person': {'uuid': person},
+                'engagement_type': {'uuid': orgid},
+                'validity': {
+                    'from': '2018-01-01',
+                    'to': None,
+                },
+            })
+
+        lines = [
+            make_engagement(1),
+            '{"kaflaflibob',
+            '',
+            '{"type": "kaflaflibob"}',
+            make_engagement(2, person=missingid),
+            make_engagement(3),
+        ]
+
+        with util.override_settings(BULK_BATCH_SIZE=2):
+            r = self.client.post(
+                '/service/details/bulk/create',
+                data='\n'.join(lines).encode(),
+                content_type='application/x-ndjson',
+            )
+
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('application/x-ndjson', r.mimetype)
+
+        results = [
+            json.loads(line)
+            for line in r.get_data(as_text=True).splitlines()
+        ]
+
+        # the details vary between versions of Python
+        results[1]['description'] = \
+            results[1]['description'].split(':')[0]
+
+        self.assertEqual(
+            [
+                {
+                    'line': 1,
+                    'uuid': '00000001-0000-0000-0000-000000000004',
+                },
+                {
+                    'line': 2,
+                    'description': 'invalid JSON',
+                    'error': True,
+                    'error_key': 'E_INVALID_INPUT',
+                    'status': 400,
+                },
+                {
+                    'line': 4,
+                    'description': 'Unknown role type.',
+                    'error': True,
+                    'error_key': 'E_UNKNOWN_ROLE_TYPE',
+                    'status': 400,
+                    'type': 'kaflaflibob',
+                },
+                {
+                    'line': 5,
+                    'description': 'User not found.',
+                    'error': True,
+                    'error_key': 'E_USER_NOT_FOUND',
+                    'status': 404,
+                    'employee_uuid': missingid,
+                },
+                {
+                    'line': 6,
+                    'uuid': '00000003-0000-0000-0000-000000000004',
+                },
+            ],
+            results,
+        )
@@ -0,0 +1,206 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from unittest import mock
+
+import freezegun
+
+from mora import exceptions
+from mora import hierarchy
+from mora import lora
+from mora import util as mora_util
+from mora import validator
+
+from . import util
+
+orgid = '00000000-0000-0000-0000-000000000000'
+
+# uuid -> (parent, name)
+units = {
+    '00000000-0000-0000-0000-00000000000a': (orgid, 'A'),
+    '00000000-0000-0000-0000-00000000000b': (
+        '00000000-0000-0000-0000-00000000000a', 'B',
+    ),
+    '00000000-0000-0000-0000-00000000000c': (
+        '00000000-0000-0000-0000-00000000000b', 'C',
+    ),
+    '00000000-0000-0000-0000-00000000000d': (
+        '00000000-0000-0000-0000-00000000000a', 'D',
+    ),
+}
+
+a, b, c, d = sorted(units)
+
+
+def get_unit(unitid):
+    parentid, name = units[unitid]
+    virkning = {
+        'from': '2017-01-01 00:00:00+01',
+        'to': 'infinity',
+    }
+
+    return {
+        'attributter': {
+            'organisationenhedegenskaber': [{
+                'brugervendtnoegle': name,
+                'enhedsnavn': name,
+                'virkning': virkning,
+            }],
+        },
+        'tilstande': {
+            'organisationenhedgyldighed': [{
+                'gyldighed': 'Aktiv',
+                'virkning': virkning,
+            }],
+        },
+        'relationer': {
+            'enhedstype': [{}],
+            'overordnet': [{'uuid': parentid, 'virkning': virkning}],
+            'tilhoerer': [{'uuid': orgid, 'virkning': virkning}],
+        },
+    }
+
+
+def mock_units(m):
+    def callback(request, context):
+        if 'uuid' in request.qs:
+            return {'results': [[
+                {'id': unitid, 'registreringer': [get_unit(unitid)]}
+                for unitid in request.qs['uuid']
+            ]]}
+        else:
+            return {'results': [[
+                unitid
+                for unitid, (parentid, name) in sorted(units.items())
+                if parentid in request.qs.get('overordnet', [parentid])
+            ]]}
+
+    m.get('http://mox/organisation/organisationenhed', json=callback)
+    m.get('http://mox/organisation/organisation', json={'results': [[]]})
+
+
+@freezegun.freeze_time('2018-03-15')
+class Tests(util.TestCase):
+    def test_hierarchy(self):
+        h = hierarchy.Hierarchy(orgid, [
+            (unitid, parentid, name)
+            for unitid, (parentid, name) in units.items()
+        ] + [
+            # a cycle, which we shouldn't follow indefinitely
+            ('x', 'y', 'X'),
+            ('y', 'x', 'Y'),
+        ])
+
+        self.assertIn(c, h)
+        self.assertNotIn(orgid, h)
+
+        self.assertEqual(orgid, h.get_parent(a))
+        self.assertEqual([b, a], h.get_ancestors(c))
+        self.assertEqual([], h.get_ancestors(a))
+        self.assertEqual(2, h.get_depth(c))
+        self.assertEqual('A/B', h.get_location(c))
+        self.assertEqual('', h.get_location(a))
+
+        self.assertEqual([a], h.get_children(orgid))
+        self.assertEqual([b, d], h.get_children(a))
+        self.assertEqual(2, h.get_child_count(a))
+        self.assertEqual(0, h.get_child_count(c))
+        self.assertEqual([b, d, c], list(h.get_descendants(a)))
+
+        self.assertEqual(['y'], h.get_ancestors('x'))
+        self.assertEqual(['y'], list(h.get_descendants('x')))
+
+    @util.mock()
+    def test_get(self, m):
+        mock_units(m)
+
+        with mock.patch.object(hierarchy.cache, 'ttl', 300):
+            h = hierarchy.get(lora.Connector(), orgid)
+
+            self.assertEqual(4, len(h))
+            self.assertEqual(2, m.call_count)
+
+            # shared by connectors on the same day
+            self.assertIs(h, hierarchy.get(
+                lora.Connector(effective_date='2018-03-15T12:00:00'),
+                orgid,
+            ))
+            self.assertEqual(2, m.call_count)
+
+            # but not those covering more than a moment
+            self.assertIsNone(hierarchy.get(
+                lora.Connector(validity='past'), orgid,
+            ))
+
+            hierarchy.invalidate()
+
+            self.assertIsNot(h, hierarchy.get(lora.Connector(), orgid))
+            self.assertEqual(4, m.call_count)
+
+        # disabled
+        self.assertIsNone(hierarchy.get(lora.Connector(), orgid))
+
+    @util.mock()
+    def test_location(self, m):
+        mock_units(m)
+
+        with mock.patch.object(hierarchy.cache, 'ttl', 300):
+            r = self.assertRequest('/service/ou/{}/'.format(c))
+
+            self.assertEqual('A/B', r['location'])
+            self.assertEqual(b, r['parent']['uuid'])
+
+            # the index is now loaded, so counting children merely
+            # requires the unit and its children
+            count = m.call_count
+
+            r = self.assertRequest('/service/ou/{}/children'.format(a))
+
+            self.assertEqual(
+                [(b, 1), (d, 0)],
+                [(child['uuid'], child['child_count']) for child in r],
+            )
+            self.assertEqual(count + 3, m.call_count)
+
+    @util.mock()
+    def test_move_to_child(self, m):
+        mock_units(m)
+
+        with mock.patch.object(hierarchy.cache, 'ttl', 300):
+            hierarchy.get(lora.Connector(), orgid)
+
+            with self.assertRaises(exceptions.HTTPException) as ctxt:
+                validator.is_candidate_parent_valid(
+                    b, c, mora_util.parsedatetime('2018-03-15'),
+                )
+
+            self.assertEqual(
+                exceptions.ErrorCodes.V_ORG_UNIT_MOVE_TO_CHILD.name,
+                ctxt.exception.response.json['error_key'],
+            )
+
+            validator.is_candidate_parent_valid(
+                c, d, mora_util.parsedatetime('2018-03-15'),
+            )
+
+            # another process moved D below C, which the index of this
+            # one does not know, so validation must ask LoRA
+            with mock.patch.dict(units, {d: (c, 'D')}):
+                h = hierarchy.get(lora.Connector(), orgid)
+
+                self.assertEqual([a], h.get_ancestors(d))
+
+                with self.assertRaises(exceptions.HTTPException) as ctxt:
+                    validator.is_candidate_parent_valid(
+                        c, d, mora_util.parsedatetime('2018-03-15'),
+                    )
+
+                self.assertEqual(
+                    exceptions.ErrorCodes.V_ORG_UNIT_MOVE_TO_CHILD.name,
+                    ctxt.exception.response.json['error_key'],
+                )
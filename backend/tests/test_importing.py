@@ -9,6 +9,7 @@
 import json
 import os
 import uuid
+from unittest import mock
 
 import requests_mock
 
@@ -68,6 +69,35 @@ class MockTests(util.TestCase):
 
         self.assertEqual(expected, actual)
 
+    @util.mock('importing-wash.json')
+    def test_addr_wash_parallel(self, m):
+        addresses = [
+            ('Rådhuspladsen', 8100, 'Århus C'),
+            ('Skejbygårdsvej 14-16', 8240, 'Risskov'),
+            ('Runevej 107-109', 8210, 'Aarhus V'),
+            ('Rådhuspladsen', 8100, 'Århus C'),
+            ('Jettesvej 2, Hus 1', 8220, 'Brabrand'),
+        ]
+
+        with mock.patch.object(processors, 'wash_address',
+                               wraps=processors.wash_address) as w:
+            self.assertEqual(
+                {
+                    ('Rådhuspladsen', 8100, 'Århus C'):
+                    '9b9a6a18-ffb7-4ece-a7f1-5368812e4719',
+                    ('Skejbygårdsvej 14-16', 8240, 'Risskov'):
+                    None,
+                    ('Runevej 107-109', 8210, 'Aarhus V'):
+                    '209b75e7-a662-4224-9e3d-64ef1f16eab0',
+                    ('Jettesvej 2, Hus 1', 8220, 'Brabrand'):
+                    '2240aef2-7636-40b6-8c19-8f3e4dd65710',
+                },
+                processors.wash_addresses(addresses, jobs=3),
+            )
+
+        # each address is only washed once
+        self.assertEqual(4, w.call_count)
+
     @util.mock('importing-wash.json')
     def test_addr_wash(self, m):
         w = processors.wash_address
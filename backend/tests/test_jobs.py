@@ -0,0 +1,306 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import flask
+
+from mora import lora
+from mora.service import jobs
+
+from . import util
+from .test_details import mock_units_and_employees
+
+
+class Tests(util.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        super().setUp()
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        self.filename = os.path.join(tmpdir.name, 'jobs.db')
+
+        settings = util.override_settings(JOB_DATABASE=self.filename)
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def wait_for(self, r):
+        self.assertEqual(202, r.status_code, r.get_data(as_text=True))
+
+        job = r.json
+        url = '/service/jobs/{}'.format(job['uuid'])
+
+        self.assertEqual(url, r.headers['Location'].split('localhost')[-1])
+        self.assertEqual('queued', job['state'])
+
+        for i in range(100):
+            job = self.assertRequest(url)
+
+            if job['state'] in jobs.FINISHED_STATES:
+                return job
+
+            time.sleep(0.05)
+
+        self.fail('job never finished')
+
+    @util.mock()
+    def test_failure(self, m):
+        orgid = '00000000-0000-0000-0000-000000000000'
+        unitid = '00000000-0000-0000-0000-000000000001'
+        userid = '00000000-0000-0000-0000-000000000002'
+
+        mock_units_and_employees(m, orgid)
+
+        req = {
+            'type': 'engagement',
+            'org_unit': {'uuid': unitid},
+            'person': {'uuid': userid},
+            'engagement_type': {'uuid': orgid},
+            'validity': {
+                'from': '2018-01-01',
+                'to': None,
+            },
+        }
+
+        with self.subTest('validation'):
+            # invalid requests fail immediately
+            self.assertRequestResponse(
+                '/service/details/create?async=1',
+                {
+                    'description': 'Unknown role type.',
+                    'error': True,
+                    'error_key': 'E_UNKNOWN_ROLE_TYPE',
+                    'status': 400,
+                    'types': ['kaflaflibob'],
+                },
+                json=[dict(req, type='kaflaflibob')],
+                status_code=400,
+            )
+
+        m.post('http://mox/organisation/organisationfunktion',
+               status_code=500, json={'message': 'kaflaflibob'})
+
+        job = self.wait_for(self.client.post(
+            '/service/details/create?async=1',
+            data=json.dumps([req]),
+            content_type='application/json',
+        ))
+
+        self.assertEqual('create_details', job['kind'])
+        self.assertEqual('failed', job['state'])
+        self.assertIsNone(job['result'])
+        self.assertEqual(500, job['error']['status'])
+        self.assertIsNotNone(job['started'])
+        self.assertIsNotNone(job['finished'])
+
+    @util.mock()
+    def test_bulk(self, m):
+        orgid = '00000000-0000-0000-0000-000000000000'
+        unitid = '00000000-0000-0000-0000-000000000001'
+        userid = '00000000-0000-0000-0000-000000000002'
+        engagementid = '00000000-0000-0000-0000-000000000003'
+
+        mock_units_and_employees(m, orgid)
+
+        m.put(
+            re.compile('http://mox/organisation/organisationfunktion/'),
+            json=lambda request, context: {
+                'uuid': request.path.rsplit('/', 1)[-1],
+            },
+        )
+
+        lines = [
+            json.dumps({
+                'type': 'engagement',
+                'uuid': engagementid,
+                'org_unit': {'uuid': unitid},
+                'person': {'uuid': userid},
+                'engagement_type': {'uuid': orgid},
+                'validity': {
+                    'from': '2018-01-01',
+                    'to': None,
+                },
+            }),
+            '{"type": "kaflaflibob"}',
+        ]
+
+        job = self.wait_for(self.client.post(
+            '/service/details/bulk/create?async=1',
+            data='\n'.join(lines).encode(),
+            content_type='application/x-ndjson',
+        ))
+
+        self.assertEqual('bulk_create', job['kind'])
+        self.assertEqual('done', job['state'])
+        self.assertEqual({'done': 2, 'total': 2}, job['progress'])
+        self.assertIsNone(job['error'])
+        self.assertEqual(
+            [
+                {
+                    'line': 1,
+                    'uuid': engagementid,
+                },
+                {
+                    'line': 2,
+                    'description': 'Unknown role type.',
+                    'error': True,
+                    'error_key': 'E_UNKNOWN_ROLE_TYPE',
+                    'status': 400,
+                    'type': 'kaflaflibob',
+                },
+            ],
+            job['result'],
+        )
+
+    @util.mock()
+    def test_auth(self, m):
+        orgid = '00000000-0000-0000-0000-000000000000'
+        unitid = '00000000-0000-0000-0000-000000000001'
+        userid = '00000000-0000-0000-0000-000000000002'
+        engagementid = '00000000-0000-0000-0000-000000000003'
+
+        mock_units_and_employees(m, orgid)
+
+        m.put(
+            'http://mox/organisation/organisationfunktion/' + engagementid,
+            json={'uuid': engagementid},
+        )
+
+        with self.client.session_transaction() as sess:
+            sess['MO-Token'] = 'kaflaflibob'
+
+        job = self.wait_for(self.client.post(
+            '/service/details/create?async=1',
+            data=json.dumps([{
+                'type': 'engagement',
+                'uuid': engagementid,
+                'org_unit': {'uuid': unitid},
+                'person': {'uuid': userid},
+                'engagement_type': {'uuid': orgid},
+                'validity': {
+                    'from': '2018-01-01',
+                    'to': None,
+                },
+            }]),
+            content_type='application/json',
+        ))
+
+        self.assertEqual('done', job['state'], job['error'])
+
+        # the job writes on behalf of the user
+        (write,) = [req for req in m.request_history if req.method == 'PUT']
+
+        self.assertEqual('kaflaflibob', write.headers.get('Authorization'))
+
+        with self.subTest('unsaved session'):
+            m.reset_mock()
+
+            with self.app.test_request_context():
+                flask.session['MO-Token'] = 'kaflaflibob'
+
+                job = jobs.enqueue(
+                    'kaflaflibob',
+                    lambda: lora.Connector().bruger.get(userid)['tilstande'],
+                )
+
+            for i in range(100):
+                job = jobs.get_store().get(job['uuid'])
+
+                if job['state'] in jobs.FINISHED_STATES:
+                    break
+
+                time.sleep(0.05)
+
+            self.assertEqual('done', job['state'], job['error'])
+            self.assertEqual(
+                ['kaflaflibob'],
+                [req.headers.get('Authorization')
+                 for req in m.request_history],
+            )
+
+    @util.mock()
+    def test_terminate_missing(self, m):
+        userid = '00000000-0000-0000-0000-000000000000'
+
+        m.get(re.compile('http://mox/organisation/bruger'),
+              json={'results': []})
+
+        # checks happen prior to responding, even when asynchronous
+        self.assertRequestResponse(
+            '/service/e/{}/terminate?async=1'.format(userid),
+            {
+                'description': 'Not found.',
+                'error': True,
+                'error_key': 'E_NOT_FOUND',
+                'path': 'organisation/bruger',
+                'status': 404,
+                'uuid': userid,
+            },
+            json={
+                'validity': {
+                    'to': '2018-01-01',
+                },
+            },
+            status_code=404,
+        )
+
+    def test_not_found(self):
+        self.assertRequestResponse(
+            '/service/jobs/00000000-0000-0000-0000-000000000000',
+            {
+                'description': 'Job not found.',
+                'error': True,
+                'error_key': 'E_JOB_NOT_FOUND',
+                'job_uuid': '00000000-0000-0000-0000-000000000000',
+                'status': 404,
+            },
+            status_code=404,
+        )
+
+    def test_database(self):
+        job = self.wait_for(self.client.post(
+            '/service/details/create?async=1',
+            data=json.dumps([]),
+            content_type='application/json',
+        ))
+
+        self.assertEqual('done', job['state'])
+        self.assertEqual([], job['result'])
+
+        # another process sees the job
+        self.assertEqual(job, jobs.SQLiteStore(self.filename).get(job['uuid']))
+
+        with self.subTest('interrupted'):
+            store = jobs.get_store()
+            store.put(dict(job, state='running'))
+
+            proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+            proc.wait()
+
+            with sqlite3.connect(self.filename) as conn:
+                conn.execute('UPDATE jobs SET pid = ? WHERE uuid = ?',
+                             (proc.pid, job['uuid']))
+
+            job = store.get(job['uuid'])
+
+            self.assertEqual('failed', job['state'])
+            self.assertEqual('job interrupted', job['error']['description'])
+
+        with self.subTest('default'):
+            with util.override_settings(JOB_DATABASE=None):
+                self.assertIn('mora-jobs', jobs.get_store().filename)
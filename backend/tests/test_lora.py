@@ -6,6 +6,9 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import threading
+
+import flask
 import freezegun
 
 from mora import exceptions
@@ -550,3 +553,531 @@ class Tests(util.TestCase):
                 )
             ],
         )
+
+    def test_get_all_concurrently(self, m):
+        uuids = [
+            '{:08x}-0000-0000-0000-000000000000'.format(i)
+            for i in range(1000)
+        ]
+
+        m.get(
+            'http://mox/organisation/bruger',
+            json=lambda request, context: {
+                'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [{'objid': objid}],
+                    }
+                    for objid in request.qs['uuid']
+                ]],
+            },
+        )
+
+        for workers in (1, 4):
+            with self.subTest(workers), \
+                    util.override_settings(LORA_CONCURRENCY=workers):
+                m.reset_mock()
+
+                c = lora.Connector()
+
+                self.assertEqual(
+                    [(objid, {'objid': objid}) for objid in uuids],
+                    list(c.bruger.get_all(uuid=uuids)),
+                )
+
+                self.assertEqual(11, m.call_count)
+
+    def test_get_all_concurrently_auth(self, m):
+        uuids = [
+            '{:08x}-0000-0000-0000-000000000000'.format(i)
+            for i in range(500)
+        ]
+
+        m.get(
+            'http://mox/organisation/bruger',
+            json=lambda request, context: {
+                'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [{'objid': objid}],
+                    }
+                    for objid in request.qs['uuid']
+                ]],
+            },
+        )
+
+        with self.app.test_request_context(), \
+                util.override_settings(LORA_CONCURRENCY=4):
+            flask.session['MO-Token'] = 'kaflaflibob'
+
+            self.assertEqual(
+                len(uuids),
+                len(list(lora.Connector().bruger.get_all(uuid=uuids))),
+            )
+
+        # every chunk acts on behalf of the user
+        self.assertEqual(
+            ['kaflaflibob'] * 6,
+            [req.headers.get('Authorization') for req in m.request_history],
+        )
+
+    def test_semaphore(self, m):
+        m.get('http://mox/organisation/bruger', json={'results': [[]]})
+
+        with util.override_settings(LORA_CONCURRENCY=2):
+            c = lora.Connector()
+
+        # occupy both slots, so that requests must wait for them
+        c.semaphore.acquire()
+        c.semaphore.acquire()
+
+        thread = threading.Thread(target=c.bruger.fetch)
+        thread.start()
+        thread.join(0.1)
+
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(0, m.call_count)
+
+        c.semaphore.release()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, m.call_count)
+
+        c.semaphore.release()
+
+    def test_map_concurrently(self, m):
+        # each call blocks until all workers are running at once
+        barrier = threading.Barrier(4, timeout=5)
+
+        def func(v):
+            barrier.wait()
+            return v * 2
+
+        with util.override_settings(LORA_CONCURRENCY=4):
+            self.assertEqual(
+                [0, 2, 4, 6, 8, 10, 12, 14],
+                list(lora.map_concurrently(func, range(8))),
+            )
+
+        with util.override_settings(LORA_CONCURRENCY=1):
+            self.assertEqual(
+                [0, 2, 4],
+                list(lora.map_concurrently(lambda v: v * 2, range(3))),
+            )
+
+    def test_identity_map(self, m):
+        objid = '00000000-0000-0000-0000-000000000000'
+        otherid = '00000000-0000-0000-0000-000000000001'
+
+        m.get(
+            'http://mox/organisation/organisationenhed',
+            json=lambda request, context: {
+                'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [{'objid': objid}],
+                    }
+                    for objid in request.qs['uuid']
+                ]],
+            },
+        )
+        m.patch(
+            'http://mox/organisation/organisationenhed/' + objid,
+            json={'uuid': objid},
+        )
+
+        c = lora.Connector()
+
+        with self.subTest('get'):
+            self.assertEqual({'objid': objid}, c.organisationenhed.get(objid))
+            self.assertEqual({'objid': objid}, c.organisationenhed.get(objid))
+
+            self.assertEqual(1, m.call_count)
+            self.assertEqual({'hits': 1, 'misses': 1}, c.counters)
+
+        with self.subTest('different parameters'):
+            c.organisationenhed.get(objid, virkningfra='-infinity')
+
+            self.assertEqual(2, m.call_count)
+            self.assertEqual({'hits': 1, 'misses': 2}, c.counters)
+
+        with self.subTest('get_all'):
+            self.assertEqual(
+                [
+                    (objid, {'objid': objid}),
+                    (otherid, {'objid': otherid}),
+                ],
+                list(c.organisationenhed.get_all(uuid=[objid, otherid])),
+            )
+
+            self.assertEqual(3, m.call_count)
+            self.assertEqual(['00000000-0000-0000-0000-000000000001'],
+                             m.last_request.qs['uuid'])
+            self.assertEqual({'hits': 2, 'misses': 3}, c.counters)
+
+            c.organisationenhed.get(otherid)
+
+            self.assertEqual(3, m.call_count)
+            self.assertEqual({'hits': 3, 'misses': 3}, c.counters)
+
+        with self.subTest('update'):
+            c.organisationenhed.update({}, objid)
+            c.organisationenhed.get(objid)
+
+            self.assertEqual(5, m.call_count)
+            self.assertEqual({'hits': 3, 'misses': 4}, c.counters)
+
+        with self.subTest('other connector'):
+            lora.Connector().organisationenhed.get(otherid)
+
+            self.assertEqual(6, m.call_count)
+
+        with self.subTest('locking'):
+            # concurrent lookups may be filling the identity map, so
+            # forgetting an object must wait for them
+            c.lock.acquire()
+
+            thread = threading.Thread(
+                target=c.organisationenhed._forget,
+                args=(otherid,),
+            )
+            thread.start()
+            thread.join(0.1)
+
+            self.assertTrue(thread.is_alive())
+
+            c.lock.release()
+            thread.join(5)
+
+            self.assertFalse(thread.is_alive())
+
+            c.organisationenhed.get(otherid)
+
+            self.assertEqual(7, m.call_count)
+
+    def test_classification_cache(self, m):
+        classid = '00000000-0000-0000-0000-000000000000'
+        otherid = '00000000-0000-0000-0000-000000000001'
+
+        def make_class(objid):
+            return {
+                'attributter': {
+                    'klasseegenskaber': [
+                        {
+                            'brugervendtnoegle': 'old',
+                            'virkning': {
+                                'from': '2000-01-01 00:00:00+01',
+                                'to': '2010-01-01 00:00:00+01',
+                            },
+                        },
+                        {
+                            'brugervendtnoegle': 'new',
+                            'virkning': {
+                                'from': '2010-01-01 00:00:00+01',
+                                'to': 'infinity',
+                            },
+                        },
+                    ],
+                },
+                'tilstande': {
+                    'klassepubliceret': [
+                        {
+                            'publiceret': 'Publiceret',
+                            'virkning': {
+                                'from': '2000-01-01 00:00:00+01',
+                                'to': '2001-01-01 00:00:00+01',
+                            },
+                        },
+                    ],
+                },
+            }
+
+        m.get(
+            'http://mox/klassifikation/klasse',
+            json=lambda request, context: {
+                'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [make_class(objid)],
+                    }
+                    for objid in request.qs['uuid']
+                ]],
+            },
+        )
+        m.patch(
+            'http://mox/klassifikation/klasse/' + classid,
+            json={'uuid': classid},
+        )
+
+        with util.patch.object(lora.classification_cache, 'ttl', 60):
+            with self.subTest('get'):
+                self.assertEqual(
+                    {
+                        'attributter': {
+                            'klasseegenskaber': [
+                                {
+                                    'brugervendtnoegle': 'new',
+                                    'virkning': {
+                                        'from': '2010-01-01 00:00:00+01',
+                                        'to': 'infinity',
+                                    },
+                                },
+                            ],
+                        },
+                        'tilstande': {},
+                    },
+                    lora.Connector().klasse.get(classid),
+                )
+
+                self.assertEqual(1, m.call_count)
+                self.assertEqual(['-infinity'],
+                                 m.last_request.qs['virkningfra'])
+                self.assertEqual(['infinity'],
+                                 m.last_request.qs['virkningtil'])
+
+            with self.subTest('other connector'):
+                c = lora.Connector(effective_date='2000-06-01')
+
+                expected = make_class(classid)
+                del expected['attributter']['klasseegenskaber'][1]
+
+                self.assertEqual(expected, c.klasse.get(classid))
+
+                self.assertEqual(1, m.call_count)
+
+            with self.subTest('get_all'):
+                self.assertEqual(
+                    [classid, otherid],
+                    [
+                        objid
+                        for objid, obj in lora.Connector().klasse.get_all(
+                            uuid=[classid, otherid],
+                        )
+                    ],
+                )
+
+                self.assertEqual(2, m.call_count)
+                self.assertEqual([otherid], m.last_request.qs['uuid'])
+
+            with self.subTest('update'):
+                lora.Connector().klasse.update({}, classid)
+                lora.Connector().klasse.get(classid)
+                lora.Connector().klasse.get(otherid)
+
+                self.assertEqual(4, m.call_count)
+
+            with self.subTest('other parameters'):
+                lora.Connector().klasse.get(classid, registreretfra='now')
+
+                self.assertEqual(5, m.call_count)
+                self.assertEqual(['2010-06-01t02:00:00+02:00'],
+                                 m.last_request.qs['virkningfra'])
+
+    def test_prefetch(self, m):
+        unitid = '00000000-0000-0000-0000-000000000000'
+        missingid = '00000000-0000-0000-0000-000000000001'
+
+        unit = {
+            'attributter': {
+                'organisationenhedegenskaber': [
+                    {
+                        'enhedsnavn': 'old',
+                        'virkning': {
+                            'from': '2000-01-01 00:00:00+01',
+                            'to': '2010-01-01 00:00:00+01',
+                        },
+                    },
+                    {
+                        'enhedsnavn': 'new',
+                        'virkning': {
+                            'from': '2010-01-01 00:00:00+01',
+                            'to': 'infinity',
+                        },
+                    },
+                ],
+            },
+        }
+
+        m.get(
+            'http://mox/organisation/organisationenhed',
+            json=lambda request, context: {
+                'results': [[
+                    {
+                        'id': objid,
+                        'registreringer': [unit],
+                    }
+                    for objid in request.qs['uuid']
+                    if objid == unitid
+                ]],
+            },
+        )
+        m.patch(
+            'http://mox/organisation/organisationenhed/' + unitid,
+            json={'uuid': unitid},
+        )
+
+        lora.prefetch({'organisationenhed': [unitid, missingid]})
+
+        self.assertEqual(1, m.call_count)
+        self.assertEqual(['-infinity'], m.last_request.qs['virkningfra'])
+        self.assertEqual(['infinity'], m.last_request.qs['virkningtil'])
+
+        with self.subTest('get'):
+            self.assertEqual(
+                {
+                    'attributter': {
+                        'organisationenhedegenskaber': [
+                            unit['attributter'][
+                                'organisationenhedegenskaber'
+                            ][1],
+                        ],
+                    },
+                },
+                lora.Connector().organisationenhed.get(unitid),
+            )
+            self.assertEqual(
+                unit,
+                lora.Connector(
+                    virkningfra='-infinity',
+                    virkningtil='infinity',
+                ).organisationenhed.get(unitid),
+            )
+            self.assertIsNone(
+                lora.Connector().organisationenhed.get(missingid),
+            )
+
+            self.assertEqual(1, m.call_count)
+
+        with self.subTest('get_all'):
+            self.assertEqual(
+                [unitid],
+                [
+                    objid
+                    for objid, obj in lora.Connector(
+                        effective_date='2005-01-01',
+                    ).organisationenhed.get_all(
+                        uuid=[unitid, missingid],
+                    )
+                ],
+            )
+
+            self.assertEqual(1, m.call_count)
+
+        with self.subTest('again'):
+            lora.prefetch({'organisationenhed': [unitid, missingid]})
+
+            self.assertEqual(1, m.call_count)
+
+        with self.subTest('other parameters'):
+            lora.Connector().organisationenhed.get(
+                unitid, registreretfra='now',
+            )
+
+            self.assertEqual(2, m.call_count)
+
+        with self.subTest('update'):
+            lora.Connector().organisationenhed.update({}, unitid)
+            lora.Connector().organisationenhed.get(unitid)
+
+            self.assertEqual(4, m.call_count)
+
+    def test_paged_get(self, m):
+        uuids = [
+            '{:08x}-0000-0000-0000-000000000000'.format(i)
+            for i in range(10)
+        ]
+
+        def callback(request, context):
+            if 'uuid' in request.qs:
+                return {
+                    'results': [[
+                        {
+                            'id': objid,
+                            'registreringer': [{}],
+                        }
+                        for objid in request.qs['uuid']
+                    ]],
+                }
+            else:
+                return {'results': [uuids]}
+
+        m.get('http://mox/organisation/bruger', json=callback)
+
+        c = lora.Connector()
+
+        self.assertEqual(
+            {
+                'total': 10,
+                'offset': 4,
+                'items': uuids[4:7],
+            },
+            c.bruger.paged_get(lambda c, objid, obj: objid,
+                               start=4, limit=3, bvn='%'),
+        )
+
+        # one search, followed by fetching the page
+        self.assertEqual(2, m.call_count)
+        self.assertEqual(['%'], m.request_history[0].qs['bvn'])
+        self.assertEqual(uuids[4:7], m.request_history[1].qs['uuid'])
+
+    def test_get_effects_overlapping(self, m):
+        def entry(name, start, end):
+            return {
+                'name': name,
+                'virkning': {
+                    'from': '{}-01-01 00:00:00+01'.format(start),
+                    'to': (
+                        '{}-01-01 00:00:00+01'.format(end)
+                        if end else 'infinity'
+                    ),
+                },
+            }
+
+        a = entry('a', 2000, 2010)
+        b = entry('b', 2005, None)
+        p = entry('p', 1990, 2008)
+        q = entry('q', 2008, None)
+
+        reg = {
+            'attributter': {
+                'egenskaber': [b, a],
+            },
+            'relationer': {
+                'overordnet': [p, q],
+            },
+        }
+
+        c = lora.Connector(validity='past', effective_date='2020-01-01')
+
+        self.assertEqual(
+            [
+                (
+                    '2000-01-01', '2005-01-01',
+                    {
+                        'attributter': {'egenskaber': [a]},
+                        'relationer': {'overordnet': [p]},
+                    },
+                ),
+                (
+                    '2005-01-01', '2010-01-01',
+                    {
+                        'attributter': {'egenskaber': [b, a]},
+                        'relationer': {'overordnet': [p, q]},
+                    },
+                ),
+            ],
+            [
+                (start.date().isoformat(), end.date().isoformat(), effect)
+                for start, end, effect in c.organisationenhed.get_effects(
+                    reg,
+                    {
+                        'attributter': ('egenskaber',),
+                    },
+                    {
+                        'attributter': ('egenskaber', 'missing'),
+                        'relationer': ('overordnet',),
+                    },
+                )
+            ],
+        )
@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2017-2018, Magenta ApS
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from unittest import mock
+
+from mora import metrics
+from mora.service import address
+
+from . import util
+
+
+class Tests(util.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        for metric in metrics._registry.values():
+            metric.clear()
+
+    def test_histogram(self):
+        with mock.patch.dict(metrics._registry):
+            histogram = metrics.Histogram(
+                'test_duration_seconds', 'Test duration.', ('kind',),
+                buckets=(0.1, 1.0),
+            )
+
+        histogram.observe(0.05, kind='a')
+        histogram.observe(0.1, kind='a')
+        histogram.observe(5, kind='a')
+        histogram.observe(0.5, kind='"b"')
+
+        self.assertEqual(
+            [
+                '# HELP test_duration_seconds Test duration.',
+                '# TYPE test_duration_seconds histogram',
+                'test_duration_seconds_bucket{kind="\\"b\\"",le="0.1"} 0',
+                'test_duration_seconds_bucket{kind="\\"b\\"",le="1"} 1',
+                'test_duration_seconds_bucket{kind="\\"b\\"",le="+Inf"} 1',
+                'test_duration_seconds_sum{kind="\\"b\\""} 0.5',
+                'test_duration_seconds_count{kind="\\"b\\""} 1',
+                'test_duration_seconds_bucket{kind="a",le="0.1"} 2',
+                'test_duration_seconds_bucket{kind="a",le="1"} 2',
+                'test_duration_seconds_bucket{kind="a",le="+Inf"} 3',
+                'test_duration_seconds_sum{kind="a"} 5.15',
+                'test_duration_seconds_count{kind="a"} 3',
+            ],
+            list(histogram.expose()),
+        )
+
+        with self.assertRaises(ValueError):
+            histogram.observe(1)
+
+    @util.mock()
+    def test_metrics(self, m):
+        m.get('http://mox/organisation/organisation', json={'results': [[]]})
+        m.get('https://dawa.aws.dk/adresser', json=[])
+
+        self.client.get('/service/o/')
+        address.session.get('https://dawa.aws.dk/adresser')
+
+        with mock.patch.dict(metrics._caches, clear=True):
+            metrics.register_cache('test', lambda: (3, 1))
+
+            r = self.client.get('/service/metrics')
+
+        self.assert200(r)
+        self.assertEqual('text/plain; version=0.0.4', r.content_type)
+
+        lines = r.get_data(as_text=True).splitlines()
+
+        for expected in (
+            'mora_request_duration_seconds_count'
+            '{endpoint="organisation.list_organisations",'
+            'method="GET",status="200"} 1',
+            'mora_lora_request_duration_seconds_count'
+            '{path="organisation/organisation",method="GET"} 1',
+            'mora_dawa_request_duration_seconds_count'
+            '{endpoint="adresser",status="200"} 1',
+            'mora_cache_hits_total{cache="test"} 3',
+            'mora_cache_misses_total{cache="test"} 1',
+            'mora_cache_hit_ratio{cache="test"} 0.75',
+        ):
+            self.assertIn(expected, lines)
+
+    @util.mock()
+    def test_identity_map_stats(self, m):
+        orgid = '00000000-0000-0000-0000-000000000000'
+
+        m.get(
+            'http://mox/organisation/organisation',
+            json=lambda request, context: {
+                'results': [
+                    [{'id': orgid, 'registreringer': [{}]}]
+                    if 'uuid' in request.qs
+                    else [orgid]
+                ],
+            },
+        )
+        m.get('http://mox/organisation/organisationenhed',
+              json={'results': [[]]})
+
+        get_stats = metrics._caches['identity_map']
+        hits, misses = get_stats()
+
+        self.client.get('/service/o/')
+
+        self.assertEqual((hits, misses + 1), get_stats())
@@ -6,10 +6,17 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+import os
+import re
+import tempfile
+import uuid
+from unittest import mock
+
 import freezegun
 
 from mora import exceptions
 from mora import lora
+from mora import util as mora_util
 from mora.service import address
 
 from tests import util
@@ -246,6 +253,95 @@ class TestAddressLookup(util.TestCase):
             [],
         )
 
+    @util.mock()
+    def test_autocomplete_cache(self, m):
+        texts = {
+            'adgangsadresser': [
+                'Nordre Frihavnsgade 2, 2100 K\u00f8benhavn \u00d8',
+                'Nordre Ringgade 1, 8000 Aarhus C',
+            ],
+            'adresser': [
+                'Nordre Ringgade 1, 1. th, 8000 Aarhus C',
+            ] + [
+                'Vestergade {}, 8000 Aarhus C'.format(i)
+                for i in range(1, 21)
+            ],
+        }
+
+        def dawa_autocomplete(request, context):
+            addrtype = request.path.split('/')[1]
+            key = addrtype[:-1]
+            q = ' '.join(request.qs['q'][0].split())
+
+            return [
+                {
+                    'tekst': text,
+                    key: {
+                        'id': str(uuid.uuid5(uuid.NAMESPACE_URL, text)),
+                    },
+                }
+                for text in texts[addrtype]
+                if text.lower().startswith(q)
+            ][:int(request.qs['per_side'][0])]
+
+        m.get(re.compile('^https://dawa.aws.dk/.*/autocomplete'),
+              json=dawa_autocomplete)
+
+        def autocomplete(q):
+            m.reset_mock()
+
+            r = self.assertRequest(
+                '/service/o/456362c4-0ee4-4e5e-a72c-751239745e62/'
+                'address_autocomplete/?global=1&q=' + q,
+            )
+
+            return [addr['location']['name'] for addr in r], m.call_count
+
+        with mock.patch.object(address.autocomplete_cache, 'ttl', 60):
+            self.assertEqual(
+                (
+                    [
+                        'Nordre Frihavnsgade 2, 2100 K\u00f8benhavn \u00d8',
+                        'Nordre Ringgade 1, 8000 Aarhus C',
+                        'Nordre Ringgade 1, 1. th, 8000 Aarhus C',
+                    ],
+                    2,
+                ),
+                autocomplete('Nordre'),
+            )
+
+            # the results above were complete, so narrow them down
+            self.assertEqual(
+                (
+                    [
+                        'Nordre Ringgade 1, 8000 Aarhus C',
+                        'Nordre Ringgade 1, 1. th, 8000 Aarhus C',
+                    ],
+                    0,
+                ),
+                autocomplete('Nordre+Ri'),
+            )
+
+            self.assertEqual(([], 0), autocomplete('Nordre+Rix'))
+
+            # these were truncated, so we must ask again
+            names, calls = autocomplete('Vestergade')
+
+            self.assertEqual(10, len(names))
+            self.assertEqual(2, calls)
+
+            names, calls = autocomplete('Vestergade+2')
+
+            self.assertEqual(
+                ['Vestergade 2, 8000 Aarhus C',
+                 'Vestergade 20, 8000 Aarhus C'],
+                names,
+            )
+            self.assertEqual(2, calls)
+
+            # but repeating a query is fine
+            self.assertEqual((names, 0), autocomplete('Vestergade+2'))
+
     @util.mock('many-addresses.json')
     def test_many_addresses(self, m):
         addresses = {
@@ -316,6 +412,130 @@ class TestAddressLookup(util.TestCase):
 
                 self.assertEquals(actual, expected)
 
+    @util.mock('many-addresses.json')
+    def test_many_addresses_at_once(self, m):
+        c = lora.Connector()
+        addrrels = [
+            {
+                'objekttype': 'DAR',
+                'uuid': addrid,
+            }
+            for addrid in (
+                '00000000-0000-0000-0000-000000000000',
+                '0a3f507b-6b35-32b8-e044-0003ba298018',
+                '0a3f5081-75bf-32b8-e044-0003ba298018',
+                '0ead9b4d-c615-442d-8447-b328a73b5b39',
+                '2ef51a73-ad7d-4ee7-e044-0003ba298018',
+                'bd7e5317-4a9e-437b-8923-11156406b117',
+            )
+        ]
+
+        expected = [address.get_one_address(c, rel) for rel in addrrels]
+
+        # each endpoint is asked for all the addresses not yet found
+        for batch_size, ncalls in ((50, 4), (2, 7)):
+            with self.subTest(batch_size=batch_size), \
+                    util.override_settings(DAWA_BATCH_SIZE=batch_size):
+                m.reset_mock()
+
+                self.assertEqual(expected,
+                                 address.get_many_addresses(c, addrrels))
+                self.assertEqual(ncalls, m.call_count)
+
+        with self.subTest('batch failure'):
+            # any batch of several addresses fails, but each address
+            # succeeds on its own
+            m.get(re.compile('https://dawa.aws.dk/'), status_code=400,
+                  json={'message': 'kaflaflibob'},
+                  additional_matcher=lambda r: '|' in r.qs['id'][0])
+
+            self.assertEqual(expected,
+                             address.get_many_addresses(c, addrrels))
+
+        with self.subTest('failure'):
+            m.get('https://dawa.aws.dk/adgangsadresser', status_code=500,
+                  json={'message': 'the system is down'})
+
+            tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(tmpdir.cleanup)
+
+            cache = mora_util.PersistentCache(
+                os.path.join(tmpdir.name, 'dawa.db'), maxsize=100, ttl=60,
+            )
+
+            with mock.patch('mora.service.address.dawa_cache', cache):
+                actual = address.get_many_addresses(c, addrrels)
+
+            # failures are not remembered
+            self.assertIsNone(cache.get(addrrels[0]['uuid']))
+
+            self.assertEqual(
+                ['Fejl', 'Fejl', 'Fejl',
+                 'Pilestr\u00e6de 43, 3. th, 1112 K\u00f8benhavn K',
+                 'Hold-An Vej 7, 1., 2750 Ballerup', 'Fejl'],
+                [addr['name'] for addr in actual],
+            )
+
+            self.assertEqual({'message': 'the system is down'},
+                             actual[0]['error'])
+
+    @util.mock('many-addresses.json')
+    def test_cache(self, m):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        cache = mora_util.PersistentCache(
+            os.path.join(tmpdir.name, 'dawa.db'), maxsize=100, ttl=60,
+        )
+
+        def lookup(addrid):
+            m.reset_mock()
+
+            with mock.patch('mora.service.address.dawa_cache', cache):
+                r = address.get_one_address(
+                    lora.Connector(),
+                    {
+                        'objekttype': 'DAR',
+                        'uuid': addrid,
+                    },
+                )
+
+            return r['name'], m.call_count
+
+        historic = 'bd7e5317-4a9e-437b-8923-11156406b117'
+        unknown = '00000000-0000-0000-0000-000000000000'
+
+        with self.subTest('found'):
+            self.assertEqual(('Hold-An Vej 7, 2750 Ballerup', 3),
+                             lookup(historic))
+            self.assertEqual(('Hold-An Vej 7, 2750 Ballerup', 0),
+                             lookup(historic))
+            self.assertEqual('historik/adresser',
+                             cache.get(historic)['endpoint'])
+
+        with self.subTest('expired'):
+            cache.set(historic, cache.get(historic), ttl=-1)
+
+            # the endpoint is remembered
+            self.assertEqual(('Hold-An Vej 7, 2750 Ballerup', 1),
+                             lookup(historic))
+
+        with self.subTest('not found'):
+            self.assertEqual(('Ukendt', 4), lookup(unknown))
+            self.assertEqual(('Ukendt', 0), lookup(unknown))
+
+            with mock.patch('mora.settings.DAWA_CACHE_NEGATIVE_TTL', -1):
+                cache.pop(unknown)
+
+                self.assertEqual(('Ukendt', 4), lookup(unknown))
+                self.assertEqual(('Ukendt', 4), lookup(unknown))
+
+        with self.subTest('shared'):
+            other = mora_util.PersistentCache(cache.filename, 100, 60)
+
+            self.assertEqual('historik/adresser',
+                             other.get(historic)['endpoint'])
+
     @util.mock()
     def test_bad_scope(self, m):
         with self.assertRaisesRegex(exceptions.HTTPException,
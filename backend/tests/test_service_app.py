@@ -39,3 +39,46 @@ class Tests(util.TestCase):
             status_code=500,
             drop_keys=['stacktrace'],
         )
+
+    @util.mock()
+    def test_server_timing(self, m):
+        m.get('http://mox/organisation/organisation', json={'results': [[]]})
+
+        with self.subTest('header'):
+            r = self.client.get('/service/o/')
+
+            self.assert200(r)
+
+            timings = [
+                timing.split(';')
+                for timing in r.headers['Server-Timing'].split(', ')
+            ]
+
+            self.assertEqual(
+                ['app', 'lora', 'lora-json', 'lora.organisation.organisation'],
+                [timing[0] for timing in timings],
+            )
+            self.assertEqual('desc="1 calls (17 bytes)"', timings[1][2])
+            self.assertEqual('desc="1 calls (17 bytes)"', timings[3][2])
+
+        with self.subTest('slow request'), \
+                mock.patch.dict(self.app.config,
+                                SLOW_REQUEST_THRESHOLD=1e-9), \
+                self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/service/o/?at=2018-01-01')
+
+            (message,) = logs.output
+
+            self.assertRegex(
+                message,
+                r'slow request: GET /service/o/\?at=2018-01-01 took '
+                r'[0-9.]+s with 1 LoRA calls taking [0-9.]+s; '
+                r'the slowest were:\n'
+                r'  [0-9.]+s GET organisation/organisation -> 200, 17 bytes, '
+                r'[0-9.]+s decoding$',
+            )
+
+        with self.subTest('no calls'):
+            r = self.client.get('/service/kaflaflibob')
+
+            self.assertRegex(r.headers['Server-Timing'], r'^app;dur=[0-9.]+$')
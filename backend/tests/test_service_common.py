@@ -1843,3 +1843,121 @@ class TestClass(util.TestCase):
                 'uuid': userid,
             }
         )
+
+    @freezegun.freeze_time('2018-01-01')
+    @util.mock()
+    def test_history(self, mock):
+        userid = '00000000-0000-0000-0000-000000000000'
+
+        def virkning(start, end, note=None):
+            d = {
+                'from': start,
+                'to': end,
+                'from_included': True,
+                'to_included': False,
+            }
+
+            if note:
+                d['notetekst'] = note
+
+            return d
+
+        obj = {
+            'tilstande': {
+                'brugergyldighed': [
+                    {
+                        'gyldighed': 'Aktiv',
+                        'virkning': virkning('2017-01-01 00:00:00+01',
+                                             'infinity'),
+                    },
+                ],
+                'brugerpublicering': [
+                    {
+                        'publiceret': 'Publiceret',
+                        'virkning': virkning('2017-01-01 00:00:00+01',
+                                             'infinity'),
+                    },
+                ],
+            },
+        }
+
+        mock.get(
+            'http://mox/organisation/bruger'
+            '?uuid=' + userid +
+            '&virkningtil=2018-01-01T00%3A00%3A00.000001%2B01%3A00'
+            '&virkningfra=2018-01-01T00%3A00%3A00%2B01%3A00',
+            json={
+                'results': [[{
+                    'id': userid,
+                    'registreringer': [obj],
+                }]],
+            },
+        )
+
+        mock.patch(
+            'http://mox/organisation/bruger/' + userid,
+            json={
+                'uuid': userid,
+            },
+        )
+
+        for reuse in (False, True):
+            with self.subTest(reuse=reuse):
+                mock.reset_mock()
+
+                common.add_history_entry(
+                    lora.Connector().bruger,
+                    userid,
+                    'kaflaflibob',
+                    obj if reuse else None,
+                )
+
+                self.assertEqual(
+                    ['PATCH'] if reuse else ['GET', 'PATCH'],
+                    [req.method for req in mock.request_history],
+                )
+
+                # we only touch a single state
+                payload = mock.request_history[-1].json()
+                note = payload['tilstande']['brugergyldighed'][0][
+                    'virkning'].pop('notetekst')
+
+                self.assertEqual(
+                    {
+                        'note': 'kaflaflibob',
+                        'tilstande': {
+                            'brugergyldighed': [
+                                {
+                                    'gyldighed': 'Aktiv',
+                                    'virkning': virkning(
+                                        '2017-01-01 00:00:00+01',
+                                        'infinity',
+                                    ),
+                                },
+                            ],
+                        },
+                    },
+                    payload,
+                )
+
+                self.assertEqual(36, len(note))
+
+        # without any entries of states, we send them as they are
+        for tilstande in ({}, {'brugergyldighed': []}):
+            with self.subTest(tilstande=tilstande):
+                mock.reset_mock()
+
+                common.add_history_entry(
+                    lora.Connector().bruger,
+                    userid,
+                    'kaflaflibob',
+                    {'tilstande': tilstande},
+                )
+
+                self.assertEqual(
+                    {
+                        'note': 'kaflaflibob',
+                        'tilstande': tilstande,
+                    },
+                    mock.request_history[-1].json(),
+                )
@@ -6,8 +6,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 
+from unittest import mock
+
 import freezegun
 
+from mora import hierarchy
 from tests import util
 
 
@@ -155,3 +158,252 @@ class TestAddressLookup(util.TestCase):
             '/service/ou/' + unitid + '/details/org_unit?validity=past',
             [],
         )
+
+
+@freezegun.freeze_time('2018-03-15')
+class TestChildren(util.TestCase):
+    orgid = '00000000-0000-0000-0000-000000000000'
+    parentid = '00000000-0000-0000-0000-000000000001'
+
+    def make_units(self, nchildren, nunits):
+        '''Create a parent with the given amount of children, each
+        having between zero and three children themselves, followed by
+        unrelated units until we have the given total.'''
+        units = {}
+
+        def add(parentid):
+            unitid = '{:08x}-0000-0000-0000-000000000000'.format(len(units))
+
+            units[unitid] = {
+                'attributter': {
+                    'organisationenhedegenskaber': [{
+                        'brugervendtnoegle': unitid,
+                        'enhedsnavn': unitid,
+                        'virkning': {
+                            'from': '2017-01-01 00:00:00+01',
+                            'to': 'infinity',
+                        },
+                    }],
+                },
+                'tilstande': {
+                    'organisationenhedgyldighed': [{
+                        'gyldighed': 'Aktiv',
+                        'virkning': {
+                            'from': '2017-01-01 00:00:00+01',
+                            'to': 'infinity',
+                        },
+                    }],
+                },
+                'relationer': {
+                    'overordnet': [{'uuid': parentid}],
+                    'tilhoerer': [{'uuid': self.orgid}],
+                },
+            }
+
+            return unitid
+
+        units[self.parentid] = units.pop(add(self.orgid))
+
+        children = [add(self.parentid) for i in range(nchildren)]
+
+        expected = []
+
+        for i, childid in enumerate(children):
+            for j in range(i % 4):
+                add(childid)
+
+            expected.append((childid, i % 4))
+
+        while len(units) < nunits:
+            add(self.orgid)
+
+        return units, expected
+
+    def mock_units(self, m, units):
+        def callback(request, context):
+            if 'uuid' in request.qs:
+                return {'results': [[
+                    {
+                        'id': unitid,
+                        'registreringer': [units[unitid]],
+                    }
+                    for unitid in request.qs['uuid']
+                ]]}
+
+            elif 'overordnet' in request.qs:
+                (parentid,) = request.qs['overordnet']
+
+                return {'results': [[
+                    unitid
+                    for unitid, unit in units.items()
+                    if unit['relationer']['overordnet'][0]['uuid'] ==
+                    parentid
+                ]]}
+
+            else:
+                self.assertEqual([self.orgid], request.qs['tilhoerer'])
+
+                return {'results': [list(units)]}
+
+        m.get('http://mox/organisation/organisationenhed', json=callback)
+
+    def get_child_counts(self):
+        return [
+            (child['uuid'], child['child_count'])
+            for child in self.assertRequest(
+                '/service/ou/{}/children'.format(self.parentid),
+            )
+        ]
+
+    @util.mock()
+    def test_wide(self, m):
+        units, expected = self.make_units(nchildren=60, nunits=150)
+        self.mock_units(m, units)
+
+        self.assertEqual(expected, self.get_child_counts())
+
+        # the parent, a search and fetch of its children, the units
+        # in the organisation, and then those we didn't already load
+        self.assertEqual(5, m.call_count)
+
+    @util.mock()
+    def test_narrow(self, m):
+        units, expected = self.make_units(nchildren=3, nunits=1000)
+        self.mock_units(m, units)
+
+        self.assertEqual(expected, self.get_child_counts())
+
+        # the parent, a search and fetch of its children, and then a
+        # search for each child -- there are too few of them for
+        # searching the organisation to pay off
+        self.assertEqual(6, m.call_count)
+
+    @util.mock()
+    def test_single(self, m):
+        units, expected = self.make_units(nchildren=1, nunits=10)
+        self.mock_units(m, units)
+
+        self.assertEqual(expected, self.get_child_counts())
+
+        # the parent, a search and fetch of its child, and then a
+        # search for its children
+        self.assertEqual(4, m.call_count)
+
+    def get_tree(self, units, unitid, **params):
+        def get_node(childid):
+            children = [
+                get_node(grandchildid)
+                for grandchildid, grandchild in sorted(units.items())
+                if grandchild['relationer']['overordnet'][0]['uuid'] ==
+                childid
+            ]
+
+            return (childid, len(children), children)
+
+        return get_node(unitid)[2]
+
+    def check_tree(self, m, nunits):
+        units, expected = self.make_units(nchildren=5, nunits=nunits)
+        self.mock_units(m, units)
+
+        def get_tree(nodes):
+            return [
+                (
+                    node['uuid'],
+                    node['child_count'],
+                    get_tree(node['children']),
+                )
+                for node in nodes
+            ]
+
+        self.assertEqual(
+            self.get_tree(units, self.parentid),
+            get_tree(self.assertRequest(
+                '/service/ou/{}/tree'.format(self.parentid),
+            )),
+        )
+
+    @util.mock()
+    def test_tree(self, m):
+        with util.override_settings(LORA_CONCURRENCY=2):
+            self.check_tree(m, nunits=20)
+
+        # the parent and its children, and then the organisation
+        self.assertEqual(1 + 2 + 2, m.call_count)
+
+    @util.mock()
+    def test_tree_narrow(self, m):
+        self.check_tree(m, nunits=1000)
+
+        # the parent and its children, a search per child and a fetch
+        # of the grandchildren, and then the units in the organisation,
+        # as the grandchildren outnumber the parallel searches, and a
+        # search per grandchild
+        self.assertEqual(1 + 2 + 6 + 1 + 6, m.call_count)
+
+        with self.subTest('known size'):
+            m.reset_mock()
+
+            self.check_tree(m, nunits=1000)
+
+            # we now know that the organisation is too large to load
+            self.assertEqual(1 + 2 + 6 + 6, m.call_count)
+
+    @util.mock()
+    def test_tree_depth(self, m):
+        units, expected = self.make_units(nchildren=5, nunits=20)
+        self.mock_units(m, units)
+
+        r = self.assertRequest(
+            '/service/ou/{}/tree?depth=1'.format(self.parentid),
+        )
+
+        self.assertEqual(
+            expected,
+            [(node['uuid'], node['child_count']) for node in r],
+        )
+        self.assertNotIn('children', r[0])
+
+        for depth in ('0', 'x'):
+            self.assertRequestResponse(
+                '/service/ou/{}/tree?depth={}'.format(self.parentid, depth),
+                {
+                    'description': 'depth must be a positive integer',
+                    'error': True,
+                    'error_key': 'E_INVALID_INPUT',
+                    'status': 400,
+                },
+                status_code=400,
+            )
+
+    @util.mock()
+    def test_tree_indexed(self, m):
+        units, expected = self.make_units(nchildren=5, nunits=20)
+        self.mock_units(m, units)
+
+        with mock.patch.object(hierarchy.cache, 'ttl', 300):
+            r = self.assertRequest(
+                '/service/ou/{}/tree?depth=2'.format(self.parentid),
+            )
+
+        self.assertEqual(
+            [
+                (childid, child_count, [
+                    (grandchildid, 0, [])
+                    for grandchildid, grandchild_count, _ in grandchildren
+                ])
+                for childid, child_count, grandchildren in
+                self.get_tree(units, self.parentid)
+            ],
+            [
+                (node['uuid'], node['child_count'], [
+                    (child['uuid'], child['child_count'],
+                     child.get('children', []))
+                    for child in node['children']
+                ])
+                for node in r
+            ],
+        )
+
+        # the parent and the index, which holds everything else
+        self.assertEqual(3, m.call_count)
@@ -7,7 +7,12 @@
 #
 
 import unittest
+import unittest.mock
+import concurrent.futures
 import datetime
+import os
+import tempfile
+import uuid
 
 import dateutil.tz
 import flask
@@ -92,6 +97,45 @@ class TestUtils(TestCase):
         # test fallback
         self.assertEqual(util.parsedatetime('blyf', 'flaf'), 'flaf')
 
+    def test_parsedatetime_lora(self):
+        tests = {
+            '2017-01-01 00:00:00+01':
+            '2017-01-01T00:00:00+01:00',
+
+            '2017-06-30 22:00:00+00':
+            '2017-07-01T00:00:00+02:00',
+
+            '2017-06-30T22:00:00.5Z':
+            '2017-07-01T00:00:00.500000+02:00',
+
+            '2017-07-01T00:00:00.123456+02:00':
+            '2017-07-01T00:00:00.123456+02:00',
+
+            '2017-07-01 03:30:00-0130':
+            '2017-07-01T07:00:00+02:00',
+
+            '2017-07-01T00:00':
+            '2017-07-01T00:00:00+02:00',
+        }
+
+        for value, expected in tests.items():
+            with self.subTest(value):
+                self.assertEqual(expected,
+                                 util.parsedatetime(value).isoformat())
+
+        # local mean time, as given for dates prior to 1890
+        self.assertEqual(
+            datetime.datetime(1850, 1, 1,
+                              tzinfo=dateutil.tz.tzoffset(None, 3020)),
+            util.parsedatetime('1850-01-01T00:00:00+00:50:20'),
+        )
+
+        # and these are left to the general parser
+        self.assertEqual('2017-07-31T00:00:00+02:00',
+                         util.parsedatetime('31-07-2017').isoformat())
+        self.assertEqual('2017-08-01T00:00:00+02:00',
+                         util.parsedatetime('2017-07-31T24:00').isoformat())
+
     def test_splitlist(self):
         self.assertEqual(
             list(util.splitlist([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 3)),
@@ -755,6 +799,84 @@ class TestUtils(TestCase):
             ctxt.exception.response.json,
         )
 
+    def test_ttl_cache(self):
+        with unittest.mock.patch('time.monotonic', return_value=0):
+            cache = util.TTLCache(maxsize=2, ttl=10)
+
+            cache['a'] = 1
+            cache['b'] = 2
+
+            self.assertEqual(1, cache.get('a'))
+
+            cache['c'] = 3
+
+            self.assertEqual(['a', 'c'], sorted(cache))
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        with unittest.mock.patch('time.monotonic', return_value=10):
+            self.assertNotIn('a', cache)
+            self.assertIsNone(cache.get('c'))
+            self.assertIsNone(cache.pop('a'))
+
+        with self.subTest('disabled'):
+            cache = util.TTLCache(maxsize=2, ttl=0)
+            cache['a'] = 1
+
+            self.assertEqual(0, len(cache))
+
+    def test_cached(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        def memoise():
+            f = util.cached(square)
+            f.cache_file = os.path.join(tmpdir.name, 'cache.db')
+            f.flush_size = 2
+
+            return f
+
+        # memoisations of the same function sharing a database, as if
+        # in separate processes
+        first = memoise()
+        second = memoise()
+
+        self.assertEqual([1, 4, 1], [first(1), first(2), first(1)])
+        self.assertEqual([1, 2], calls)
+
+        # results are only written once the batch is full
+        self.assertEqual(9, first(3))
+        self.assertEqual([4, 9], [second(2), second(3)])
+        self.assertEqual([1, 2, 3, 3], calls)
+
+        first.flush()
+
+        third = memoise()
+
+        self.assertEqual([1, 4, 9], [third(1), third(2), third(3)])
+        self.assertEqual([1, 2, 3, 3], calls)
+
+        with self.subTest('unserialisable'):
+            @util.cached
+            def get_int(v):
+                calls.append(v)
+                return v.int
+
+            get_int.cache_file = os.path.join(tmpdir.name, 'cache.db')
+
+            key = uuid.UUID(int=5)
+
+            # memoised, albeit only in memory
+            self.assertEqual([5, 5], [get_int(key), get_int(key)])
+            self.assertEqual(1, calls.count(key))
+            self.assertEqual({}, get_int.pending)
+
 
 class TestAppUtils(unittest.TestCase):
     def test_restrictargs(self):
@@ -801,6 +923,43 @@ class TestAppUtils(unittest.TestCase):
             self.assertEqual(client.get('/?fest=42').status,
                              '200 OK')
 
+    def test_copy_current_context(self):
+        app = flask.Flask(__name__)
+
+        def get_state():
+            return (
+                flask.has_request_context() and flask.request.path,
+                flask.g.get('state'),
+            )
+
+        def run_in_thread(func):
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                return executor.submit(func).result()
+
+        self.assertIs(get_state, util.copy_current_context(get_state))
+
+        with app.test_request_context('/kaflaflibob'):
+            flask.g.state = 42
+
+            self.assertEqual(
+                ('/kaflaflibob', 42),
+                run_in_thread(util.copy_current_context(get_state)),
+            )
+
+            self.assertEqual(
+                ('/kaflaflibob', None),
+                run_in_thread(util.copy_current_context(get_state,
+                                                        share_g=False)),
+            )
+
+        with app.app_context():
+            flask.g.state = 'app'
+
+            self.assertEqual(
+                (False, 'app'),
+                run_in_thread(util.copy_current_context(get_state)),
+            )
+
     def test_mapping_fieldtype(self):
         self.assertEqual("FieldTuple(('relationer', 'tilknyttedeitsystemer'), "
                          "FieldTypes.ADAPTED_ZERO_TO_MANY, None)",
@@ -15,6 +15,7 @@ import shutil
 import sys
 import tempfile
 import threading
+import urllib.parse
 from unittest.mock import patch
 
 import flask
@@ -27,8 +28,9 @@ import werkzeug.serving
 
 from oio_rest.utils import test_support
 
-from mora import app, lora, settings
+from mora import app, hierarchy, lora, settings
 from mora.importing import spreadsheets
+from mora.service import address
 
 TESTS_DIR = os.path.dirname(__file__)
 BASE_DIR = os.path.dirname(TESTS_DIR)
@@ -287,13 +289,23 @@ class mock(requests_mock.Mocker):
             if not isinstance(names, (list, tuple)):
                 names = [names]
 
+            fixtures = [
+                (url, value)
+                for name in names
+                for url, value in get_mock_data(name).items()
+            ]
+
+            # the fixtures contain DAWA addresses one at a time, so
+            # answer lookups of several at once by combining them;
+            # this goes first, as the last matching mock wins
+            self.__combine_dawa_lookups(fixtures)
+
             # inject the fixture; note that complete_qs is
             # important: without it, a URL need only match *some*
             # of the query parameters passed, and that's quite
             # obnoxious if requests only differ by them
-            for name in names:
-                for url, value in get_mock_data(name).items():
-                    self.get(url, json=value, complete_qs=True)
+            for url, value in fixtures:
+                self.get(url, json=value, complete_qs=True)
 
         if not allow_mox:
             self.__overrider = override_lora_url()
@@ -305,6 +317,40 @@ class mock(requests_mock.Mocker):
                 real_http=True,
             )
 
+    def __combine_dawa_lookups(self, fixtures):
+        def split(url):
+            parts = urllib.parse.urlsplit(url)
+            query = urllib.parse.parse_qsl(parts.query)
+
+            return (
+                parts.path,
+                tuple(sorted((k, v) for k, v in query if k != 'id')),
+                [v for k, v in query if k == 'id'],
+            )
+
+        addresses = {}
+
+        for url, value in fixtures:
+            path, query, ids = split(url)
+
+            if url.startswith('https://dawa.aws.dk/') and len(ids) == 1:
+                addresses[path, query, ids[0]] = value
+
+        def callback(request, context):
+            path, query, ids = split(request.url)
+
+            try:
+                return [
+                    addrobj
+                    for addrid in ''.join(ids).split('|')
+                    for addrobj in addresses[path, query, addrid]
+                ]
+            except KeyError:
+                raise requests_mock.exceptions.NoMockAddress(request)
+
+        if addresses:
+            self.get(re.compile('^https://dawa.aws.dk/'), json=callback)
+
     def copy(self):
         """Returns an exact copy of current mock
         """
@@ -314,11 +360,31 @@ class mock(requests_mock.Mocker):
         if self.__overrider:
             self.__overrider.__enter__()
 
+        # the fixtures correspond to requests made without the
+        # process-wide caches
+        self.__cache_patches = [
+            patch.object(lora.classification_cache, 'ttl', 0),
+            patch.object(hierarchy.cache, 'ttl', 0),
+            patch.object(address.dawa_cache, 'ttl', 0),
+            patch.object(address.autocomplete_cache, 'ttl', 0),
+        ]
+
+        for p in self.__cache_patches:
+            p.start()
+
+        lora.classification_cache.clear()
+        hierarchy.cache.clear()
+        hierarchy.sizes.clear()
+        address.autocomplete_cache.clear()
+
         super().start()
 
     def stop(self):
         super().stop()
 
+        for p in self.__cache_patches:
+            p.stop()
+
         if self.__overrider:
             self.__overrider.__exit__(None, None, None)
 
@@ -524,6 +590,7 @@ class LoRATestCaseMixin(test_support.TestCaseMixin, TestCaseMixin):
             patch('mora.importing.processors._fetch.cache', {}),
             patch('mora.importing.processors._fetch.cache_file',
                   os.devnull),
+            patch.object(address.dawa_cache, 'ttl', 0),
         ]
 
         # apply patches, then start the server -- so they're active
@@ -531,6 +598,10 @@ class LoRATestCaseMixin(test_support.TestCaseMixin, TestCaseMixin):
         for p in patches:
             p.start()
 
+        lora.classification_cache.clear()
+        hierarchy.cache.clear()
+        hierarchy.sizes.clear()
+
         threading.Thread(
             target=lora_server.serve_forever,
             args=(),